@@ -0,0 +1,158 @@
+"""
+Line alignments between any two versions of a note, composed from the
+alignments of consecutive versions.
+
+A note's history is covered by a segment tree over version numbers: a span
+goes from version s to version s + 2**k, where s - 1 is a multiple of 2**k.
+A leaf span joins two consecutive versions and is aligned from the stored
+delta when the later one is a delta of the earlier, or by diffing their
+contents otherwise. A longer span composes its two halves. Any range splits
+into at most 2 log2(n) spans, so once they are cached a diff across a
+thousand versions composes about twenty alignments instead of a thousand.
+
+Alignments are matching blocks over "\\n"-separated lines, kept in
+cache.alignment_cache keyed by the ids of a span's two versions (and the
+edits coalesced into the later one) and tagged with the note id. Spans
+shorter than MIN_CACHED_SPAN are recomposed from deltas rather than cached,
+to keep the cache small.
+"""
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from cache import alignment_cache
+from storage import delta_blocks
+from utils import compose_blocks, matching_blocks, refine_blocks
+
+MIN_CACHED_SPAN = 16
+
+Blocks = List[Tuple[int, int, int]]
+
+
+def spans(low: int, high: int) -> List[Tuple[int, int]]:
+    """Split the version numbers from low to high into spans of the tree"""
+    result = []
+    while low < high:
+        size = 1
+        while (low - 1) % (size * 2) == 0 and low + size * 2 <= high:
+            size *= 2
+        result.append((low, low + size))
+        low += size
+    return result
+
+
+def missing_leaves(versions: Mapping[int, object], low: int, high: int) -> Tuple[List[int], List[Tuple[int, int]]]:
+    """
+    What align() needs that is not cached: the ids of the versions whose
+    delta must be loaded, and the pairs of version numbers to diff.
+    versions maps version numbers to rows with id, base_id, edits and is_delta.
+    """
+    deltas, pairs = [], []
+    stack = spans(low, high)
+    while stack:
+        start, end = stack.pop()
+        if end - start == 1 and _is_delta(versions, start, end):
+            deltas.append(versions[end].id)
+        elif alignment_cache.peek(_key(versions, start, end)) is not None:
+            continue
+        elif end - start > 1:
+            stack.extend(_halves(start, end))
+        else:
+            pairs.append((start, end))
+    return deltas, pairs
+
+
+def align_pairs(note_id: int, versions: Mapping[int, object], pairs: Sequence[Tuple[int, int]], contents: Dict[int, str]) -> None:
+    """Diff and cache the alignments of pairs of consecutive versions, given their contents"""
+    for start, end in pairs:
+        _span(note_id, versions, start, end, {}, contents)
+
+
+def align(
+    note_id: int,
+    versions: Mapping[int, object],
+    low: int,
+    high: int,
+    deltas: Dict[int, str],
+    contents: Dict[int, str]
+) -> Optional[Blocks]:
+    """
+    Matching blocks of version low against version high, over "\\n"-separated
+    lines, caching the spans composed on the way. deltas and contents hold
+    what missing_leaves() asked for, by version id. Returns None if a leaf
+    is neither cached nor computable from them.
+    """
+    blocks: Optional[Blocks] = None
+    for start, end in spans(low, high):
+        span = _span(note_id, versions, start, end, deltas, contents)
+        if span is None:
+            return None
+        blocks = span if blocks is None else compose_blocks(blocks, span)
+    return blocks if blocks is not None else []
+
+
+def line_alignment(old_content: str, new_content: str, blocks: Optional[Blocks]) -> Tuple[List[str], List[str], Blocks]:
+    """
+    Turn an alignment over "\\n"-separated lines into one over the lines that
+    diffs report (str.splitlines), and recover lines that were removed then
+    restored within the range. Without an alignment, or when the two ways of
+    splitting disagree, the contents are diffed directly.
+    """
+    old_lines = old_content.splitlines()
+    new_lines = new_content.splitlines()
+    if blocks is None or not (_same_lines(old_content, old_lines) and _same_lines(new_content, new_lines)):
+        return old_lines, new_lines, matching_blocks(old_lines, new_lines)
+
+    clipped = []
+    for i, j, n in blocks:
+        n = min(n, len(old_lines) - i, len(new_lines) - j)
+        if n > 0:
+            clipped.append((i, j, n))
+    return old_lines, new_lines, refine_blocks(old_lines, new_lines, clipped)
+
+
+def _span(note_id, versions, start, end, deltas, contents) -> Optional[Blocks]:
+    if end - start == 1 and _is_delta(versions, start, end):
+        delta = deltas.get(versions[end].id)
+        return delta_blocks(delta) if delta is not None else None
+    key = _key(versions, start, end)
+    if end - start == 1 or end - start >= MIN_CACHED_SPAN:
+        blocks = alignment_cache.get(key)
+        if blocks is not None:
+            return blocks
+
+    if end - start == 1:
+        old, new = contents.get(versions[start].id), contents.get(versions[end].id)
+        if old is None or new is None:
+            return None
+        blocks = matching_blocks(old.split("\n"), new.split("\n"))
+    else:
+        (first_start, first_end), (second_start, second_end) = _halves(start, end)
+        first = _span(note_id, versions, first_start, first_end, deltas, contents)
+        second = _span(note_id, versions, second_start, second_end, deltas, contents) if first is not None else None
+        if second is None:
+            return None
+        blocks = compose_blocks(first, second)
+        if end - start < MIN_CACHED_SPAN:
+            return blocks
+
+    alignment_cache.set(key, blocks, tag=note_id)
+    return blocks
+
+
+def _key(versions, start: int, end: int) -> Tuple[int, int, int]:
+    # A head version taking coalesced edits changes, only the later end can be one
+    return versions[start].id, versions[end].id, versions[end].edits
+
+
+def _halves(start: int, end: int) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    middle = (start + end) // 2
+    return (start, middle), (middle, end)
+
+
+def _is_delta(versions, start: int, end: int) -> bool:
+    return versions[end].is_delta and versions[end].base_id == versions[start].id
+
+
+def _same_lines(content: str, lines: List[str]) -> bool:
+    """Whether splitting on "\\n" gives the same lines, up to a final empty one"""
+    split = content.split("\n")
+    return len(split) - len(lines) in (0, 1) and split[:len(lines)] == lines
@@ -0,0 +1,119 @@
+"""
+Benchmark autosaving editors: concurrent editors each keep changing a line of
+their own note and PUT it with their X-Edit-Session, every --interval seconds.
+Compares plain writes, coalescing into the head version
+(NOTES_AUTOSAVE_WINDOW), group commit (NOTES_GROUP_COMMIT) and both, under
+SQLite's default settings and the tuned profile. Reports write throughput,
+write latency, commits, and how much the version table grew.
+
+    python -m benchmarks.bench_autosave [--editors 32] [--interval 0.02] [--window 2] [--duration 5]
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import httpx
+from sqlalchemy import func, select
+
+from benchmarks.common import app_for, make_temp_db, percentile, print_table, seed_notes
+from database import DBNoteVersion, DBVersionBlob, sqlite_pragmas
+import main
+import storage
+from writer import GroupCommitWriter, immediate_engine
+
+
+async def editor(client, note_id, lines, interval, deadline, latencies, errors):
+    session = {"X-Edit-Session": f"editor-{note_id}"}
+    while time.perf_counter() < deadline:
+        lines[random.randrange(len(lines))] = f"edited {random.random()}"
+        started = time.perf_counter()
+        response = await client.put(
+            f"/notes/{note_id}", json={"title": f"Note {note_id}", "content": "\n".join(lines)}, headers=session
+        )
+        if response.status_code == 200:
+            latencies.append((time.perf_counter() - started) * 1000)
+        else:
+            errors.append(response.status_code)
+        await asyncio.sleep(interval)
+
+
+def history_size(engine):
+    """Version rows, and the bytes of their stored bodies (deltas and blobs)"""
+    with engine.connect() as conn:
+        versions = conn.execute(select(func.count()).select_from(DBNoteVersion)).scalar()
+        deltas = conn.execute(select(func.coalesce(func.sum(func.length(DBNoteVersion.delta)), 0))).scalar()
+        blobs = conn.execute(select(func.coalesce(func.sum(func.length(DBVersionBlob.content)), 0))).scalar()
+    return versions, deltas + blobs
+
+
+async def run_config(profile, window, group_commit, editors, interval, duration):
+    engine, _, path = make_temp_db(profile)
+    seed_notes(engine, editors, lines=40)
+    versions_before, bytes_before = history_size(engine)
+    app = app_for(path, profile)
+    storage.AUTOSAVE_WINDOW = window
+    main.group_writer = (
+        GroupCommitWriter(immediate_engine(f"sqlite:///{path}", sqlite_pragmas(profile))) if group_commit else None
+    )
+
+    latencies, errors = [], []
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            contents = {}
+            for note_id in range(1, editors + 1):
+                contents[note_id] = (await client.get(f"/notes/{note_id}")).json()["content"].split("\n")
+            deadline = time.perf_counter() + duration
+            await asyncio.gather(*(
+                editor(client, note_id, lines, interval, deadline, latencies, errors)
+                for note_id, lines in contents.items()
+            ))
+        versions_after, bytes_after = history_size(engine)
+        commits = main.group_writer.commits if group_commit else len(latencies)
+    finally:
+        if main.group_writer is not None:
+            main.group_writer.close()
+            main.group_writer.session_factory.kw["bind"].dispose()
+            main.group_writer = None
+        storage.AUTOSAVE_WINDOW = 0
+        engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    writes = len(latencies)
+    return [
+        profile,
+        f"{window:g}s" if window else "off",
+        "on" if group_commit else "off",
+        writes / duration,
+        percentile(latencies, 99) if latencies else 0.0,
+        commits,
+        versions_after - versions_before,
+        (bytes_after - bytes_before) / 1024,
+        len(errors),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--editors", type=int, default=32)
+    parser.add_argument("--interval", type=float, default=0.02, help="Seconds between an editor's saves")
+    parser.add_argument("--window", type=float, default=2, help="Coalescing window in seconds")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--profiles", default="default,tuned")
+    args = parser.parse_args()
+
+    rows = []
+    for profile in args.profiles.split(","):
+        for window, group_commit in ((0, False), (args.window, False), (0, True), (args.window, True)):
+            rows.append(asyncio.run(run_config(
+                profile, window, group_commit, args.editors, args.interval, args.duration
+            )))
+    print_table(
+        ["profile", "coalescing", "group commit", "writes/s", "p99 ms", "commits", "versions added",
+         "history KiB added", "errors"],
+        rows
+    )
@@ -0,0 +1,105 @@
+"""
+Benchmark fetching many notes, or many versions of a note, one call per item
+(GET /notes/{id}, GET /notes/{id}/versions/{version_id}) against one batched
+call (POST /notes:batchGet, POST /notes/{id}/versions:batchGet). The note
+and payload caches are cleared before every round, so notes and versions
+are read from the database.
+Reports the time to fetch them all and the SQL statements it took.
+
+    python -m benchmarks.bench_batch_get [--items 10,50,200] [--rounds 20]
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import httpx
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+
+from benchmarks.common import app_for, make_temp_db, percentile, print_table, seed_notes
+from database import DBNoteVersion
+import main
+
+
+async def fetch_notes(client, note_ids, batched):
+    if batched:
+        response = await client.post("/notes:batchGet", json={"ids": note_ids})
+        return len(response.json()["notes"])
+    return sum([(await client.get(f"/notes/{note_id}")).status_code == 200 for note_id in note_ids])
+
+
+async def fetch_versions(client, note_id, version_ids, batched):
+    if batched:
+        response = await client.post(f"/notes/{note_id}/versions:batchGet", json={"ids": version_ids})
+        return len(response.json()["versions"])
+    return sum([
+        (await client.get(f"/notes/{note_id}/versions/{version_id}")).status_code == 200
+        for version_id in version_ids
+    ])
+
+
+async def run(items_list, rounds):
+    notes = max(items_list) * 2
+    engine, _, path = make_temp_db()
+    seed_notes(engine, notes, lines=20)
+    seed_notes(engine, 1, versions_per_note=max(items_list), lines=20)
+    with engine.connect() as conn:
+        history_note = notes + 1
+        history = conn.execute(
+            select(DBNoteVersion.id).where(DBNoteVersion.note_id == history_note)
+        ).scalars().all()
+    app = app_for(path)
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    rows = []
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            event.listen(Engine, "before_cursor_execute", count)
+            for items in items_list:
+                for kind in ("notes", "versions"):
+                    for batched in (False, True):
+                        timings, fetched = [], 0
+                        del statements[:]
+                        for _ in range(rounds):
+                            main.note_cache.clear()
+                            main.payload_cache.clear()
+                            started = time.perf_counter()
+                            if kind == "notes":
+                                fetched += await fetch_notes(client, random.sample(range(1, notes + 1), items), batched)
+                            else:
+                                fetched += await fetch_versions(
+                                    client, history_note, random.sample(history, items), batched
+                                )
+                            timings.append((time.perf_counter() - started) * 1000)
+                        assert fetched == items * rounds
+                        rows.append([
+                            kind,
+                            items,
+                            "1 batched call" if batched else f"{items} single calls",
+                            percentile(timings, 50),
+                            percentile(timings, 99),
+                            len(statements) / rounds,
+                        ])
+            event.remove(Engine, "before_cursor_execute", count)
+    finally:
+        engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", default="10,50,200", help="Comma-separated numbers of items fetched")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = asyncio.run(run([int(n) for n in args.items.split(",")], args.rounds))
+    print_table(["fetching", "items", "calls", "p50 ms", "p99 ms", "SQL per fetch"], rows)
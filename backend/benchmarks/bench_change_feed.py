@@ -0,0 +1,134 @@
+"""
+Benchmark how clients learn about other users' edits: by re-polling GET /notes
+every --interval seconds, or by following the change feed (GET /notes:changes
+as server-sent events). Meanwhile a writer updates random notes --rate times
+a second. Reports how long a change takes to reach a client (from the note's
+updated_at to the client seeing it), and the requests and SQL statements the
+server spends per second to keep every client up to date.
+
+    python -m benchmarks.bench_change_feed [--clients 1000] [--interval 1] [--rate 20] [--duration 5]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from benchmarks.common import app_for, make_temp_db, percentile, print_table, seed_notes
+import main
+from changes import ChangeFeed
+
+
+def _lag_ms(updated_at: str) -> float:
+    return (datetime.datetime.utcnow() - datetime.datetime.fromisoformat(updated_at)).total_seconds() * 1000
+
+
+async def writer(client, notes, rate, deadline):
+    writes = 0
+    while time.perf_counter() < deadline:
+        note_id = random.randint(1, notes)
+        await client.put(f"/notes/{note_id}", json={"title": f"Note {note_id}", "content": f"edit {random.random()}"})
+        writes += 1
+        await asyncio.sleep(1 / rate)
+    return writes
+
+
+async def poller(client, interval, deadline, lags, requests):
+    await asyncio.sleep(random.uniform(0, interval))
+    newest = None
+    while time.perf_counter() < deadline:
+        items = (await client.get("/notes", params={"limit": 50})).json()["items"]
+        requests.append(1)
+        if newest is not None:
+            lags.extend(_lag_ms(item["updated_at"]) for item in items if item["updated_at"] > newest)
+        newest = max([newest or ""] + [item["updated_at"] for item in items])
+        await asyncio.sleep(interval)
+
+
+async def follower(session, cursor, lags, requests):
+    async with session() as db:
+        requests.append(1)
+        async for chunk in main._change_events(db, cursor):
+            for line in chunk.split(b"\n"):
+                if line.startswith(b"data: ") and b"updated_at" in line:
+                    lags.append(_lag_ms(json.loads(line[6:])["updated_at"]))
+
+
+async def run_config(mode, notes, clients, interval, rate, duration):
+    engine, _, path = make_temp_db()
+    seed_notes(engine, notes, lines=10)
+    app = app_for(path)
+    main.change_feed = ChangeFeed()
+    session = asynccontextmanager(app.dependency_overrides[main.get_db])
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    lags, requests = [], []
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            cursor = (await client.get("/notes:changes")).json()["cursor"]
+            deadline = time.perf_counter() + duration
+            if mode == "polling":
+                readers = [asyncio.create_task(poller(client, interval, deadline, lags, requests)) for _ in range(clients)]
+            else:
+                readers = [asyncio.create_task(follower(session, cursor, lags, requests)) for _ in range(clients)]
+                while main.change_feed.subscribers < clients:
+                    await asyncio.sleep(0.01)
+            event.listen(Engine, "before_cursor_execute", count)
+            started = time.perf_counter()
+            writes = await writer(client, notes, rate, deadline)
+            if mode == "polling":
+                await asyncio.gather(*readers)
+            else:
+                await asyncio.sleep(0.1)  # Deliver the last changes
+                for task in readers:
+                    task.cancel()
+                await asyncio.gather(*readers, return_exceptions=True)
+            elapsed = time.perf_counter() - started
+            event.remove(Engine, "before_cursor_execute", count)
+    finally:
+        engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    return [
+        mode,
+        clients,
+        writes / elapsed,
+        len(requests) / elapsed if mode == "polling" else 0.0,
+        0 if mode == "polling" else len(requests),
+        len(statements) / elapsed,
+        percentile(lags, 50) if lags else 0.0,
+        percentile(lags, 99) if lags else 0.0,
+        len(lags),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--notes", type=int, default=1000)
+    parser.add_argument("--clients", default="100,1000", help="Comma-separated numbers of clients")
+    parser.add_argument("--interval", type=float, default=1, help="Seconds between the polls of a client")
+    parser.add_argument("--rate", type=float, default=20, help="Writes per second")
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    for clients in (int(n) for n in args.clients.split(",")):
+        for mode in ("polling", "change feed"):
+            rows.append(asyncio.run(run_config(mode, args.notes, clients, args.interval, args.rate, args.duration)))
+    print_table(
+        ["mode", "clients", "writes/s", "polls/s", "streams", "SQL/s", "p50 lag ms", "p99 lag ms", "changes seen"],
+        rows
+    )
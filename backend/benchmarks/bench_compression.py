@@ -0,0 +1,77 @@
+"""
+Benchmark response compression on a large note with a long history: the
+note with every version embedded, one settled version, and a diff between
+two settled versions, in each encoding available. Versions and diffs are
+fetched cold (payload cache cleared, so they are serialized and compressed)
+and warm (served as stored). Reports the bytes sent, server time, and the
+time to fetch the response over a --mbps link.
+
+    python -m benchmarks.bench_compression [--lines 2000] [--versions 50] [--mbps 10] [--repeat 20]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+from benchmarks.common import app_for, make_temp_db, print_table, random_words, seed_notes
+from compression import ENCODINGS
+import main
+
+
+async def measure(client, url, encoding, repeat, cold):
+    timings, size = [], 0
+    for _ in range(repeat):
+        if cold:
+            main.payload_cache.clear()
+        started = time.perf_counter()
+        response = await client.get(url, headers={"Accept-Encoding": encoding})
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200
+        assert response.headers.get("content-encoding", "identity") == encoding
+        size = response.num_bytes_downloaded
+    return size, statistics.median(timings)
+
+
+async def run(lines, versions, mbps, repeat):
+    engine, _, path = make_temp_db()
+    seed_notes(engine, 1, versions_per_note=versions, lines=lines, text=random_words)
+    app = app_for(path)
+    rows = []
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            history = (await client.get("/notes/1/versions", params={"start": versions - 1})).json()
+            version_id = history[-1]["id"]
+            cases = [
+                ("note with history", "/notes/1?embed=versions", False),
+                ("version, cold", f"/notes/1/versions/{version_id}", True),
+                ("version, warm", f"/notes/1/versions/{version_id}", False),
+                ("diff, cold", f"/notes/1/diff?from=1&to={versions - 1}", True),
+                ("diff, warm", f"/notes/1/diff?from=1&to={versions - 1}", False),
+            ]
+            for name, url, cold in cases:
+                for encoding in ["identity"] + ENCODINGS:
+                    size, server_ms = await measure(client, url, encoding, repeat, cold)
+                    transfer_ms = size * 8 / (mbps * 1e6) * 1000
+                    rows.append([name, encoding, size / 1024, server_ms, server_ms + transfer_ms])
+    finally:
+        engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--versions", type=int, default=50)
+    parser.add_argument("--mbps", type=float, default=10, help="Link bandwidth in megabits per second")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = asyncio.run(run(args.lines, args.versions, args.mbps, args.repeat))
+    print_table(["response", "encoding", "KiB sent", "server ms", f"fetch ms at {args.mbps:g} Mbit/s"], rows)
@@ -0,0 +1,53 @@
+"""
+Benchmark note creation throughput: one POST /notes per note against
+POST /notes:batch with batches of various sizes.
+
+    python -m benchmarks.bench_create_notes [--notes 2000] [--batch-sizes 100,1000]
+"""
+import argparse
+import os
+import time
+
+from benchmarks.common import client_for, make_temp_db, print_table, random_text
+
+
+def run(total, batch_sizes):
+    payloads = [{"title": f"Note {i}", "content": random_text(20)} for i in range(total)]
+    rows = []
+
+    engine, _, path = make_temp_db()
+    try:
+        client = client_for(path)
+        started = time.perf_counter()
+        for payload in payloads:
+            client.post("/notes", json=payload).raise_for_status()
+        elapsed = time.perf_counter() - started
+        rows.append(["POST /notes", 1, total / elapsed])
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+    for batch_size in batch_sizes:
+        engine, _, path = make_temp_db()
+        try:
+            client = client_for(path)
+            started = time.perf_counter()
+            for offset in range(0, total, batch_size):
+                client.post(
+                    "/notes:batch", json={"notes": payloads[offset:offset + batch_size]}
+                ).raise_for_status()
+            elapsed = time.perf_counter() - started
+            rows.append(["POST /notes:batch", batch_size, total / elapsed])
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+    print_table(["endpoint", "batch size", "notes/s"], rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--batch-sizes", default="10,100,1000")
+    args = parser.parse_args()
+    run(args.notes, [int(size) for size in args.batch_sizes.split(",")])
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark of compare_versions against the original difflib.Differ
+implementation on large, heavily edited notes.
+
+    python -m benchmarks.bench_diff [--sizes 100,1000,5000] [--edit-ratio 0.3]
+"""
+import argparse
+import difflib
+import random
+import time
+
+from benchmarks.common import print_table, random_text
+from utils import compare_versions
+
+
+def differ_compare(old_version, new_version):
+    """The previous implementation, kept here as the baseline"""
+    content_diff = []
+    for line in difflib.Differ().compare(
+        old_version["content"].splitlines(), new_version["content"].splitlines()
+    ):
+        kind = {"  ": "unchanged", "- ": "removed", "+ ": "added"}.get(line[:2])
+        if kind:
+            content_diff.append({"type": kind, "content": line[2:]})
+    return content_diff
+
+
+def edited(content, ratio):
+    """Rewrite, insert and delete about ratio of the lines, with small intraline edits"""
+    lines = content.split("\n")
+    result = []
+    for line in lines:
+        roll = random.random()
+        if roll < ratio / 3:
+            continue
+        if roll < 2 * ratio / 3:
+            result.append(line[:20] + random_text(1, 10) + line[30:])
+        else:
+            result.append(line)
+        if random.random() < ratio / 3:
+            result.append(random_text(1))
+    return "\n".join(result)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - started) * 1000
+
+
+def run(sizes, ratio, differ_limit):
+    rows = []
+    for size in sizes:
+        old = {"title": "t", "content": random_text(size)}
+        new = {"title": "t", "content": edited(old["content"], ratio)}
+
+        fast_ms = min(timed(compare_versions, old, new) for _ in range(3))
+        if size <= differ_limit:
+            differ_ms = timed(differ_compare, old, new)
+            speedup = differ_ms / fast_ms
+        else:
+            differ_ms = speedup = "skipped"
+        rows.append([size, fast_ms, differ_ms, speedup])
+
+    print_table(["lines", "compare_versions ms", "Differ ms", "speedup"], rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="100,1000,5000,20000")
+    parser.add_argument("--edit-ratio", type=float, default=0.3)
+    parser.add_argument("--differ-limit", type=int, default=5000,
+                        help="Largest size to run the (slow) Differ baseline on")
+    args = parser.parse_args()
+    random.seed(0)
+    run([int(s) for s in args.sizes.split(",")], args.edit_ratio, args.differ_limit)
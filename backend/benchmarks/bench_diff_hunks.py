@@ -0,0 +1,71 @@
+"""
+Benchmark the diff endpoint on very large notes: the per-line format against
+hunks (with context, changed lines only, one page) and streamed NDJSON hunks.
+
+"cold" requests clear the diff cache first, so the diff is computed each time;
+"warm" ones reuse the cached alignment, as when paging through hunks.
+
+    python -m benchmarks.bench_diff_hunks [--lines 50000] [--edit-ratio 0.01]
+"""
+import argparse
+import os
+import random
+import tracemalloc
+
+from benchmarks.bench_diff import edited
+from benchmarks.common import client_for, make_temp_db, print_table, random_text, time_calls
+from cache import diff_cache
+
+
+def run(lines, ratio, repeat):
+    engine, _, path = make_temp_db()
+    try:
+        client = client_for(path)
+        content = random_text(lines)
+        note_id = client.post("/notes", json={"title": "Large", "content": content}).json()["id"]
+        client.put(f"/notes/{note_id}", json={"title": "Large", "content": edited(content, ratio)})
+        version_id = client.get(f"/notes/{note_id}/versions", params={"start": 2}).json()[0]["id"]
+        url = f"/notes/{note_id}/versions/{version_id}/diff"
+
+        variants = [
+            ("lines", {}, {}),
+            ("hunks, context 3", {"format": "hunks"}, {}),
+            ("hunks, changes only", {"format": "hunks", "context": 0}, {}),
+            ("hunks, first 20", {"format": "hunks", "hunk_limit": 20}, {}),
+            ("hunks, NDJSON", {"format": "hunks"}, {"Accept": "application/x-ndjson"}),
+        ]
+        rows = []
+        for name, params, headers in variants:
+            params = {"previous": True, **params}
+
+            def fetch():
+                return client.get(url, params=params, headers=headers)
+
+            def fetch_cold():
+                diff_cache.clear()
+                return fetch()
+
+            size = len(fetch_cold().content)
+            cold = time_calls(fetch_cold, repeat=repeat)
+            warm = time_calls(fetch, repeat=repeat)
+            tracemalloc.start()
+            fetch_cold()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rows.append([name, size / 1024, cold["p50_ms"], warm["p50_ms"], peak / 1024 / 1024])
+
+        print(f"{lines} lines, {ratio:.0%} of them edited")
+        print_table(["format", "response KiB", "cold p50 ms", "warm p50 ms", "peak MiB"], rows)
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=50000)
+    parser.add_argument("--edit-ratio", type=float, default=0.01)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    random.seed(0)
+    run(args.lines, args.edit_ratio, args.repeat)
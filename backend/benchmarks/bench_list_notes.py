@@ -0,0 +1,65 @@
+"""
+Benchmark GET /notes latency and memory as the notes table grows.
+
+The paginated listing should stay flat: the first page costs the same
+whether the table holds one thousand or fifty thousand notes.
+
+    python -m benchmarks.bench_list_notes [--sizes 1000,10000,50000]
+"""
+import argparse
+import os
+import tracemalloc
+
+from benchmarks.common import (
+    client_for, current_rss_mb, make_temp_db, print_table, seed_notes, time_calls
+)
+
+
+def run(sizes, versions_per_note, page_size):
+    rows = []
+    for size in sizes:
+        engine, _, path = make_temp_db()
+        try:
+            seed_notes(engine, size, versions_per_note=versions_per_note)
+            client = client_for(path)
+
+            first_page = time_calls(lambda: client.get("/notes", params={"limit": page_size}))
+            next_cursor = client.get("/notes", params={"limit": page_size}).json()["next_cursor"]
+            deep_page = time_calls(lambda: client.get(
+                "/notes", params={"limit": page_size, "cursor": next_cursor}
+            ))
+            with_versions = time_calls(lambda: client.get(
+                "/notes", params={"limit": page_size, "include": "versions"}
+            ))
+
+            tracemalloc.start()
+            client.get("/notes", params={"limit": page_size, "include": "versions"})
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            rows.append([
+                size,
+                first_page["p50_ms"],
+                deep_page["p50_ms"],
+                with_versions["p50_ms"],
+                with_versions["p99_ms"],
+                peak / 1024,
+                current_rss_mb(),
+            ])
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+    print_table(
+        ["notes", "page1 p50", "page2 p50", "+versions p50", "+versions p99", "peak KiB", "rss MB"],
+        rows
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--versions", type=int, default=5)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+    run([int(s) for s in args.sizes.split(",")], args.versions, args.page_size)
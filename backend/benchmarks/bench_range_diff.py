@@ -0,0 +1,97 @@
+"""
+Benchmark diffs between arbitrary versions of a note with a long history.
+
+"direct" diffs the two versions' contents, as when no alignment is reused.
+"cold" is the first request after clearing the alignment cache: consecutive
+versions stored as deltas are aligned from their deltas for free, and at
+most main.ALIGNMENTS_PER_REQUEST snapshot pairs are diffed and cached per
+request, so a wide range falls back to a direct diff until later requests
+have warmed the cache. "warm" is once every alignment is cached.
+
+    python -m benchmarks.bench_range_diff [--versions 1000] [--lines 2000,20000]
+"""
+import argparse
+import datetime
+import os
+import random
+
+import main
+from benchmarks.bench_diff import edited
+from benchmarks.common import client_for, make_temp_db, print_table, random_text, time_calls
+from cache import alignment_cache
+from transfer import import_batch
+
+
+def run(lines, versions, ratio, repeat):
+    engine, Session, path = make_temp_db()
+    try:
+        now = datetime.datetime.now()
+        history = [random_text(lines)]
+        for _ in range(versions - 1):
+            history.append(edited(history[-1], ratio))
+        with Session() as db:
+            note_id, = import_batch(db, [{
+                "title": "History", "content": history[-1], "created_at": now, "updated_at": now,
+                "versions": [{"title": "History", "content": content, "created_at": now} for content in history],
+            }])
+            db.commit()
+        client = client_for(path)
+
+        ranges = [
+            ("last 10", versions - 10, versions),
+            ("last 100", versions - 100, versions),
+            ("whole history", 1, versions),
+            ("whole history, reversed", versions, 1),
+        ]
+        rows = []
+        for name, old, new in ranges:
+            params = {"from": old, "to": new, "format": "hunks"}
+
+            def fetch():
+                response = client.get(f"/notes/{note_id}/diff", params=params)
+                assert response.status_code == 200
+                return response
+
+            def fetch_direct():
+                alignment_cache.clear()
+                return fetch()
+
+            def fetch_cold():
+                alignment_cache.clear()
+                main.ALIGNMENTS_PER_REQUEST = budget
+                return fetch()
+
+            budget = main.ALIGNMENTS_PER_REQUEST
+            main.ALIGNMENTS_PER_REQUEST = 0
+            direct = time_calls(fetch_direct, repeat=repeat)
+            main.ALIGNMENTS_PER_REQUEST = budget
+            cold = time_calls(fetch_cold, repeat=repeat)
+
+            warming = 0
+            alignment_cache.clear()
+            while True:
+                cached = len(alignment_cache)
+                fetch()
+                warming += 1
+                if len(alignment_cache) == cached:
+                    break  # Every snapshot pair of the range is cached
+            warm = time_calls(fetch, repeat=repeat)
+            rows.append([name, direct["p50_ms"], cold["p50_ms"], warming, warm["p50_ms"]])
+
+        print(f"{versions} versions of {lines} lines, {ratio:.2%} of them edited each time")
+        print_table(["range", "direct p50 ms", "cold p50 ms", "requests to warm", "warm p50 ms"], rows)
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--versions", type=int, default=1000)
+    parser.add_argument("--lines", default="2000,20000", help="Comma-separated note sizes")
+    parser.add_argument("--edit-ratio", type=float, default=0.0005)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for size in args.lines.split(","):
+        random.seed(0)
+        run(int(size), args.versions, args.edit_ratio, args.repeat)
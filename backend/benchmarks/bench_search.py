@@ -0,0 +1,80 @@
+"""
+Benchmark GET /notes/search on a large corpus.
+
+Notes are written with a Zipf-like vocabulary so that queries hit both very
+common and rare words. The FTS5 search is compared with the LIKE scan a
+search without an index would need.
+
+    python -m benchmarks.bench_search [--notes 100000]
+"""
+import argparse
+import os
+import time
+
+from sqlalchemy import text
+
+from benchmarks.common import (
+    VOCABULARY, client_for, make_temp_db, print_table, random_words, seed_notes, time_calls
+)
+
+
+def run(notes, lines, repeat):
+    engine, _, path = make_temp_db()
+    try:
+        started = time.perf_counter()
+        seed_notes(engine, notes, lines=lines, text=random_words)
+        seed_seconds = time.perf_counter() - started
+
+        with engine.connect() as conn:
+            page_size = conn.execute(text("PRAGMA page_size")).scalar()
+            index_pages = conn.execute(text(
+                "SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'notes_fts%'"
+            )).scalar() if _has_dbstat(conn) else None
+        print(f"seeded {notes} notes in {seed_seconds:.1f} s ({notes / seed_seconds:.0f} notes/s, index kept by triggers)")
+        print(f"database {os.path.getsize(path) / 1e6:.1f} MB", end="")
+        print(f", full-text index {index_pages / 1e6:.1f} MB" if index_pages else f" (page size {page_size})")
+
+        client = client_for(path)
+        common, medium, rare = VOCABULARY[0], VOCABULARY[50], VOCABULARY[4000]
+        queries = [
+            ("common word", {"q": common}),
+            ("medium word", {"q": medium}),
+            ("rare word", {"q": rare}),
+            ("two words", {"q": f"{common} {medium}"}),
+            ("prefix", {"q": medium[:4] + "*"}),
+            ("common, page 20", {"q": common, "offset": 19 * 20}),
+        ]
+        rows = []
+        for name, params in queries:
+            matches = len(client.get("/notes/search", params={**params, "limit": 200}).json()["items"])
+            stats = time_calls(lambda: client.get("/notes/search", params=params), repeat=repeat)
+            rows.append([name, params["q"], matches, stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]])
+
+        # What finding every match without an index costs: a scan of every note body
+        with engine.connect() as conn:
+            like = time_calls(lambda: conn.execute(text(
+                "SELECT id FROM notes WHERE title LIKE :pattern OR content LIKE :pattern"
+            ), {"pattern": f"%{rare}%"}).all(), repeat=max(3, repeat // 4))
+        rows.append(["LIKE scan", rare, "", like["p50_ms"], like["p95_ms"], like["p99_ms"]])
+
+        print_table(["query", "q", "matches (first 200)", "p50 ms", "p95 ms", "p99 ms"], rows)
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+
+def _has_dbstat(conn) -> bool:
+    try:
+        conn.execute(text("SELECT 1 FROM dbstat LIMIT 1"))
+        return True
+    except Exception:
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--notes", type=int, default=100000)
+    parser.add_argument("--lines", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.notes, args.lines, args.repeat)
@@ -0,0 +1,123 @@
+"""
+Benchmark response serialization for notes with large histories.
+
+Endpoints returning a note with its versions are timed end to end, along
+with the part of each request spent serializing its response, as recorded
+by the metrics middleware. A second table times serialization alone, for
+the same note: building response models and letting FastAPI validate and
+encode them, against encoding plain dicts built from the rows with orjson
+(when installed) or the json module.
+
+    python -m benchmarks.bench_serialization [--versions 10,100,1000] [--lines 50]
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+
+from pydantic import TypeAdapter
+
+from benchmarks.common import client_for, make_temp_db, print_table, random_words, time_calls
+from cache import note_cache
+from models import Note
+from observability import SERIALIZATION_SECONDS
+from transfer import import_batch
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def serialization_ms(client, method, url, route, repeat, **kwargs):
+    """Mean time serializing the response, over repeat requests"""
+    count, total = SERIALIZATION_SECONDS.totals(method, route)
+    for _ in range(repeat):
+        if route == "/notes/{note_id}":
+            note_cache.clear()
+        client.request(method, url, **kwargs)
+    new_count, new_total = SERIALIZATION_SECONDS.totals(method, route)
+    return (new_total - total) / max(1, new_count - count) * 1000
+
+
+def note_payload(versions, lines):
+    now = datetime.datetime(2024, 1, 1, 12, 0, 0, 123456)
+    content = random_words(lines)
+    return {
+        "id": 1, "title": "History", "content": content, "created_at": now, "updated_at": now,
+        "versions": [
+            {"id": i, "note_id": 1, "version_number": i, "title": "History", "content": content, "created_at": now}
+            for i in range(1, versions + 1)
+        ],
+    }
+
+
+def run(versions_list, lines, repeat):
+    endpoint_rows = []
+    encoder_rows = []
+    adapter = TypeAdapter(Note)
+    for versions in versions_list:
+        engine, Session, path = make_temp_db()
+        try:
+            now = datetime.datetime(2024, 1, 1)
+            with Session() as db:
+                content = random_words(lines)
+                note_id, = import_batch(db, [{
+                    "title": "History", "content": content, "created_at": now, "updated_at": now,
+                    "versions": [
+                        {"title": "History", "content": content + f"\nrevision {i}", "created_at": now}
+                        for i in range(versions)
+                    ],
+                }])
+                db.commit()
+            client = client_for(path)
+            body = client.get(f"/notes/{note_id}").json()
+            update = {"title": body["title"], "content": body["content"]}
+
+            def get_note():
+                note_cache.clear()
+                return client.get(f"/notes/{note_id}")
+
+            for name, method, url, route, kwargs, func in [
+                ("GET /notes/{id}", "GET", f"/notes/{note_id}", "/notes/{note_id}", {}, get_note),
+                ("GET /notes/{id}?embed=versions", "GET", f"/notes/{note_id}?embed=versions", "/notes/{note_id}", {},
+                 lambda: client.get(f"/notes/{note_id}?embed=versions")),
+                ("GET /notes/{id}/versions", "GET", f"/notes/{note_id}/versions", "/notes/{note_id}/versions", {},
+                 lambda: client.get(f"/notes/{note_id}/versions")),
+                ("PUT /notes/{id}, unchanged", "PUT", f"/notes/{note_id}", "/notes/{note_id}", {"json": update},
+                 lambda: client.put(f"/notes/{note_id}", json=update)),
+            ]:
+                latency = time_calls(func, repeat=repeat)
+                endpoint_rows.append([
+                    versions, name, latency["p50_ms"],
+                    serialization_ms(client, method, url, route, repeat, **kwargs)
+                ])
+        finally:
+            engine.dispose()
+            os.remove(path)
+
+        payload = note_payload(versions, lines)
+        encoders = [
+            ("models, validated by FastAPI", lambda: adapter.dump_json(adapter.validate_python(Note(**payload)))),
+            ("dicts, json", lambda: json.dumps(payload, default=datetime.datetime.isoformat).encode()),
+        ]
+        if orjson is not None:
+            encoders.append(("dicts, orjson", lambda: orjson.dumps(payload)))
+        for name, encode in encoders:
+            encoder_rows.append([versions, name, time_calls(encode, repeat=repeat)["p50_ms"]])
+
+    print(f"Notes with {lines}-line versions")
+    print_table(["versions", "request", "p50 ms", "serialization ms"], endpoint_rows)
+    print()
+    print_table(["versions", "serialization", "p50 ms"], encoder_rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--versions", default="10,100,1000", help="Comma-separated history depths")
+    parser.add_argument("--lines", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    random.seed(0)
+    run([int(v) for v in args.versions.split(",")], args.lines, args.repeat)
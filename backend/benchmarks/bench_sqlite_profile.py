@@ -0,0 +1,101 @@
+"""
+Concurrency benchmark of the SQLite connection profiles: write throughput
+and reader latency with concurrent writer and reader threads, for SQLite's
+default settings ("before") and the tuned profile ("after").
+
+    python -m benchmarks.bench_sqlite_profile [--writers 4] [--readers 8] [--duration 5]
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.common import percentile, print_table, random_text, seed_notes
+from database import Base, DBNote, DBNoteVersion, configure_sqlite, pool_options, sqlite_pragmas
+import storage
+
+
+def run_profile(profile, writers, readers, duration):
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="notes-profile-")
+    os.close(fd)
+    url = f"sqlite:///{path}"
+    engine = create_engine(url, connect_args={"check_same_thread": False}, **pool_options(url))
+    configure_sqlite(engine, sqlite_pragmas(profile))
+    Base.metadata.create_all(bind=engine)
+    seed_notes(engine, 2000, versions_per_note=3)
+
+    writes = []
+    locked = []
+    read_latencies = []
+    deadline = time.perf_counter() + duration
+
+    def write_loop(worker):
+        content = random_text(20)
+        while time.perf_counter() < deadline:
+            try:
+                with engine.begin() as conn:
+                    now = datetime.datetime.utcnow()
+                    note_id = conn.execute(insert(DBNote).values(
+                        title=f"Writer {worker}", content=content, created_at=now, updated_at=now
+                    )).inserted_primary_key[0]
+                    storage.save_blobs(conn, [content])
+                    conn.execute(insert(DBNoteVersion).values(
+                        note_id=note_id, version_number=1, title=f"Writer {worker}",
+                        content_hash=storage.content_hash(content), size=len(content), created_at=now
+                    ))
+                writes.append(1)
+            except OperationalError:
+                locked.append(1)
+
+    def read_loop():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    conn.execute(
+                        select(DBNote.id, DBNote.title, DBNote.updated_at)
+                        .order_by(DBNote.updated_at.desc()).limit(50)
+                    ).all()
+                    conn.execute(select(func.count()).select_from(DBNoteVersion)).scalar()
+                read_latencies.append((time.perf_counter() - started) * 1000)
+            except OperationalError:
+                locked.append(1)
+
+    threads = [threading.Thread(target=write_loop, args=(i,)) for i in range(writers)]
+    threads += [threading.Thread(target=read_loop) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    return [
+        profile,
+        len(writes) / duration,
+        len(locked),
+        percentile(read_latencies, 50) if read_latencies else 0.0,
+        percentile(read_latencies, 99) if read_latencies else 0.0,
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    args = parser.parse_args()
+
+    rows = [
+        run_profile(profile, args.writers, args.readers, args.duration)
+        for profile in ("default", "tuned")
+    ]
+    print_table(["profile", "writes/s", "locked errors", "read p50 ms", "read p99 ms"], rows)
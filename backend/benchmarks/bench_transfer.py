@@ -0,0 +1,88 @@
+"""
+Benchmark streaming export and import of notes with their history.
+
+A uvicorn server is started per corpus size; the export is streamed to a
+temporary file, then streamed into a second, empty server. The servers'
+peak RSS should stay flat as the corpus grows, since neither side holds
+more than a chunk of notes in memory. With the tuned SQLite profile, the
+database pages mapped through mmap also count towards RSS; set
+NOTES_SQLITE_MMAP_SIZE=0 to measure the process's own memory only.
+
+    python -m benchmarks.bench_transfer [--sizes 10000,50000] [--versions 5]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine
+
+from benchmarks.common import print_table, seed_notes
+from benchmarks.loadtest import start_server
+
+
+def peak_rss_mb(pid: int) -> float:
+    """Peak resident set size of a process in MB (Linux)"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def run(sizes, versions, port):
+    rows = []
+    for size in sizes:
+        source, url, source_path = start_server(port)
+        target, target_url, target_path = start_server(port + 1)
+        fd, export_path = tempfile.mkstemp(suffix=".ndjson", prefix="notes-export-")
+        os.close(fd)
+        try:
+            engine = create_engine(f"sqlite:///{source_path}")
+            seed_notes(engine, size, versions_per_note=versions)
+            engine.dispose()
+            baseline = peak_rss_mb(source.pid)
+
+            started = time.perf_counter()
+            with httpx.stream("GET", f"{url}/notes:export", timeout=None) as response, \
+                    open(export_path, "wb") as out:
+                response.raise_for_status()
+                for chunk in response.iter_bytes():
+                    out.write(chunk)
+            export_seconds = time.perf_counter() - started
+            export_mb = os.path.getsize(export_path) / 1e6
+            rows.append([
+                "export", size, size / export_seconds, export_mb / export_seconds,
+                baseline, peak_rss_mb(source.pid)
+            ])
+
+            baseline = peak_rss_mb(target.pid)
+            started = time.perf_counter()
+            with open(export_path, "rb") as body:
+                response = httpx.post(
+                    f"{target_url}/notes:import", content=iter(lambda: body.read(1 << 16), b""), timeout=None
+                )
+            response.raise_for_status()
+            import_seconds = time.perf_counter() - started
+            rows.append([
+                "import", size, size / import_seconds, export_mb / import_seconds,
+                baseline, peak_rss_mb(target.pid)
+            ])
+        finally:
+            for server, path in ((source, source_path), (target, target_path)):
+                server.terminate()
+                server.wait()
+                os.remove(path)
+            os.remove(export_path)
+
+    print_table(["operation", "notes", "notes/s", "MB/s", "rss before MB", "peak rss MB"], rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="10000,50000")
+    parser.add_argument("--versions", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8775)
+    args = parser.parse_args()
+    run([int(size) for size in args.sizes.split(",")], args.versions, args.port)
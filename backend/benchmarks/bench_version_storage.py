@@ -0,0 +1,80 @@
+"""
+Benchmark version storage size and reconstruct latency against history depth,
+comparing full copies with snapshot + delta chains.
+
+    python -m benchmarks.bench_version_storage [--depths 10,100,500,1000]
+"""
+import argparse
+import os
+import random
+
+from sqlalchemy import text
+
+import storage
+from benchmarks.common import make_temp_db, print_table, random_text, time_calls
+from database import DBNote, DBNoteVersion
+
+
+def build_history(session_factory, depth, lines):
+    """Create one note edited depth times, a couple of lines per edit"""
+    db = session_factory()
+    content_lines = random_text(lines).split("\n")
+    content = "\n".join(content_lines)
+    note = DBNote(title="Bench", content=content)
+    db.add(note)
+    db.flush()
+    head = storage.add_version(db, note.id, note.title, content)
+    db.flush()
+
+    for _ in range(depth - 1):
+        for index in random.sample(range(len(content_lines)), 2):
+            content_lines[index] = random_text(1)
+        new_content = "\n".join(content_lines)
+        version = storage.add_version(db, note.id, note.title, new_content, head=head, head_content=content)
+        db.flush()
+        head, content = version, new_content
+
+    note.content = content
+    note_id = note.id
+    db.commit()
+    db.close()
+    return note_id
+
+
+def run(depths, lines):
+    rows = []
+    for depth in depths:
+        for mode in ("full", "delta"):
+            storage.STORAGE_MODE = mode
+            engine, session_factory, path = make_temp_db()
+            try:
+                note_id = build_history(session_factory, depth, lines)
+                with engine.connect() as conn:
+                    conn.execute(text("VACUUM"))
+                size_kib = os.path.getsize(path) / 1024
+
+                db = session_factory()
+                versions = db.query(DBNoteVersion).filter(
+                    DBNoteVersion.note_id == note_id
+                ).order_by(DBNoteVersion.id).all()
+                single = time_calls(lambda: storage.load_contents(db, [versions[-1]]))
+                history = time_calls(lambda: storage.load_contents(db, versions), repeat=5)
+                db.close()
+
+                rows.append([
+                    depth, mode, size_kib, max(v.chain_length for v in versions),
+                    single["p50_ms"], history["p50_ms"]
+                ])
+            finally:
+                engine.dispose()
+                os.remove(path)
+
+    print_table(["depth", "mode", "db KiB", "max chain", "latest ms", "full history ms"], rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--depths", default="10,100,500,1000")
+    parser.add_argument("--lines", type=int, default=200)
+    args = parser.parse_args()
+    run([int(d) for d in args.depths.split(",")], args.lines)
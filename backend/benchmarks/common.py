@@ -0,0 +1,185 @@
+"""
+Shared helpers for the backend benchmarks.
+
+Benchmarks are run from the backend directory, e.g.:
+    python -m benchmarks.bench_list_notes
+"""
+import datetime
+import itertools
+import os
+import random
+import resource
+import statistics
+import string
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, DBNote, DBNoteVersion, configure_sqlite, sqlite_pragmas
+import storage
+
+
+def make_temp_db(profile: Optional[str] = None) -> Tuple[object, sessionmaker, str]:
+    """
+    Create an empty SQLite database in a temporary file, under the given
+    SQLite profile (NOTES_SQLITE_PROFILE by default).
+    Returns the engine, a session factory and the file path.
+    """
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="notes-bench-")
+    os.close(fd)
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    configure_sqlite(engine, sqlite_pragmas(profile))
+    Base.metadata.create_all(bind=engine)
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine), path
+
+
+def random_text(lines: int, line_length: int = 60) -> str:
+    alphabet = string.ascii_lowercase + " "
+    return "\n".join(
+        "".join(random.choices(alphabet, k=line_length)) for _ in range(lines)
+    )
+
+
+def random_words(lines: int, words_per_line: int = 10, vocabulary: int = 5000) -> str:
+    """
+    Text drawn from a fixed vocabulary with Zipf-like word frequencies, so that
+    some words are common and most are rare, as in real notes.
+    """
+    words = VOCABULARY[:vocabulary]
+    weights = _ZIPF_CUMULATIVE_WEIGHTS[:vocabulary]
+    return "\n".join(
+        " ".join(random.choices(words, cum_weights=weights, k=words_per_line)) for _ in range(lines)
+    )
+
+
+# Deterministic pseudo-words, VOCABULARY[0] being the most frequent
+VOCABULARY = [f"{''.join(random.Random(i).choices(string.ascii_lowercase, k=5))}{i}" for i in range(5000)]
+_ZIPF_CUMULATIVE_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(VOCABULARY) + 1)))
+
+
+def seed_notes(
+    engine,
+    notes: int,
+    versions_per_note: int = 1,
+    lines: int = 20,
+    batch: int = 1000,
+    text: Callable[[int], str] = random_text
+) -> None:
+    """
+    Insert synthetic notes, each with a chain of versions, using executemany inserts.
+    text(lines) generates the body of each note.
+    """
+    start = datetime.datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        first_id = (conn.execute(select(func.max(DBNote.id))).scalar() or 0) + 1
+        for offset in range(0, notes, batch):
+            note_rows = []
+            version_rows = []
+            blobs = []
+            for i in range(offset, min(offset + batch, notes)):
+                note_id = first_id + i
+                created = start + datetime.timedelta(seconds=i)
+                content = text(lines)
+                for v in range(versions_per_note):
+                    version_content = content + f"\nrevision {v}"
+                    blobs.append(version_content)
+                    version_rows.append({
+                        "note_id": note_id,
+                        "version_number": v + 1,
+                        "title": f"Note {note_id}",
+                        "content_hash": storage.content_hash(version_content),
+                        "size": len(version_content),
+                        "created_at": created + datetime.timedelta(minutes=v),
+                    })
+                note_rows.append({
+                    "id": note_id,
+                    "title": f"Note {note_id}",
+                    "content": content + f"\nrevision {versions_per_note - 1}",
+                    "created_at": created,
+                    "updated_at": created + datetime.timedelta(minutes=versions_per_note - 1),
+                })
+            conn.execute(insert(DBNote), note_rows)
+            storage.save_blobs(conn, blobs)
+            conn.execute(insert(DBNoteVersion), version_rows)
+
+
+def app_for(path: str, profile: Optional[str] = None):
+    """
+    Return the API application, with requests using the SQLite database at
+    path, under the given SQLite profile (NOTES_SQLITE_PROFILE by default).
+    """
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    from main import app, get_db
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    configure_sqlite(async_engine.sync_engine, sqlite_pragmas(profile))
+    session_factory = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_db():
+        async with session_factory() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = override_get_db
+    return app
+
+
+def client_for(path: str):
+    """
+    Return a TestClient whose requests use the SQLite database at path.
+    """
+    from fastapi.testclient import TestClient
+
+    return TestClient(app_for(path))
+
+
+def current_rss_mb() -> float:
+    """
+    Current resident set size in MB (Linux), falling back to the peak RSS elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def time_calls(func: Callable[[], object], repeat: int = 20, warmup: int = 2) -> Dict[str, float]:
+    """
+    Call func repeatedly and return latency statistics in milliseconds.
+    """
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return {
+        "p50_ms": statistics.median(samples),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": max(samples),
+    }
+
+
+def print_table(headers: List[str], rows: List[List[object]]) -> None:
+    widths = [max(len(str(h)), *(len(_fmt(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    print("  ".join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(_fmt(v).rjust(w) for v, w in zip(row, widths)))
+
+
+def _fmt(value: object) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
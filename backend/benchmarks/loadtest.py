@@ -0,0 +1,123 @@
+"""
+Load test mixing concurrent reads and writes against a running API.
+
+By default a uvicorn server for this tree is started on a temporary database.
+Pass --url to target another server instead, for example a checkout of an
+older commit, and compare the reported p99 latencies.
+
+    python -m benchmarks.loadtest [--readers 32] [--writers 8] [--duration 10]
+    python -m benchmarks.loadtest --url http://localhost:8000
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.common import percentile, print_table, random_text
+
+
+async def seed(client: httpx.AsyncClient, notes: int) -> List[int]:
+    ids = []
+    for i in range(notes):
+        response = await client.post("/notes", json={"title": f"Load {i}", "content": random_text(20)})
+        response.raise_for_status()
+        ids.append(response.json()["id"])
+    return ids
+
+
+async def reader(client, note_ids, deadline, samples):
+    while time.perf_counter() < deadline:
+        note_id = random.choice(note_ids)
+        started = time.perf_counter()
+        if random.random() < 0.8:
+            response = await client.get(f"/notes/{note_id}")
+            kind = "GET /notes/{id}"
+        else:
+            response = await client.get("/notes")
+            kind = "GET /notes"
+        samples.setdefault(kind, []).append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 500:
+            samples.setdefault("errors", []).append(0)
+
+
+async def writer(client, note_ids, deadline, samples):
+    while time.perf_counter() < deadline:
+        note_id = random.choice(note_ids)
+        started = time.perf_counter()
+        response = await client.put(
+            f"/notes/{note_id}", json={"title": f"Load {note_id}", "content": random_text(20)}
+        )
+        samples.setdefault("PUT /notes/{id}", []).append((time.perf_counter() - started) * 1000)
+        if response.status_code >= 500:
+            samples.setdefault("errors", []).append(0)
+
+
+async def run(url, readers, writers, duration, notes):
+    limits = httpx.Limits(max_connections=readers + writers)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        note_ids = await seed(client, notes)
+        samples: Dict[str, List[float]] = {}
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(
+            *(reader(client, note_ids, deadline, samples) for _ in range(readers)),
+            *(writer(client, note_ids, deadline, samples) for _ in range(writers)),
+        )
+
+    errors = len(samples.pop("errors", []))
+    rows = [
+        [kind, len(values), len(values) / duration,
+         percentile(values, 50), percentile(values, 95), percentile(values, 99)]
+        for kind, values in sorted(samples.items())
+    ]
+    print_table(["operation", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms"], rows)
+    print(f"server errors: {errors}")
+
+
+def start_server(port: int, path: Optional[str] = None):
+    """Start uvicorn for this tree on the database at path, by default a fresh temporary one"""
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".db", prefix="notes-load-")
+        os.close(fd)
+    env = dict(os.environ, NOTES_DATABASE_URL=f"sqlite:///{path}")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(url)
+            break
+        except httpx.TransportError:
+            time.sleep(0.1)
+    return server, url, path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", help="Target an already running server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--readers", type=int, default=32)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--notes", type=int, default=200)
+    args = parser.parse_args()
+
+    server = path = None
+    url = args.url
+    if url is None:
+        server, url, path = start_server(args.port)
+    try:
+        asyncio.run(run(url, args.readers, args.writers, args.duration, args.notes))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            os.remove(path)
@@ -0,0 +1,416 @@
+"""
+Benchmark suite driving every endpoint of the API against seeded corpora.
+
+Each corpus (a number of notes, of a number of lines, each with a history
+of some depth) is seeded into a temporary SQLite file from a fixed random
+seed. Every scenario then sends its requests from concurrent clients,
+either to the application in this process (--mode inprocess, no network)
+or to a uvicorn server on the same file (--mode uvicorn), and reports
+throughput and p50/p95/p99 latencies. Results are saved as JSON, tagged
+with the commit, for compare to flag regressions between two runs; a run
+where some requests failed is not saved, as its numbers would mislead:
+
+    python -m benchmarks.suite [--mode inprocess|uvicorn] [--corpus default --corpus deep-history]
+    python -m benchmarks.suite compare results/old.json results/new.json [--threshold 0.2]
+
+The suite refuses to run if a route of main.py has no scenario. Scenarios
+the corpus cannot support (a next page of a corpus that fits in one) are
+skipped.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+from fastapi.routing import APIRoute
+from sqlalchemy import select
+
+# The profiler is switched at runtime, by the app of this process or uvicorn's
+os.environ.setdefault("NOTES_PROFILE_RUNTIME", "1")
+
+from benchmarks.bench_diff import edited
+from benchmarks.common import VOCABULARY, app_for, make_temp_db, percentile, print_table, random_words
+from benchmarks.loadtest import start_server
+from cache import alignment_cache, diff_cache, note_cache, payload_cache
+from database import DBNote, DBNoteVersion
+from transfer import import_batch
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# name: (notes, lines per note, versions per note)
+CORPORA = {
+    "default": (2000, 20, 5),
+    "large-notes": (200, 2000, 5),
+    "deep-history": (100, 50, 200),
+}
+
+
+class Corpus:
+    """What scenarios draw their requests from"""
+
+    def __init__(self, name: str, notes: int, lines: int, versions: int):
+        self.name = name
+        self.notes = notes
+        self.lines = lines
+        self.versions = versions
+        self.note_ids: List[int] = []
+        self.version_ids: Dict[int, List[int]] = {}  # By note, in version number order
+        self.etags: Dict[int, str] = {}
+        self.cursor: Optional[str] = None
+        self.disposable_ids: List[int] = []
+
+    def settings(self) -> Dict[str, int]:
+        return {"notes": self.notes, "lines": self.lines, "versions": self.versions}
+
+
+def seed_corpus(corpus: Corpus, session_factory, seed: int) -> None:
+    """Import the corpus's notes with their histories, encoded as the API would store them"""
+    random.seed(seed)
+    now = datetime.datetime(2024, 1, 1)
+    with session_factory() as db:
+        for offset in range(0, corpus.notes, 100):
+            batch = []
+            for i in range(offset, min(offset + 100, corpus.notes)):
+                history = [random_words(corpus.lines)]
+                for _ in range(corpus.versions - 1):
+                    history.append(edited(history[-1], 0.1))
+                created = now + datetime.timedelta(minutes=i)
+                batch.append({
+                    "title": f"Note {i}",
+                    "content": history[-1],
+                    "created_at": created,
+                    "updated_at": created,
+                    "versions": [
+                        {"title": f"Note {i}", "content": content, "created_at": created}
+                        for content in history
+                    ],
+                })
+            import_batch(db, batch)
+            db.commit()
+
+        for note_id, version_id in db.execute(
+            select(DBNoteVersion.note_id, DBNoteVersion.id)
+            .order_by(DBNoteVersion.note_id, DBNoteVersion.version_number)
+        ):
+            corpus.version_ids.setdefault(note_id, []).append(version_id)
+        corpus.note_ids = db.execute(select(DBNote.id).order_by(DBNote.id)).scalars().all()
+
+
+async def prepare(client: httpx.AsyncClient, corpus: Corpus, rng: random.Random, deletions: int) -> None:
+    """Gather what some scenarios need from the API itself"""
+    corpus.cursor = (await client.get("/notes", params={"limit": 50})).json()["next_cursor"]
+    for note_id in rng.sample(corpus.note_ids, min(50, len(corpus.note_ids))):
+        corpus.etags[note_id] = (await client.get(f"/notes/{note_id}")).headers["ETag"]
+    notes = [{"title": "Disposable", "content": "To be deleted"}] * deletions
+    corpus.disposable_ids = (await client.post("/notes:batch", json={"notes": notes})).json()["ids"]
+
+
+# A request: method, URL, and keyword arguments for httpx
+Request = Tuple[str, str, dict]
+
+
+class Scenario:
+    def __init__(
+        self,
+        name: str,
+        method: str,
+        route: str,
+        build: Callable[[Corpus, random.Random], Request],
+        weight: float = 1.0,
+        applies: Optional[Callable[[Corpus], bool]] = None
+    ):
+        self.name = name
+        self.method = method
+        self.route = route  # Path template of the route it exercises
+        self.build = build
+        self.weight = weight  # Fraction of --requests sent, for the heaviest endpoints
+        self.applies = applies  # Whether a prepared corpus supports it, always by default
+
+
+def _note(corpus, rng):
+    return rng.choice(corpus.note_ids)
+
+
+def _version(corpus, rng, first: int = 0):
+    note_id = _note(corpus, rng)
+    return note_id, rng.choice(corpus.version_ids[note_id][first:])
+
+
+def _import_body(corpus, rng):
+    lines = []
+    for i in range(10):
+        content = random_words(corpus.lines)
+        lines.append(json.dumps({
+            "title": f"Imported {i}", "content": content,
+            "created_at": "2024-01-01T00:00:00", "updated_at": "2024-01-01T00:00:00",
+            "versions": [{"version_number": 1, "title": f"Imported {i}", "content": content, "created_at": "2024-01-01T00:00:00"}],
+        }))
+    return "\n".join(lines) + "\n"
+
+
+SCENARIOS = [
+    Scenario("root", "GET", "/", lambda c, r: ("GET", "/", {})),
+    Scenario("cache stats", "GET", "/cache/stats", lambda c, r: ("GET", "/cache/stats", {})),
+    Scenario("metrics", "GET", "/metrics", lambda c, r: ("GET", "/metrics", {})),
+    Scenario("profiler report", "GET", "/debug/profiler", lambda c, r: ("GET", "/debug/profiler", {})),
+    Scenario("profiler switch", "PUT", "/debug/profiler", lambda c, r: ("PUT", "/debug/profiler", {"json": {"slow_ms": 0}})),
+    Scenario("list", "GET", "/notes", lambda c, r: ("GET", "/notes", {"params": {"limit": 50}})),
+    Scenario(
+        "list, next page", "GET", "/notes", lambda c, r: ("GET", "/notes", {"params": {"limit": 50, "cursor": c.cursor}}),
+        applies=lambda c: c.cursor is not None
+    ),
+    Scenario("list with versions", "GET", "/notes", lambda c, r: ("GET", "/notes", {"params": {"limit": 50, "include": "versions"}})),
+    Scenario("create", "POST", "/notes", lambda c, r: (
+        "POST", "/notes", {"json": {"title": "Created", "content": random_words(c.lines)}}
+    )),
+    Scenario("create batch of 100", "POST", "/notes:batch", lambda c, r: (
+        "POST", "/notes:batch", {"json": {"notes": [{"title": "Batch", "content": random_words(c.lines)}] * 100}}
+    ), weight=0.1),
+    Scenario("export", "GET", "/notes:export", lambda c, r: ("GET", "/notes:export", {}), weight=0.02),
+    Scenario("import 10 notes", "POST", "/notes:import", lambda c, r: (
+        "POST", "/notes:import", {"content": _import_body(c, r), "headers": {"Content-Type": "application/x-ndjson"}}
+    ), weight=0.1),
+    Scenario("search", "GET", "/notes/search", lambda c, r: (
+        "GET", "/notes/search", {"params": {"q": r.choice(VOCABULARY[:100])}}
+    )),
+    Scenario("changes since a cursor", "GET", "/notes:changes", lambda c, r: (
+        "GET", "/notes:changes", {"params": {"after": r.randrange(c.notes), "limit": 100}}
+    )),
+    Scenario("get note", "GET", "/notes/{note_id}", lambda c, r: ("GET", f"/notes/{_note(c, r)}", {})),
+    Scenario("get note with versions embedded", "GET", "/notes/{note_id}", lambda c, r: (
+        "GET", f"/notes/{_note(c, r)}", {"params": {"embed": "versions"}}
+    )),
+    Scenario("get note, not modified", "GET", "/notes/{note_id}", lambda c, r: (
+        lambda note_id: ("GET", f"/notes/{note_id}", {"headers": {"If-None-Match": c.etags[note_id]}})
+    )(r.choice(list(c.etags)))),
+    Scenario("get 50 notes", "POST", "/notes:batchGet", lambda c, r: (
+        "POST", "/notes:batchGet", {"json": {"ids": r.sample(c.note_ids, min(50, len(c.note_ids)))}}
+    )),
+    Scenario("update note", "PUT", "/notes/{note_id}", lambda c, r: (
+        "PUT", f"/notes/{_note(c, r)}", {"json": {"title": "Updated", "content": random_words(c.lines)}}
+    )),
+    Scenario("delete note", "DELETE", "/notes/{note_id}", lambda c, r: ("DELETE", f"/notes/{c.disposable_ids.pop()}", {})),
+    Scenario("versions", "GET", "/notes/{note_id}/versions", lambda c, r: ("GET", f"/notes/{_note(c, r)}/versions", {})),
+    Scenario("get version", "GET", "/notes/{note_id}/versions/{version_id}", lambda c, r: (
+        "GET", "/notes/{}/versions/{}".format(*_version(c, r)), {}
+    )),
+    Scenario("get every version", "POST", "/notes/{note_id}/versions:batchGet", lambda c, r: (
+        lambda note_id: ("POST", f"/notes/{note_id}/versions:batchGet", {"json": {"ids": c.version_ids[note_id]}})
+    )(_note(c, r))),
+    Scenario("revert", "POST", "/notes/{note_id}/revert/{version_id}", lambda c, r: (
+        "POST", "/notes/{}/revert/{}".format(*_version(c, r)), {}
+    )),
+    Scenario("diff with previous", "GET", "/notes/{note_id}/versions/{version_id}/diff", lambda c, r: (
+        "GET", "/notes/{}/versions/{}/diff".format(*_version(c, r, first=1)), {"params": {"previous": True}}
+    )),
+    Scenario("diff hunks with note", "GET", "/notes/{note_id}/versions/{version_id}/diff", lambda c, r: (
+        "GET", "/notes/{}/versions/{}/diff".format(*_version(c, r)), {"params": {"format": "hunks"}}
+    )),
+    Scenario("diff whole history", "GET", "/notes/{note_id}/diff", lambda c, r: (
+        "GET", f"/notes/{_note(c, r)}/diff", {"params": {"from": 1, "to": c.versions, "format": "hunks"}}
+    )),
+]
+
+
+def check_coverage(app) -> None:
+    """Fail if a route of the application has no scenario"""
+    covered = {(scenario.method, scenario.route) for scenario in SCENARIOS}
+    missing = [
+        f"{method} {route.path}"
+        for route in app.routes if isinstance(route, APIRoute)
+        for method in route.methods if (method, route.path) not in covered
+    ]
+    if missing:
+        raise SystemExit(f"No benchmark scenario for: {', '.join(sorted(missing))}")
+
+
+async def run_scenario(client: httpx.AsyncClient, corpus: Corpus, scenario: Scenario, requests: int, concurrency: int, seed: int) -> dict:
+    rng = random.Random(f"{seed}-{corpus.name}-{scenario.name}")
+    planned = [scenario.build(corpus, rng) for _ in range(requests)]
+    latencies: List[float] = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while planned:
+            method, url, kwargs = planned.pop()
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, requests))))
+    seconds = time.perf_counter() - started
+    return {
+        "corpus": corpus.name,
+        "scenario": scenario.name,
+        "method": scenario.method,
+        "route": scenario.route,
+        "requests": requests,
+        "errors": errors,
+        "seconds": seconds,
+        "throughput": requests / seconds,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies),
+    }
+
+
+async def run_corpus(client: httpx.AsyncClient, corpus: Corpus, requests: int, concurrency: int, seed: int) -> List[dict]:
+    counts = {scenario.name: max(1, int(requests * scenario.weight)) for scenario in SCENARIOS}
+    await prepare(client, corpus, random.Random(seed), deletions=counts["delete note"])
+    results = []
+    for scenario in SCENARIOS:
+        if scenario.applies is not None and not scenario.applies(corpus):
+            print(f"  {scenario.name}: skipped for this corpus", file=sys.stderr)
+            continue
+        result = await run_scenario(client, corpus, scenario, counts[scenario.name], concurrency, seed)
+        results.append(result)
+        print(f"  {scenario.name}: {result['throughput']:.1f} req/s, p50 {result['p50_ms']:.2f} ms", file=sys.stderr)
+    return results
+
+
+def run(corpora: List[Corpus], mode: str, requests: int, concurrency: int, seed: int, port: int) -> dict:
+    results = []
+    for corpus in corpora:
+        engine, session_factory, path = make_temp_db()
+        server = None
+        try:
+            print(f"Seeding {corpus.name}: {corpus.settings()}", file=sys.stderr)
+            seed_corpus(corpus, session_factory, seed)
+            engine.dispose()
+            limits = httpx.Limits(max_connections=concurrency)
+            if mode == "uvicorn":
+                server, url, _ = start_server(port, path)
+                client = httpx.AsyncClient(base_url=url, limits=limits, timeout=300)
+            else:
+                app = app_for(path)
+                check_coverage(app)
+                for cache in (note_cache, diff_cache, alignment_cache, payload_cache):
+                    cache.clear()  # Ids repeat from one corpus to the next
+                client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://suite", timeout=300)
+
+            async def drive():
+                async with client:
+                    return await run_corpus(client, corpus, requests, concurrency, seed)
+
+            for result in asyncio.run(drive()):
+                result["corpus_settings"] = corpus.settings()
+                results.append(result)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"mode": mode, "requests": requests, "concurrency": concurrency, "seed": seed},
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> bool:
+    """Print how each scenario moved; returns whether any regressed beyond threshold"""
+    old_results = {(r["corpus"], r["scenario"]): r for r in old["results"]}
+    rows = []
+    regressed = False
+    for result in new["results"]:
+        before = old_results.get((result["corpus"], result["scenario"]))
+        if before is None:
+            continue
+        changes = {
+            "p50": result["p50_ms"] / before["p50_ms"] - 1,
+            "p95": result["p95_ms"] / before["p95_ms"] - 1,
+            "throughput": before["throughput"] / result["throughput"] - 1,  # Positive when slower
+        }
+        worse = [name for name, change in changes.items() if change > threshold]
+        regressed = regressed or bool(worse)
+        rows.append([
+            result["corpus"], result["scenario"],
+            before["p50_ms"], result["p50_ms"], before["p95_ms"], result["p95_ms"],
+            before["throughput"], result["throughput"], ", ".join(worse) or "-",
+        ])
+    print(f"{old['commit'][:10]} -> {new['commit'][:10]}, regression threshold {threshold:.0%}")
+    print_table(
+        ["corpus", "scenario", "p50 ms", "now", "p95 ms", "now", "req/s", "now", "regressed"], rows
+    )
+    return regressed
+
+
+def _git(*args: str) -> str:
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["compare"]:
+        parser = argparse.ArgumentParser(prog="benchmarks.suite compare", description="Compare two saved runs")
+        parser.add_argument("old")
+        parser.add_argument("new")
+        parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown counted as a regression")
+        args = parser.parse_args(argv[1:])
+        with open(args.old) as old, open(args.new) as new:
+            return 1 if compare(json.load(old), json.load(new), args.threshold) else 0
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--corpus", action="append", choices=sorted(CORPORA), help="Corpus to run, repeatable (default: default)")
+    parser.add_argument("--notes", type=int, help="Run a custom corpus of this many notes instead")
+    parser.add_argument("--lines", type=int, default=20, help="Lines per note of the custom corpus")
+    parser.add_argument("--versions", type=int, default=5, help="Versions per note of the custom corpus")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--output", help="Where to save the JSON results (default: benchmarks/results/<commit>-<mode>.json)")
+    args = parser.parse_args(argv)
+
+    if args.notes is not None:
+        corpora = [Corpus("custom", args.notes, args.lines, args.versions)]
+    else:
+        corpora = [Corpus(name, *CORPORA[name]) for name in args.corpus or ["default"]]
+    report = run(corpora, args.mode, args.requests, args.concurrency, args.seed, args.port)
+
+    print_table(
+        ["corpus", "scenario", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"],
+        [
+            [r["corpus"], r["scenario"], r["requests"], r["errors"], r["throughput"], r["p50_ms"], r["p95_ms"], r["p99_ms"]]
+            for r in report["results"]
+        ]
+    )
+    failed = [f"{r['corpus']}/{r['scenario']}" for r in report["results"] if r["errors"]]
+    if failed:
+        print(f"Not saved, requests failed in: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['commit'][:10]}-{args.mode}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,339 @@
+"""
+In-process caches for computed responses.
+
+diff_cache keeps computed diffs in this process, and payload_cache the
+serialized and compressed responses that never change. note_cache keeps
+serialized note payloads in a pluggable backend: by default a local
+in-memory LRU, or Redis (NOTES_CACHE_URL=redis://...) so that every worker
+shares one cache.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+NOTE_CACHE_SIZE = int(os.environ.get("NOTES_NOTE_CACHE_SIZE", "1024"))
+NOTE_CACHE_TTL = float(os.environ.get("NOTES_NOTE_CACHE_TTL", "300"))
+NOTE_CACHE_URL = os.environ.get("NOTES_CACHE_URL")
+PAYLOAD_CACHE_SIZE = int(os.environ.get("NOTES_PAYLOAD_CACHE_SIZE", "512"))
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe least-recently-used cache.
+
+    Entries can be tagged (for example with a note id) so that everything
+    derived from the same object is dropped at once with invalidate(tag).
+    Each tag has a generation number: read it before computing a value and
+    pass it to set(), so a value computed from data that was modified in the
+    meantime is never stored.
+
+    With a ttl (in seconds), entries also expire that long after being set.
+    Hits, misses and evictions (including expirations) are counted.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._tags: Dict[Hashable, set] = {}
+        self._key_tags: Dict[Hashable, Hashable] = {}
+        self._generations: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= self._clock():
+                del self._entries[key]
+                self._untag(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Get a live entry without counting a hit or refreshing it"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] is not None and entry[0] <= self._clock()):
+                return None
+            return entry[1]
+
+    def generation(self, tag: Hashable) -> int:
+        with self._lock:
+            return self._generations.get(tag, 0)
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        tag: Hashable = None,
+        generation: Optional[int] = None,
+        ttl: Optional[float] = None
+    ) -> None:
+        with self._lock:
+            if generation is not None and generation != self._generations.get(tag, 0):
+                return  # Computed from stale data
+            ttl = ttl if ttl is not None else self.ttl
+            expires = self._clock() + ttl if ttl is not None else None
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+                self._key_tags[key] = tag
+            while len(self._entries) > self.max_entries:
+                oldest, _ = self._entries.popitem(last=False)
+                self._untag(oldest)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._untag(key)
+
+    def invalidate(self, tag: Hashable) -> None:
+        """Drop every entry with the given tag"""
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            for key in self._tags.pop(tag, ()):
+                self._entries.pop(key, None)
+                self._key_tags.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._key_tags.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _untag(self, key: Hashable) -> None:
+        tag = self._key_tags.pop(key, None)
+        if tag is not None:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class CacheBackend:
+    """
+    Storage behind NoteCache. Keys are strings and values bytes, so a backend
+    can live outside the process and be shared by several workers.
+    """
+
+    # Whether calls wait on I/O, and must be kept off the event loop
+    blocking = False
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """The values of several keys, None for those missing"""
+        return [self.get(key) for key in keys]
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    @property
+    def evictions(self) -> int:
+        """Entries dropped for lack of space or on expiry, if the backend knows"""
+        return 0
+
+
+class LocalCacheBackend(CacheBackend):
+    """Backend private to this process, also used as a stand-in in tests"""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None, **options):
+        self._cache = LRUCache(max_entries=max_entries, ttl=ttl, **options)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self._cache.set(key, value, ttl=ttl)
+
+    def delete(self, key: str) -> None:
+        self._cache.delete(key)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    @property
+    def evictions(self) -> int:
+        return self._cache.evictions
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Backend shared by every worker through Redis. Requires the redis package;
+    the server's own maxmemory policy bounds its size.
+    """
+
+    blocking = True
+
+    def __init__(self, url: str, prefix: str = "notes:"):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(self._prefix + key)
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self._client.mget([self._prefix + key for key in keys])
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self._client.set(self._prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key: str) -> None:
+        self._client.delete(self._prefix + key)
+
+    def clear(self) -> None:
+        keys = list(self._client.scan_iter(match=self._prefix + "*"))
+        if keys:
+            self._client.delete(*keys)
+
+
+class NoteCache:
+    """
+    Read-through cache of serialized note responses with their ETag, keyed by
+    note id. Writers call invalidate(note_id) after committing.
+
+    Generations are tracked in this process: a payload read before a local
+    invalidation is never stored. With a shared backend, a payload built by
+    one worker while another updates the note can outlive the update for at
+    most the TTL.
+
+    Calls to a blocking backend run in the thread pool, off the event loop,
+    and never under the lock, which only guards generations and counters.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: Optional[float] = None):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    async def _call(self, method: Callable[..., Any], *args, **kwargs) -> Any:
+        if self.backend.blocking:
+            return await run_in_threadpool(method, *args, **kwargs)
+        return method(*args, **kwargs)
+
+    async def get(self, note_id: int) -> Optional[Tuple[str, bytes]]:
+        value = await self._call(self.backend.get, f"note:{note_id}")
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        etag, _, payload = value.partition(b"\n")
+        return etag.decode(), payload
+
+    async def get_many(self, note_ids: List[int]) -> Dict[int, Tuple[str, bytes]]:
+        """The cached (ETag, payload) of several notes, in one backend round trip"""
+        values = await self._call(self.backend.get_many, [f"note:{note_id}" for note_id in note_ids])
+        found = {}
+        for note_id, value in zip(note_ids, values):
+            if value is not None:
+                etag, _, payload = value.partition(b"\n")
+                found[note_id] = (etag.decode(), payload)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(note_ids) - len(found)
+        return found
+
+    def generation(self, note_id: int) -> int:
+        with self._lock:
+            return self._generations.get(note_id, 0)
+
+    async def set(self, note_id: int, etag: str, payload: bytes, generation: Optional[int] = None) -> None:
+        if generation is None:
+            generation = self.generation(note_id)
+        elif generation != self.generation(note_id):
+            return  # Built from a note that changed since
+        key = f"note:{note_id}"
+        await self._call(self.backend.set, key, etag.encode() + b"\n" + payload, ttl=self.ttl)
+        if generation != self.generation(note_id):
+            # Invalidated while being stored, the invalidation's delete may have come first
+            await self._call(self.backend.delete, key)
+
+    async def invalidate(self, note_id: int) -> None:
+        await self._call(self.invalidate_blocking, note_id)
+
+    def invalidate_blocking(self, note_id: int) -> None:
+        """invalidate() for callers off the event loop, such as the compaction thread"""
+        with self._lock:
+            self._generations[note_id] = self._generations.get(note_id, 0) + 1
+        self.backend.delete(f"note:{note_id}")
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.backend.evictions}
+
+
+def _note_cache_backend() -> CacheBackend:
+    if NOTE_CACHE_URL:
+        return RedisCacheBackend(NOTE_CACHE_URL)
+    return LocalCacheBackend(max_entries=NOTE_CACHE_SIZE)
+
+
+# (ETag, Cache-Control, diff, ids of the versions compared) keyed by (note id,
+# version id, compare target), tagged with the note id
+diff_cache = LRUCache(max_entries=512)
+
+# Line alignments (matching blocks) between versions, keyed by (old version id,
+# new version id) and tagged with the note id; see alignments.py. Versions
+# never change, so only deleting the note invalidates them.
+alignment_cache = LRUCache(max_entries=4096)
+
+# Responses that never change (settled versions, diffs between settled
+# versions) as compression.Payload objects, serialized and compressed once,
+# along with the ids of the versions they were built from; tagged with the
+# note id, as only deleting versions invalidates them. Hits are checked
+# against the database, as compaction may run in another process.
+payload_cache = LRUCache(max_entries=PAYLOAD_CACHE_SIZE)
+
+# Serialized GET /notes/{id} responses
+note_cache = NoteCache(_note_cache_backend(), ttl=NOTE_CACHE_TTL or None)
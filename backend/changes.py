@@ -0,0 +1,235 @@
+"""
+Live feed of note changes.
+
+Every committed change to a note leaves an event in note_events, written by
+triggers in the same transaction (see database.py): the note, its head
+version after the change (none once deleted), its updated_at and a kind
+(created, updated or deleted). Event ids only grow, so the id of the last
+event a client saw is a cursor it can resume from.
+
+A ChangeFeed fans the events out to the subscribers of this process. It keeps
+the latest CHANGE_FEED_BUFFER events in memory: once a write has committed,
+its request reads the events past the last one known, with one indexed query
+however many subscribers there are, and wakes the subscribers with a single
+callback per event loop. A subscriber first catches up from the table, then
+follows the buffer; while it waits, it holds no database connection.
+
+Writes of other processes (more API workers, command line imports) are only
+seen by polling the table, every NOTES_CHANGE_FEED_POLL seconds when set.
+"""
+import asyncio
+import bisect
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import DBNoteEvent
+from serialization import change_dict
+
+# Events kept in memory for the subscribers following the feed
+CHANGE_FEED_BUFFER = int(os.environ.get("NOTES_CHANGE_FEED_BUFFER", "4096"))
+# Seconds between reads of the events written by other processes, 0 switches them off
+CHANGE_FEED_POLL = float(os.environ.get("NOTES_CHANGE_FEED_POLL", "0"))
+# Seconds between keepalives on an idle event stream
+CHANGE_FEED_HEARTBEAT = float(os.environ.get("NOTES_CHANGE_FEED_HEARTBEAT", "15"))
+
+# Most events read from the table per query, and sent per batch
+CHANGE_FEED_PAGE = 500
+
+EVENT_COLUMNS = (
+    DBNoteEvent.id, DBNoteEvent.note_id, DBNoteEvent.version_id, DBNoteEvent.kind, DBNoteEvent.updated_at
+)
+
+Batch = Tuple[List[dict], int, bool]
+
+
+async def latest_cursor(db: AsyncSession) -> int:
+    """The id of the latest event, 0 before the first one"""
+    return (await db.execute(select(func.coalesce(func.max(DBNoteEvent.id), 0)))).scalar()
+
+
+async def read_changes(db: AsyncSession, cursor: int, limit: int = CHANGE_FEED_PAGE) -> Tuple[List[dict], bool]:
+    """
+    Up to limit events after a cursor, from the table; and whether some
+    events right after the cursor were deleted since, as only the latest
+    CHANGE_EVENTS_KEPT are kept.
+    """
+    rows = (await db.execute(
+        select(*EVENT_COLUMNS).where(DBNoteEvent.id > cursor).order_by(DBNoteEvent.id).limit(limit)
+    )).all()
+    if not rows or rows[0].id == cursor + 1:
+        return [change_dict(row) for row in rows], False
+    # Past a gap, the cursor is lost if no event up to it is left either
+    oldest = (await db.execute(select(func.min(DBNoteEvent.id)))).scalar()
+    if oldest == rows[0].id:
+        return [], True
+    return [change_dict(row) for row in rows], False
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class ChangeFeed:
+    """
+    The latest events, and the subscribers waiting for more. Subscribers
+    may wait on any event loop, and writes may publish from any thread.
+    """
+
+    def __init__(self, buffer_size: int = CHANGE_FEED_BUFFER, poll: float = CHANGE_FEED_POLL):
+        self.buffer_size = buffer_size
+        self.poll = poll
+        self.subscribers = 0
+        self.reads = 0  # Reads of new events, by writes and polls
+        self._ids: List[int] = []
+        self._events: List[dict] = []
+        # Every event after this id is buffered, None until known
+        self._floor: Optional[int] = None
+        self._last_id = 0
+        self._read_at = 0.0
+        self._lock = threading.Lock()
+        self._polling = threading.Lock()
+        # A future per event loop with waiting subscribers, set by the next publish
+        self._wakeups: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Future]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @contextmanager
+    def subscribe(self) -> Iterator[None]:
+        """Count a subscriber, so that writes read their events for it"""
+        with self._lock:
+            self.subscribers += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.subscribers -= 1
+
+    async def committed(self, db: AsyncSession) -> None:
+        """After a write commits: publish its events if anyone follows the feed"""
+        if self.subscribers:
+            await self.refresh(db)
+
+    async def refresh(self, db: AsyncSession) -> None:
+        """Read and publish the events committed since the last read"""
+        last_id = self._last_id
+        rows = (await db.execute(
+            select(*EVENT_COLUMNS).where(DBNoteEvent.id > last_id)
+            .order_by(DBNoteEvent.id.desc()).limit(self.buffer_size)
+        )).all()
+        self.publish([change_dict(row) for row in reversed(rows)], last_id, complete=len(rows) < self.buffer_size)
+
+    def publish(self, events: List[dict], after: int, complete: bool) -> None:
+        """
+        Buffer the events read after an id, oldest first (complete when they
+        are all the events after it), and wake the waiting subscribers.
+        """
+        with self._lock:
+            self.reads += 1
+            self._read_at = time.monotonic()
+            events = [event for event in events if event["id"] > self._last_id]
+            if not events:
+                if complete and self._floor is None:
+                    self._floor = after
+                return
+            if not complete or self._floor is None:
+                # Events before these may be missing from the buffer
+                self._ids, self._events = [], []
+                self._floor = after if complete else events[0]["id"] - 1
+            self._ids.extend(event["id"] for event in events)
+            self._events.extend(events)
+            self._last_id = events[-1]["id"]
+            excess = len(self._ids) - self.buffer_size
+            if excess >= self.buffer_size:  # Trimmed in bulk, not on every publish
+                self._floor = self._ids[excess - 1]
+                del self._ids[:excess], self._events[:excess]
+            wakeups = list(self._wakeups.items())
+            self._wakeups.clear()
+        for loop, future in wakeups:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # The loop was closed
+
+    def after(self, cursor: int, limit: int = CHANGE_FEED_PAGE) -> Optional[List[dict]]:
+        """The buffered events after a cursor, None if some may not be buffered"""
+        with self._lock:
+            if self._floor is None or cursor < self._floor:
+                return None
+            start = bisect.bisect_right(self._ids, cursor)
+            return self._events[start:start + limit]
+
+    async def wait(self, cursor: int, timeout: float) -> bool:
+        """Wait until events after a cursor are published, False after timeout seconds"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._last_id > cursor:
+                return True
+            future = self._wakeups.get(loop)
+            if future is None:
+                future = self._wakeups[loop] = loop.create_future()
+        done, _ = await asyncio.wait((future,), timeout=timeout)
+        return bool(done)
+
+    async def poll_table(self, db: AsyncSession) -> None:
+        """Read the events of other processes, once per poll interval across subscribers"""
+        if not self._polling.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._read_at >= self.poll:
+                await self.refresh(db)
+                await db.rollback()
+        finally:
+            self._polling.release()
+
+    async def follow(
+        self, db: AsyncSession, cursor: int, heartbeat: float, limit: int = CHANGE_FEED_PAGE
+    ) -> AsyncIterator[Batch]:
+        """
+        Follow the feed from a cursor. Yields (events, cursor, reset): the next
+        events as they are committed, up to limit at a time, and the cursor
+        after them; no events after heartbeat seconds without any; or reset
+        when the cursor is older than the events kept, with the cursor of the
+        latest event.
+        """
+        with self.subscribe():
+            # Events committed before subscribing were not published for it
+            events, reset = await read_changes(db, cursor, limit)
+            from_table = True
+            idle_since = time.monotonic()
+            while True:
+                if reset:
+                    cursor = await latest_cursor(db)
+                    yield [], cursor, True
+                    idle_since = time.monotonic()
+                elif events:
+                    cursor = events[-1]["id"]
+                    yield events, cursor, False
+                    idle_since = time.monotonic()
+
+                if len(events) < limit:
+                    # Caught up, wait for more
+                    if from_table:
+                        await db.rollback()  # Hold no connection while waiting
+                        from_table = False
+                    timeout = idle_since + heartbeat - time.monotonic()
+                    if self.poll:
+                        timeout = min(timeout, self.poll)
+                    if not await self.wait(cursor, max(timeout, 0)):
+                        if self.poll:
+                            await self.poll_table(db)
+                        if time.monotonic() - idle_since >= heartbeat:
+                            yield [], cursor, False
+                            idle_since = time.monotonic()
+
+                events, reset = (None, False) if from_table else (self.after(cursor, limit), False)
+                if events is None:
+                    events, reset = await read_changes(db, cursor, limit)
+                    from_table = True
@@ -0,0 +1,232 @@
+"""
+Negotiated compression of responses.
+
+CompressionMiddleware compresses JSON, NDJSON and text responses of at least
+NOTES_COMPRESSION_MIN_SIZE bytes with the best encoding the client accepts
+among NOTES_COMPRESSION: zstd and br when the zstandard and brotli packages
+are installed, gzip always. Streamed responses are compressed chunk by chunk
+and flushed after each one; event streams are left alone.
+
+A compressed response is a different representation, so its ETag gets the
+encoding as a suffix ("note-1-3" becomes "note-1-3-gzip"). The suffix is
+removed from If-None-Match and If-Match before the request reaches the
+application, which only knows the plain ETags.
+
+Payloads that never change (settled versions, diffs between settled
+versions) are kept serialized in a Payload, which also keeps each encoding
+once it has been compressed, at a higher level as that only happens once.
+"""
+import gzip
+import os
+import re
+import zlib
+from typing import Dict, List, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+
+try:
+    import zstandard
+except ImportError:  # Optional, see README.md
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # Optional, see README.md
+    brotli = None
+
+# Encodings in order of preference, among those available; empty switches compression off
+COMPRESSION = os.environ.get("NOTES_COMPRESSION", "zstd,br,gzip")
+# Smallest response body compressed, in bytes
+COMPRESSION_MIN_SIZE = int(os.environ.get("NOTES_COMPRESSION_MIN_SIZE", "1024"))
+
+AVAILABLE = {"gzip": True, "br": brotli is not None, "zstd": zstandard is not None}
+ENCODINGS = [name for name in (e.strip() for e in COMPRESSION.split(",")) if AVAILABLE.get(name)]
+
+# Levels for responses compressed as they are sent, and for payloads compressed once
+LEVELS = {"gzip": 6, "br": 4, "zstd": 3}
+STORED_LEVELS = {"gzip": 9, "br": 9, "zstd": 12}
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+_ENCODED_ETAG = re.compile(r'-(gzip|br|zstd)"')
+
+
+def negotiate(accept_encoding: Optional[str], encodings: List[str] = ENCODINGS) -> Optional[str]:
+    """The preferred encoding the client accepts, None for the identity"""
+    if not accept_encoding or not encodings:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class _StreamCompressor:
+    """Compresses a body chunk by chunk, each flushed so the client gets it at once"""
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == "gzip":
+            return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """The ETag of a representation compressed with an encoding"""
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def _compressible(status: int, headers: Headers) -> bool:
+    content_type = headers.get("content-type", "")
+    return (
+        status == 200
+        and "content-encoding" not in headers
+        and content_type.startswith(COMPRESSIBLE_TYPES)
+        and not content_type.startswith("text/event-stream")
+    )
+
+
+class Payload:
+    """
+    A serialized JSON response that never changes, with its validators, and
+    the encodings it has been sent in so far.
+    """
+
+    def __init__(self, body: bytes, etag: str, cache_control: str):
+        self.body = body
+        self.etag = etag
+        self.cache_control = cache_control
+        self._encoded: Dict[str, bytes] = {}
+
+    async def response(self, accept_encoding: Optional[str]) -> Response:
+        """The payload in the encoding the client prefers, compressed on first use"""
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        encoding = negotiate(accept_encoding) if len(self.body) >= COMPRESSION_MIN_SIZE else None
+        if encoding is None:
+            return Response(content=self.body, media_type="application/json", headers=headers)
+        encoded = self._encoded.get(encoding)
+        if encoded is None:
+            encoded = await run_in_threadpool(compress, self.body, encoding, STORED_LEVELS[encoding])
+            self._encoded[encoding] = encoded
+        headers["ETag"] = encoded_etag(self.etag, encoding)
+        headers["Content-Encoding"] = encoding
+        return Response(content=encoded, media_type="application/json", headers=headers)
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses in the encoding the client prefers"""
+
+    def __init__(self, app, min_size: int = COMPRESSION_MIN_SIZE, encodings: List[str] = ENCODINGS):
+        self.app = app
+        self.min_size = min_size
+        self.encodings = encodings
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.encodings:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"), self.encodings)
+        scope, validated = _strip_encoded_etags(scope)
+        start = None
+        stream: Optional[_StreamCompressor] = None
+
+        async def send_compressed(message):
+            nonlocal start, stream
+            if message["type"] == "http.response.start":
+                start = message  # Sent along with the first chunk of the body
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is None:
+                if stream is not None:
+                    body = stream.chunk(body) + (b"" if more_body else stream.finish())
+                    message = {"type": "http.response.body", "body": body, "more_body": more_body}
+                await send(message)
+                return
+
+            response_start, start = start, None
+            headers = MutableHeaders(raw=response_start["headers"])
+            if response_start["status"] == 304:
+                # Name the representation the client validated
+                if encoding in validated and "etag" in headers:
+                    headers["ETag"] = encoded_etag(headers["etag"], encoding)
+            elif _compressible(response_start["status"], headers):
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+                if encoding is not None and (more_body or len(body) >= self.min_size):
+                    headers["Content-Encoding"] = encoding
+                    if "etag" in headers:
+                        headers["ETag"] = encoded_etag(headers["etag"], encoding)
+                    if more_body:
+                        del headers["Content-Length"]
+                        stream = _StreamCompressor(encoding, LEVELS[encoding])
+                        body = stream.chunk(body)
+                    else:
+                        body = compress(body, encoding, LEVELS[encoding])
+                        headers["Content-Length"] = str(len(body))
+            await send(response_start)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def _strip_encoded_etags(scope):
+    """
+    The scope with encoding suffixes removed from the ETags of If-None-Match
+    and If-Match, and the encodings those ETags named.
+    """
+    found = set()
+    headers = []
+    for name, value in scope["headers"]:
+        if name in (b"if-none-match", b"if-match"):
+            text = value.decode("latin-1")
+            found.update(_ENCODED_ETAG.findall(text))
+            value = _ENCODED_ETAG.sub('"', text).encode("latin-1")
+        headers.append((name, value))
+    if not found:
+        return scope, found
+    return dict(scope, headers=headers), found
@@ -1,44 +1,254 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, create_engine
-from sqlalchemy.orm import relationship, declarative_base, sessionmaker
+from sqlalchemy import DDL, Column, Integer, String, Text, DateTime, ForeignKey, Index, create_engine, event, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import deferred, relationship, declarative_base, sessionmaker
 import datetime
+import os
+from typing import Dict, Optional
 
 Base = declarative_base()
 
 class DBNote(Base):
     __tablename__ = "notes"
 
+    # Never reused (AUTOINCREMENT), as URLs and ETags are built from ids
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+    # Row version, incremented by every write; writes are conditional on it
+    revision = Column(Integer, nullable=False, default=1)
     
     # Add relationship to versions
-    versions = relationship("DBNoteVersion", back_populates="note", cascade="all, delete-orphan")
+    versions = relationship(
+        "DBNoteVersion",
+        back_populates="note",
+        cascade="all, delete-orphan",
+        order_by="DBNoteVersion.version_number"
+    )
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+class DBVersionBlob(Base):
+    """A full version body, stored once for every version (of any note) that has it"""
+    __tablename__ = "version_blobs"
+
+    hash = Column(String, primary_key=True)  # SHA-256 of the content, in hex
+    content = Column(Text, nullable=False)
+    # Versions pointing at the blob, counted by triggers on note_versions
+    refcount = Column(Integer, nullable=False, default=0)
 
 class DBNoteVersion(Base):
     __tablename__ = "note_versions"
 
+    # Never reused (AUTOINCREMENT): settled versions are served as immutable by id
     id = Column(Integer, primary_key=True, index=True)
     note_id = Column(Integer, ForeignKey("notes.id", ondelete="CASCADE"))
     title = Column(String, nullable=False)
-    content = Column(String, nullable=False)
+    # SHA-256 of the full content, however the version is stored. Versions
+    # that are not deltas point at the version_blobs row with this hash.
+    content_hash = Column(String, nullable=True)
+    # Delta against base_id, NULL when the version points at a blob.
+    # Use storage.load_contents() to read version bodies. Bodies are deferred:
+    # loading a version only reads them with the undefer_group("body") option.
+    delta = deferred(Column(Text, nullable=True), group="body")
+    base_id = Column(Integer, ForeignKey("note_versions.id"), nullable=True)
+    chain_length = Column(Integer, nullable=False, default=0)
+    # Per-note sequence: 1 for the first version, then +1 per version. Numbers
+    # of versions pruned by retention.py are not reused, so it may have gaps.
+    version_number = Column(Integer, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Length of the full content in characters, however it is stored
+    size = Column(Integer, nullable=False, default=0)
+    # Editor session (X-Edit-Session) that wrote the version, and the number
+    # of its edits coalesced into it while it was the head (see AUTOSAVE_WINDOW)
+    edit_session = Column(String, nullable=True)
+    edits = Column(Integer, nullable=False, default=1)
     
     # Add relationship back to note
     note = relationship("DBNote", back_populates="versions")
 
+    # History queries filter on the note and order by creation time or id
+    __table_args__ = (
+        Index("ix_note_versions_note_id_created_at", "note_id", "created_at"),
+        Index("ix_note_versions_note_id_id", "note_id", "id"),
+        Index("ix_note_versions_note_id_version_number", "note_id", "version_number", unique=True),
+        {"sqlite_autoincrement": True},
+    )
+
+class DBNoteEvent(Base):
+    """A committed change to a note, written by triggers (see NOTE_EVENTS_DDL)"""
+    __tablename__ = "note_events"
+
+    # Only grows (AUTOINCREMENT never reuses ids), clients resume from it
+    id = Column(Integer, primary_key=True)
+    # No foreign key: the events of a note outlive it
+    note_id = Column(Integer, nullable=False)
+    # The note's head version after the change, NULL when it was deleted
+    version_id = Column(Integer, nullable=True)
+    kind = Column(String, nullable=False)  # created, updated or deleted
+    updated_at = Column(DateTime, nullable=False)
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+# Full content of the versions that are not deltas, read from their blob
+# (NULL for deltas); part of the deferred "body" group like delta
+DBNoteVersion.content = deferred(
+    select(DBVersionBlob.content).where(
+        DBVersionBlob.hash == DBNoteVersion.content_hash, DBNoteVersion.delta.is_(None)
+    ).scalar_subquery().label("content"),
+    group="body"
+)
+
+# Reference counts of version blobs, kept by triggers so that every write
+# path (including bulk inserts and deletes) maintains them. A blob must be
+# written before the versions that point at it, and goes with the last one.
+VERSION_BLOBS_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS version_blobs_insert AFTER INSERT ON note_versions "
+    "WHEN new.delta IS NULL BEGIN "
+    "UPDATE version_blobs SET refcount = refcount + 1 WHERE hash = new.content_hash; END",
+    "CREATE TRIGGER IF NOT EXISTS version_blobs_delete AFTER DELETE ON note_versions "
+    "WHEN old.delta IS NULL BEGIN "
+    "UPDATE version_blobs SET refcount = refcount - 1 WHERE hash = old.content_hash; "
+    "DELETE FROM version_blobs WHERE hash = old.content_hash AND refcount <= 0; END",
+    "CREATE TRIGGER IF NOT EXISTS version_blobs_update AFTER UPDATE OF delta, content_hash ON note_versions "
+    "BEGIN "
+    "UPDATE version_blobs SET refcount = refcount + 1 WHERE new.delta IS NULL AND hash = new.content_hash; "
+    "UPDATE version_blobs SET refcount = refcount - 1 WHERE old.delta IS NULL AND hash = old.content_hash; "
+    "DELETE FROM version_blobs WHERE old.delta IS NULL AND hash = old.content_hash AND refcount <= 0; END",
+]
+# Only with note_versions itself: an older table lacks the columns they read
+for statement in VERSION_BLOBS_DDL:
+    event.listen(DBNoteVersion.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+# Full-text index of note titles and contents: an FTS5 table that reads its
+# text from notes, kept in sync by triggers so every write path (including
+# bulk inserts and deletes) updates it
+NOTES_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5("
+    "title, content, content='notes', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN "
+    "INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN "
+    "INSERT INTO notes_fts(notes_fts, rowid, title, content) "
+    "VALUES ('delete', old.id, old.title, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content ON notes BEGIN "
+    "INSERT INTO notes_fts(notes_fts, rowid, title, content) "
+    "VALUES ('delete', old.id, old.title, old.content); "
+    "INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+]
+for statement in NOTES_FTS_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+# Change events, kept by triggers so that every write path (including bulk
+# inserts, imports and coalesced autosaves) records them in its own
+# transaction. A new or reverted version is an update (a creation for the
+# first version of a note), and so is an edit coalesced into the head version.
+# Only the latest CHANGE_EVENTS_KEPT events are kept, older ones are deleted
+# every 1024 events.
+CHANGE_EVENTS_KEPT = 100000
+NOTE_EVENTS_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS note_events_version_insert AFTER INSERT ON note_versions BEGIN "
+    "INSERT INTO note_events(note_id, version_id, kind, updated_at) VALUES (new.note_id, new.id, "
+    "CASE WHEN new.version_number = 1 THEN 'created' ELSE 'updated' END, "
+    "(SELECT updated_at FROM notes WHERE id = new.note_id)); END",
+    "CREATE TRIGGER IF NOT EXISTS note_events_version_edit AFTER UPDATE OF edits ON note_versions "
+    "WHEN new.edits > old.edits BEGIN "
+    "INSERT INTO note_events(note_id, version_id, kind, updated_at) VALUES (new.note_id, new.id, 'updated', "
+    "(SELECT updated_at FROM notes WHERE id = new.note_id)); END",
+    "CREATE TRIGGER IF NOT EXISTS note_events_note_delete AFTER DELETE ON notes BEGIN "
+    "INSERT INTO note_events(note_id, version_id, kind, updated_at) "
+    "VALUES (old.id, NULL, 'deleted', strftime('%Y-%m-%d %H:%M:%f', 'now')); END",
+    "CREATE TRIGGER IF NOT EXISTS note_events_trim AFTER INSERT ON note_events "
+    f"WHEN new.id % 1024 = 0 BEGIN DELETE FROM note_events WHERE id <= new.id - {CHANGE_EVENTS_KEPT}; END",
+]
+# Like VERSION_BLOBS_DDL, only with the tables they are on. DDL() formats its
+# statement with %, text() in migrations does not.
+for statement in NOTE_EVENTS_DDL:
+    table = DBNoteEvent.__table__ if " ON note_events " in statement else DBNoteVersion.__table__
+    event.listen(table, "after_create", DDL(statement.replace("%", "%%")).execute_if(dialect="sqlite"))
+
 # Database connection
-SQLALCHEMY_DATABASE_URL = "sqlite:///./notes.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+SQLALCHEMY_DATABASE_URL = os.environ.get("NOTES_DATABASE_URL", "sqlite:///./notes.db")
+ASYNC_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+# SQLite tuning profiles, applied as pragmas on every new connection.
+# "tuned" lets readers proceed while a writer commits (WAL), only fsyncs at
+# checkpoints (synchronous=NORMAL, still safe in WAL mode), maps the file in
+# memory, enlarges the page cache and waits for locks instead of failing.
+# New databases are created with auto_vacuum=INCREMENTAL, so the pages freed
+# by pruning history can be handed back to the filesystem (see retention.py).
+# "default" leaves SQLite's own settings, for comparison.
+SQLITE_PROFILES = {
+    "default": {},
+    "tuned": {
+        "auto_vacuum": "INCREMENTAL",  # Only takes effect on new databases, see retention.py
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,  # 256 MiB
+        "cache_size": -65536,  # 64 MiB, negative values are in KiB
+        "busy_timeout": 5000,  # ms
+        "temp_store": "MEMORY",
+    },
+}
+SQLITE_PROFILE = os.environ.get("NOTES_SQLITE_PROFILE", "tuned")
+
+
+def sqlite_pragmas(profile: Optional[str] = None) -> Dict[str, object]:
+    """
+    Pragmas for a profile. Each one can be overridden with an environment
+    variable, e.g. NOTES_SQLITE_BUSY_TIMEOUT=10000.
+    """
+    pragmas = dict(SQLITE_PROFILES[profile or SQLITE_PROFILE])
+    for name in SQLITE_PROFILES["tuned"]:
+        override = os.environ.get(f"NOTES_SQLITE_{name.upper()}")
+        if override is not None:
+            pragmas[name] = override
+    return pragmas
+
+
+def configure_sqlite(bind, pragmas: Optional[Dict[str, object]] = None) -> None:
+    """Apply pragmas to every connection the engine opens"""
+    pragmas = sqlite_pragmas() if pragmas is None else pragmas
+
+    @event.listens_for(bind, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+
+def pool_options(url: str) -> Dict[str, int]:
+    """Connection pool sizing for the deployment, from the environment"""
+    if ":memory:" in url:
+        return {}  # In-memory databases use a single shared connection
+    return {
+        "pool_size": int(os.environ.get("NOTES_DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.environ.get("NOTES_DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": int(os.environ.get("NOTES_DB_POOL_TIMEOUT", "30")),
+    }
+
+
+# Blocking engine, used for migrations and command line tools
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    **pool_options(SQLALCHEMY_DATABASE_URL)
+)
+configure_sqlite(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def get_db():
-    db = SessionLocal()
-    try:
+# Async engine, used by the API so requests never block the event loop
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL))
+configure_sqlite(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def create_tables():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+def create_tables(bind=None):
+    """Create missing tables and bring an existing database up to date"""
+    from migrations import run_migrations
+    run_migrations(bind or engine)
@@ -1,16 +1,86 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy import DateTime, delete, func, insert, select, text, tuple_, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, undefer_group
+from contextlib import aclosing
+import asyncio
 import datetime
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Tuple
 
-from database import get_db, create_tables, DBNote, DBNoteVersion
-from models import Note, NoteCreate, NoteUpdate, NoteVersion, NoteDiff
-from utils import compare_versions
-from sqlalchemy.orm import joinedload
+from alignments import align, align_pairs, line_alignment, missing_leaves
+from cache import alignment_cache, diff_cache, note_cache, payload_cache
+from compression import CompressionMiddleware, Payload
+from changes import CHANGE_FEED_HEARTBEAT, CHANGE_FEED_PAGE, ChangeFeed, latest_cursor
+from database import SQLALCHEMY_DATABASE_URL, SessionLocal, engine, get_db, create_tables, DBNote, DBNoteVersion
+from models import (
+    Note, NoteCreate, NoteDetail, NoteUpdate, NoteVersion, NoteDiff,
+    NotePage, NoteBatchCreate, NoteBatchResult, NoteChangePage,
+    BatchGet, NoteBatchGetResult, VersionBatchGetResult,
+    NoteSearchPage, NoteSearchResult, NoteImportResult, NoteHunkDiff,
+    ProfilerReport, ProfilerSettings, SlowRequest
+)
+from observability import (
+    PROFILE_RUNTIME, InstrumentedRoute, MetricsMiddleware, configure_logging, instrument_sql, logger, profiler,
+    render_metrics, serializing
+)
+from retention import RETENTION_INTERVAL, RetentionPolicy, start_compaction
+from serialization import (
+    JSONResponse, dumps, note_dict, summary_dict, version_dict, version_header_dict, version_summary_dict
+)
+from storage import (
+    add_version, build_version, coalesces, content_hash, encode_rewrite, latest_version, load_content,
+    load_contents, rewrite_version, save_blobs, settled
+)
+from transfer import IMPORT_BATCH_SIZE, begin_snapshot, export_chunk, import_batch, parse_note
+from utils import (
+    compare_versions, diff_hunks, encode_cursor, decode_cursor, fts_query, hunk_ranges, matching_blocks
+)
+from writer import GROUP_COMMIT, GroupCommitWriter, immediate_engine
+
+# Listing limits
+MAX_PAGE_SIZE = 200
+EXCERPT_LENGTH = 200
+
+# Most context lines around changes in a hunk diff
+MAX_DIFF_CONTEXT = 1000
+
+# Alignments of consecutive versions computed by one range diff request
+ALIGNMENTS_PER_REQUEST = 16
+
+# Search ranking: title matches weigh this much more than content matches
+SEARCH_TITLE_WEIGHT = 5.0
+SNIPPET_TOKENS = 16
+
+# Version columns read to respond with whole versions, as plain rows rather
+# than ORM objects; delta and base_id let load_contents() rebuild their content
+VERSION_ROW = (
+    DBNoteVersion.id, DBNoteVersion.note_id, DBNoteVersion.version_number, DBNoteVersion.title,
+    DBNoteVersion.created_at, DBNoteVersion.content, DBNoteVersion.delta, DBNoteVersion.base_id
+)
+
+# Version columns of a version header, which leaves the body out
+VERSION_HEADER = (
+    DBNoteVersion.id, DBNoteVersion.note_id, DBNoteVersion.version_number, DBNoteVersion.title,
+    DBNoteVersion.created_at, DBNoteVersion.size
+)
+
+# Longest wait for changes, in seconds, of a request to /notes:changes
+MAX_CHANGES_WAIT = 60
+
+# Cache-Control for responses that never change, and for those clients must revalidate
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+configure_logging()
+instrument_sql()
 
 # Initialize the FastAPI application
 app = FastAPI(title="Versioned Notes API")
+app.router.route_class = InstrumentedRoute
 
 # Configure CORS to allow requests from the frontend
 app.add_middleware(
@@ -21,52 +91,453 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"]
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 # Create tables at application startup
 create_tables()
 
 
+async def _invalidate_caches(note_id: int) -> None:
+    """Drop everything cached about a note after its history changed"""
+    diff_cache.invalidate(note_id)
+    await note_cache.invalidate(note_id)
+    alignment_cache.invalidate(note_id)
+    payload_cache.invalidate(note_id)
+
+
+def _invalidate_caches_blocking(note_id: int) -> None:
+    """_invalidate_caches() for threads off the event loop"""
+    diff_cache.invalidate(note_id)
+    note_cache.invalidate_blocking(note_id)
+    alignment_cache.invalidate(note_id)
+    payload_cache.invalidate(note_id)
+
+
+# Prune version histories in the background when a retention policy is set
+if RETENTION_INTERVAL > 0:
+    start_compaction(
+        SessionLocal, engine, RetentionPolicy.from_env(), RETENTION_INTERVAL, _invalidate_caches_blocking
+    )
+
+
+# Note writes are committed in groups by a single writer thread when enabled
+group_writer = GroupCommitWriter(immediate_engine(SQLALCHEMY_DATABASE_URL)) if GROUP_COMMIT else None
+
+# Committed changes are pushed to the clients following /notes:changes
+change_feed = ChangeFeed()
+
+
+def _etag(*parts) -> str:
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+
+def _note_etag(note: DBNote, embed: Optional[str] = None) -> str:
+    """ETag of a note, which changes with its revision"""
+    return _etag("note", note.id, note.revision, *([embed] if embed is not None else []))
+
+
+def _version_cache_control(version) -> str:
+    """Versions never change once settled, until then they must be revalidated"""
+    settled_now = settled(version, datetime.datetime.utcnow())
+    return IMMUTABLE_CACHE_CONTROL if settled_now else REVALIDATE_CACHE_CONTROL
+
+
+def _if_match_revision(request: Request, note_id: int) -> Optional[int]:
+    """
+    The revision a write is conditional on, named by an ETag of the note in
+    If-Match. None without the header, or with If-Match: *.
+    """
+    if_match = request.headers.get("if-match")
+    if if_match is None or if_match.strip() == "*":
+        return None
+    # Only strong ETags of this note match, in any representation
+    for tag in if_match.split(","):
+        parts = tag.strip().strip('"').split("-")
+        if len(parts) >= 3 and parts[:2] == ["note", str(note_id)] and parts[2].isdigit():
+            return int(parts[2])
+    raise HTTPException(status_code=409, detail="If-Match does not name a revision of this note")
+
+
+def _conditional(request: Request, response: Response, etag: str, cache_control: str) -> Optional[Response]:
+    """
+    Set the validators of a response. Returns a 304 response to send instead
+    when the client's If-None-Match already names the current representation.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags):
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED,
+                headers={"ETag": etag, "Cache-Control": cache_control}
+            )
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
+    return None
+
+
+def _cached_response(payload: bytes, etag: str, cache_control: str) -> Response:
+    """Send an already serialized JSON payload with its validators"""
+    return Response(
+        content=payload,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": cache_control}
+    )
+
+
+async def _versions_exist(db: AsyncSession, note_id: int, version_ids: Tuple[int, ...]) -> bool:
+    """
+    Whether the versions a cached response was built from are all still
+    there. Compaction only deletes versions, and when retention.py runs it
+    from another process, the caches of this one are not invalidated.
+    """
+    found = (await db.execute(
+        select(func.count()).select_from(DBNoteVersion).where(
+            DBNoteVersion.note_id == note_id,
+            DBNoteVersion.id.in_(version_ids)
+        )
+    )).scalar()
+    return found == len(version_ids)
+
+
+async def _immutable_response(
+    request: Request,
+    key: tuple,
+    note_id: int,
+    versions: Tuple[int, ...],
+    generation: int,
+    body,
+    etag: str,
+    cache_control: str
+) -> Response:
+    """
+    Respond with a payload built from some versions of a note, keeping it
+    serialized and compressed in the payload cache if it can never change
+    """
+    if cache_control != IMMUTABLE_CACHE_CONTROL:
+        return JSONResponse(body, headers={"ETag": etag, "Cache-Control": cache_control})
+    with serializing():
+        payload = Payload(dumps(body), etag, cache_control)
+    payload_cache.set(key, (versions, payload), tag=note_id, generation=generation)
+    return await payload.response(request.headers.get("accept-encoding"))
+
+
+async def _cached_payload_response(
+    db: AsyncSession, request: Request, response: Response, note_id: int, key: tuple
+) -> Optional[Response]:
+    """
+    The response for an unchanging payload of the payload cache, None if not
+    cached or if its versions were deleted since
+    """
+    cached = payload_cache.get(key)
+    if cached is None:
+        return None
+    versions, payload = cached
+    if not await _versions_exist(db, note_id, versions):
+        await _invalidate_caches(note_id)
+        return None
+    return (
+        _conditional(request, response, payload.etag, payload.cache_control)
+        or await payload.response(request.headers.get("accept-encoding"))
+    )
+
+
+def _batch_error(item_id: int, detail: str) -> dict:
+    """A BatchGetError for an id a batch get did not find"""
+    return {"id": item_id, "status": 404, "detail": detail}
+
+
+async def _get_note_or_404(db: AsyncSession, note_id: int) -> DBNote:
+    note = await db.get(DBNote, note_id)
+    if note is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    return note
+
+
+async def _get_version_or_404(db: AsyncSession, note_id: int, version_id: int) -> DBNoteVersion:
+    version = (await db.execute(
+        select(DBNoteVersion).options(undefer_group("body")).where(
+            DBNoteVersion.note_id == note_id,
+            DBNoteVersion.id == version_id
+        )
+    )).scalar_one_or_none()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Version not found")
+    return version
+
+
+async def _note_payload(db: AsyncSession, note: DBNote) -> dict:
+    """The response body for a note, rebuilding the content of its versions"""
+    versions = (await db.execute(
+        select(*VERSION_ROW).where(
+            DBNoteVersion.note_id == note.id
+        ).order_by(DBNoteVersion.version_number)
+    )).all()
+    contents = await db.run_sync(load_contents, versions)
+    return note_dict(note, [version_dict(v, contents[v.id]) for v in versions])
+
+
+async def _note_response(db: AsyncSession, note: DBNote) -> Response:
+    """Build the response for a note, rebuilding the content of its versions"""
+    return JSONResponse(await _note_payload(db, note), headers={"ETag": _note_etag(note)})
+
+
+class _Unchanged(Exception):
+    """The note already has the state to write"""
+
+
+def _apply_write(
+    db: Session,
+    note_id: int,
+    title: str,
+    content: str,
+    expected: Optional[int],
+    if_changed: bool,
+    edit_session: Optional[str]
+) -> Tuple[DBNote, bool]:
+    """
+    The writing half of _write_note(), with a blocking session: on the
+    request's own connection, or on the group commit writer's. Returns the
+    note and whether the edit went into the head version; the caller commits.
+    """
+    # The head version is read (and an edit likely to go into it encoded)
+    # before the write lock is taken, to hold the lock no longer than needed.
+    # This holds if no other write claimed a revision of the note since the
+    # note, then the head, were read.
+    read = None
+    note = db.get(DBNote, note_id)
+    if note is not None:
+        head = latest_version(db, note_id, delta=edit_session is not None)
+        encoded = None
+        if if_changed and coalesces(head, edit_session, datetime.datetime.utcnow()):
+            encoded = encode_rewrite(db, head, title, content)
+        read = (note.revision, head, encoded)
+    
+    claim = update(DBNote).where(DBNote.id == note_id).values(revision=DBNote.revision + 1)
+    if expected is not None:
+        claim = claim.where(DBNote.revision == expected)
+    if db.execute(claim.execution_options(synchronize_session=False)).rowcount == 0:
+        if db.execute(select(DBNote.id).where(DBNote.id == note_id)).first() is None:
+            raise HTTPException(status_code=404, detail="Note not found")
+        raise HTTPException(status_code=409, detail="The note was changed by another write")
+    
+    note = db.get(DBNote, note_id, populate_existing=True)
+    if if_changed and note.title == title and note.content == content:
+        raise _Unchanged()  # Changed to the same state meanwhile, nothing to write
+    
+    # The head version holds the current content, new versions are stored against it
+    if read is not None and note.revision == read[0] + 1:
+        _, head, encoded = read
+    else:
+        head, encoded = latest_version(db, note_id), None
+    now = datetime.datetime.utcnow()
+    coalesced = if_changed and coalesces(head, edit_session, now)
+    if coalesced:
+        rewrite_version(db, head, content, encoded or encode_rewrite(db, head, title, content))
+    else:
+        add_version(
+            db, note_id, title, content, head=head, head_content=note.content,
+            edit_session=edit_session if if_changed else None
+        )
+    note.title = title
+    note.content = content
+    note.updated_at = now
+    db.flush()
+    return note, coalesced
+
+
+async def _write_note(
+    db: AsyncSession,
+    request: Request,
+    note_id: int,
+    title: str,
+    content: str,
+    if_changed: bool
+) -> Response:
+    """
+    Make title and content the current state of a note, with a new version
+    (only if they differ from the current state, with if_changed).
+
+    The write first claims the next revision of the note with a single
+    UPDATE, conditional on the revision named by If-Match if any: it fails
+    with 409 when another write got there first, and otherwise holds the
+    write lock, so the note and its head version read next cannot change
+    before the new version is committed against them.
+
+    An edit (not a revert) naming its editor session in X-Edit-Session goes
+    into the head version instead when that session wrote it less than
+    AUTOSAVE_WINDOW seconds ago. With group commit on, the write itself is
+    committed by the group commit writer along with concurrent ones.
+    """
+    expected = _if_match_revision(request, note_id)
+    edit_session = request.headers.get("x-edit-session") or None
+    note = await _get_note_or_404(db, note_id)
+    if expected is not None and note.revision != expected:
+        raise HTTPException(status_code=409, detail="The note was changed by another write")
+    if if_changed and note.title == title and note.content == content:
+        return await _note_response(db, note)
+    
+    write = (_apply_write, note_id, title, content, expected, if_changed, edit_session)
+    try:
+        if group_writer is not None:
+            note, coalesced = await group_writer.submit(*write)
+        else:
+            try:
+                note, coalesced = await db.run_sync(*write)
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+    except _Unchanged:
+        await db.rollback()
+        return await _note_response(db, await _get_note_or_404(db, note_id))
+    
+    await change_feed.committed(db)
+    if coalesced:
+        await _invalidate_caches(note_id)  # Alignments with the head version changed too
+    else:
+        diff_cache.invalidate(note_id)
+        await note_cache.invalidate(note_id)
+    return await _note_response(db, note)
+
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Welcome to the Versioned Notes API"}
 
 
-@app.get("/notes", response_model=List[Note])
-def get_notes(db: Session = Depends(get_db)):
-    """Get all notes"""
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Hit, miss and eviction counters of the response caches in this worker"""
+    return {"notes": note_cache.stats(), "diffs": diff_cache.stats(), "payloads": payload_cache.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Request latency, SQL and serialization histograms per route, and cache
+    counters, for this worker in the Prometheus text format.
+    """
+    caches = {
+        "notes": note_cache.stats(), "diffs": diff_cache.stats(), "alignments": alignment_cache.stats(),
+        "payloads": payload_cache.stats()
+    }
+    counters = [
+        (f"notes_cache_{name}_total", "counter", f"Cache {name}", {
+            (("cache", cache),): stats[name] for cache, stats in caches.items()
+        })
+        for name in ("hits", "misses", "evictions")
+    ]
+    return PlainTextResponse(
+        render_metrics(counters),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/debug/profiler", response_model=ProfilerReport)
+async def get_profiler():
+    """The slow request profiler's settings and the last slow requests it caught"""
+    return ProfilerReport(
+        enabled=profiler.enabled,
+        slow_ms=profiler.slow_ms,
+        interval_ms=profiler.interval_ms,
+        slow_requests=[SlowRequest.model_validate(request) for request in profiler.slow_requests]
+    )
+
+
+@app.put("/debug/profiler", response_model=ProfilerReport)
+async def update_profiler(settings: ProfilerSettings):
+    """
+    Switch the slow request profiler on or off at runtime: requests taking at
+    least slow_ms are kept with the stacks sampled meanwhile; 0 switches it off.
+    Refused unless NOTES_PROFILE_RUNTIME=1, as the endpoint is not authenticated.
+    """
+    if not PROFILE_RUNTIME:
+        raise HTTPException(
+            status_code=403, detail="Switching the profiler at runtime is off, see NOTES_PROFILE_RUNTIME"
+        )
+    profiler.configure(slow_ms=settings.slow_ms, interval_ms=settings.interval_ms)
+    logger.info("Profiler configured", extra={"slow_ms": profiler.slow_ms, "interval_ms": profiler.interval_ms})
+    return await get_profiler()
+
+
+@app.get("/notes", response_model=NotePage)
+async def get_notes(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    include: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Get a page of note summaries, most recently updated first.
+    Pass the returned next_cursor to fetch the following page.
+    With include=versions, each summary also lists its version metadata (no bodies).
+    """
+    if include not in (None, "versions"):
+        raise HTTPException(status_code=400, detail=f"Unsupported include: {include}")
+
     try:
-        print("Fetching all notes")  # Debug log
-        print("Database session status:", db.is_active)
-        
-        # Query notes with eager loading of versions
-        notes = db.query(DBNote).options(
-            joinedload(DBNote.versions)
-        ).all()
-        
-        print(f"Found {len(notes)} notes")  # Debug log
-        
-        # Convert to Pydantic models
-        return [
-            Note(
-                id=note.id,
-                title=note.title,
-                content=note.content,
-                created_at=note.created_at,
-                updated_at=note.updated_at,
-                versions=[
-                    NoteVersion(
-                        id=v.id,
-                        note_id=v.note_id,
-                        title=v.title,
-                        content=v.content,
-                        created_at=v.created_at
-                    ) for v in note.versions
-                ]
-            ) for note in notes
-        ]
-        
+        logger.debug("Fetching notes page", extra={"limit": limit})
+
+        # Only select the summary columns so note bodies are never loaded in full
+        query = select(
+            DBNote.id,
+            DBNote.title,
+            func.substr(DBNote.content, 1, EXCERPT_LENGTH).label("excerpt"),
+            DBNote.created_at,
+            DBNote.updated_at
+        )
+
+        if cursor is not None:
+            try:
+                cursor_updated_at, cursor_id = decode_cursor(cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            query = query.where(
+                tuple_(DBNote.updated_at, DBNote.id) < tuple_(cursor_updated_at, cursor_id)
+            )
+
+        # Fetch one extra row to know whether there is a next page
+        rows = (await db.execute(
+            query.order_by(DBNote.updated_at.desc(), DBNote.id.desc()).limit(limit + 1)
+        )).all()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        versions_by_note = {}
+        if include == "versions" and rows:
+            # Pull version metadata for the whole page in a single query
+            versions_by_note = {row.id: [] for row in rows}
+            version_rows = (await db.execute(
+                select(
+                    DBNoteVersion.id,
+                    DBNoteVersion.note_id,
+                    DBNoteVersion.version_number,
+                    DBNoteVersion.created_at
+                ).where(
+                    DBNoteVersion.note_id.in_(versions_by_note.keys())
+                ).order_by(DBNoteVersion.note_id, DBNoteVersion.version_number.desc())
+            )).all()
+
+            for v in version_rows:
+                versions_by_note[v.note_id].append(version_summary_dict(v))
+
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            next_cursor = encode_cursor(last.updated_at, last.id)
+
+        return JSONResponse({
+            "items": [summary_dict(row, versions_by_note.get(row.id)) for row in rows],
+            "next_cursor": next_cursor
+        })
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error fetching notes: {str(e)}")  # Debug log
+        logger.exception("Error fetching notes")
         raise HTTPException(
             status_code=500,
             detail=f"Error fetching notes: {str(e)}"
@@ -74,299 +545,831 @@ def get_notes(db: Session = Depends(get_db)):
 
 
 @app.post("/notes", response_model=Note, status_code=status.HTTP_201_CREATED)
-async def create_note(note: NoteCreate, db: Session = Depends(get_db)):
+async def create_note(note: NoteCreate, db: AsyncSession = Depends(get_db)):
     """Create a new note with its first version"""
     try:
-        # Log incoming request data
-        print(f"Received request data: {note.dict()}")
+        logger.debug("Creating note", extra={"content_length": len(note.content)})
         
         now = datetime.datetime.utcnow()
         
-        # Create the note
+        # Create the note and its first version, written in a single transaction
         db_note = DBNote(
             title=note.title,
             content=note.content,
             created_at=now,
             updated_at=now
         )
+        db_version = build_version(None, note.title, note.content, created_at=now, version_number=1)
+        await db.run_sync(save_blobs, [note.content])
+        db_note.versions.append(db_version)
         db.add(db_note)
         try:
-            db.commit()
-            db.refresh(db_note)
-            print(f"Note created with ID: {db_note.id}")
+            await db.commit()
+            logger.debug("Note created", extra={"note_id": db_note.id})
         except Exception as e:
-            db.rollback()
-            print(f"Database error creating note: {str(e)}")
+            await db.rollback()
+            logger.exception("Database error creating note")
             raise HTTPException(
                 status_code=500,
                 detail=f"Database error: {str(e)}"
             )
+        await change_feed.committed(db)
         
-        # Create the first version
-        db_version = DBNoteVersion(
-            note_id=db_note.id,
-            title=note.title,
-            content=note.content,
-            created_at=now
-        )
-        db.add(db_version)
-        try:
-            db.commit()
-            db.refresh(db_note)
-        except Exception as e:
-            db.rollback()
-            print(f"Database error creating version: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Database error: {str(e)}"
-            )
-        
-        # Convert to Pydantic model for response
-        return Note(
-            id=db_note.id,
-            title=db_note.title,
-            content=db_note.content,
-            created_at=db_note.created_at,
-            updated_at=db_note.updated_at,
-            versions=[NoteVersion(
-                id=v.id,
-                note_id=v.note_id,
-                title=v.title,
-                content=v.content,
-                created_at=v.created_at
-            ) for v in db_note.versions]
+        # Respond from what was written, nothing needs to be read back
+        return JSONResponse(
+            note_dict(db_note, [version_dict(db_version, note.content)]),
+            status_code=status.HTTP_201_CREATED
         )
         
     except Exception as e:
-        db.rollback()
-        print(f"Unexpected error: {str(e)}")
+        await db.rollback()
+        logger.exception("Unexpected error creating note")
         raise HTTPException(
             status_code=500,
             detail=str(e)
         )
 
 
-@app.get("/notes/{note_id}", response_model=Note)
-def get_note(note_id: int, db: Session = Depends(get_db)):
-    """Get a note by its ID"""
+@app.post("/notes:batch", response_model=NoteBatchResult, status_code=status.HTTP_201_CREATED)
+async def create_notes_batch(batch: NoteBatchCreate, db: AsyncSession = Depends(get_db)):
+    """
+    Create many notes with their first versions in one transaction.
+    Rows are written with multi-row INSERT statements rather than one per note.
+    """
+    now = datetime.datetime.utcnow()
     try:
-        print(f"Fetching note with ID: {note_id}")  # Debug log
-        
-        # Add debug logging for database connection
-        print("Database session status:", db.is_active)
+        note_ids = (await db.execute(
+            insert(DBNote).returning(DBNote.id, sort_by_parameter_order=True),
+            [
+                {"title": note.title, "content": note.content, "created_at": now, "updated_at": now}
+                for note in batch.notes
+            ]
+        )).scalars().all()
         
-        # Query the note with eager loading of versions
-        note = db.query(DBNote).options(
-            joinedload(DBNote.versions)
-        ).filter(DBNote.id == note_id).first()
-        
-        print(f"Query result: {note}")  # Debug log
+        await db.run_sync(save_blobs, (note.content for note in batch.notes))
+        await db.execute(insert(DBNoteVersion), [
+            {
+                "note_id": note_id,
+                "version_number": 1,
+                "title": note.title,
+                "content_hash": content_hash(note.content),
+                "chain_length": 0,
+                "size": len(note.content),
+                "created_at": now
+            }
+            for note_id, note in zip(note_ids, batch.notes)
+        ])
+        await db.commit()
+        await change_feed.committed(db)
+    except Exception as e:
+        await db.rollback()
+        logger.exception("Database error creating notes")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Database error: {str(e)}"
+        )
+    
+    return NoteBatchResult(ids=note_ids)
+
+
+@app.get("/notes:export")
+async def export_notes(db: AsyncSession = Depends(get_db)):
+    """
+    Stream every note with its full history as NDJSON, one note per line.
+    Notes are read in chunks, so memory use does not grow with the database,
+    in one read transaction, so writes committed meanwhile are not exported.
+    """
+    async def lines() -> AsyncIterator[str]:
+        await db.run_sync(begin_snapshot)
+        after_id = 0
+        while after_id is not None:
+            chunk, after_id = await db.run_sync(export_chunk, after_id)
+            yield "".join(chunk)
+            db.expunge_all()
+        await db.commit()
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def _request_lines(request: Request) -> AsyncIterator[str]:
+    """Split a streamed request body into lines without reading it whole"""
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8")
+    if pending:
+        yield pending.decode("utf-8")
+
+
+@app.post("/notes:import", response_model=NoteImportResult, status_code=status.HTTP_201_CREATED)
+async def import_notes(request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Import notes exported by GET /notes:export, read as the body streams in.
+    Notes are written in batches, one transaction per batch, and get new ids.
+    On an invalid line the current batch is rolled back and earlier batches
+    stay imported.
+    """
+    imported = 0
+    batch = []
+    try:
+        line_number = 0
+        async for line in _request_lines(request):
+            line_number += 1
+            if not line.strip():
+                continue
+            batch.append(parse_note(line, line_number))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                imported += len(await db.run_sync(import_batch, batch))
+                await db.commit()
+                batch = []
+        imported += len(await db.run_sync(import_batch, batch))
+        await db.commit()
+    except ValueError as e:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail=f"{e} ({imported} notes imported before it)")
+    finally:
+        if imported:
+            await change_feed.committed(db)
+    
+    return NoteImportResult(imported=imported)
+
+
+@app.get(
+    "/notes:changes",
+    response_model=NoteChangePage,
+    responses={200: {"content": {"text/event-stream": {}}, "description": "With Accept: text/event-stream"}}
+)
+async def get_changes(
+    request: Request,
+    after: Optional[int] = Query(None, ge=0),
+    wait: float = Query(0, ge=0, le=MAX_CHANGES_WAIT),
+    limit: int = Query(CHANGE_FEED_PAGE, ge=1, le=CHANGE_FEED_PAGE),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Changes to notes committed after a cursor, oldest first: the note, its
+    head version after the change (none once deleted) and its updated_at.
+    Without after, there are none yet and the cursor is that of the latest
+    change, to pass as after from then on.
+    
+    With wait, the response waits up to that many seconds for a change when
+    there is none yet. When changes older than those still kept were missed,
+    reset is set: reload the notes, then follow on from the cursor returned.
+    
+    With Accept: text/event-stream, changes are streamed as server-sent events
+    as they are committed, each with its cursor as id and its kind as event
+    type; a reconnecting client resumes after its Last-Event-ID. A reset is
+    sent as a "reset" event, and an idle stream gets a comment every
+    NOTES_CHANGE_FEED_HEARTBEAT seconds.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id is not None:
+        if not last_event_id.isdigit():
+            raise HTTPException(status_code=400, detail="Last-Event-ID is not a cursor of /notes:changes")
+        after = int(last_event_id)
+    if after is None:
+        after = await latest_cursor(db)
+    
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            _change_events(db, after),
+            media_type="text/event-stream",
+            headers={"Cache-Control": REVALIDATE_CACHE_CONTROL, "X-Accel-Buffering": "no"}
+        )
+    
+    async with aclosing(change_feed.follow(db, after, heartbeat=wait, limit=limit)) as batches:
+        changes, cursor, reset = await anext(batches)
+    return JSONResponse({"changes": changes, "cursor": cursor, "reset": reset})
+
+
+async def _change_events(db: AsyncSession, after: int) -> AsyncIterator[bytes]:
+    """The changes after a cursor as server-sent events, until the client goes away"""
+    yield b"retry: 1000\n\n"
+    async with aclosing(change_feed.follow(db, after, heartbeat=CHANGE_FEED_HEARTBEAT)) as batches:
+        async for changes, cursor, reset in batches:
+            if reset:
+                yield b"id: %d\nevent: reset\ndata: %s\n\n" % (cursor, dumps({"cursor": cursor}))
+            elif not changes:
+                yield b": keepalive\n\n"
+            else:
+                yield b"".join(
+                    b"id: %d\nevent: %s\ndata: %s\n\n" % (change["id"], change["kind"].encode(), dumps(change))
+                    for change in changes
+                )
+
+
+@app.get("/notes/search", response_model=NoteSearchPage)
+async def search_notes(
+    q: str = Query(..., min_length=1, max_length=500),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Search note titles and contents, best matches first.
+    Every word of q must match; end a word with * to match it as a prefix.
+    Pass the returned next_offset to fetch the following page.
+    """
+    try:
+        query = fts_query(q)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Fetch one extra row to know whether there is a next page
+    statement = text(
+        "SELECT notes.id, notes.title, notes.created_at, notes.updated_at, "
+        "snippet(notes_fts, -1, '<mark>', '</mark>', '…', :tokens) AS snippet, "
+        "bm25(notes_fts, :title_weight, 1.0) AS rank "
+        "FROM notes_fts JOIN notes ON notes.id = notes_fts.rowid "
+        "WHERE notes_fts MATCH :query "
+        "ORDER BY rank, notes.id LIMIT :limit OFFSET :offset"
+    ).columns(created_at=DateTime, updated_at=DateTime)
+    try:
+        rows = (await db.execute(statement, {
+            "query": query,
+            "tokens": SNIPPET_TOKENS,
+            "title_weight": SEARCH_TITLE_WEIGHT,
+            "limit": limit + 1,
+            "offset": offset,
+        })).all()
+    except OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {e.orig}")
+    
+    has_more = len(rows) > limit
+    return NoteSearchPage(
+        items=[
+            NoteSearchResult(
+                id=row.id,
+                title=row.title,
+                snippet=row.snippet,
+                rank=row.rank,
+                created_at=row.created_at,
+                updated_at=row.updated_at
+            ) for row in rows[:limit]
+        ],
+        next_offset=offset + limit if has_more else None
+    )
+
+
+@app.get(
+    "/notes/{note_id}",
+    response_model=NoteDetail,
+    responses={200: {"model": Note, "description": "With embed=versions"}}
+)
+async def get_note(
+    note_id: int,
+    request: Request,
+    response: Response,
+    embed: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Get a note by its ID, with the headers of its versions (no bodies).
+    Fetch the content of a version from /notes/{note_id}/versions/{version_id},
+    or pass embed=versions to include every version's content.
+    Supports If-None-Match; the ETag changes whenever the note is updated.
+    Serialized responses without embed are cached until the note changes.
+    """
+    if embed not in (None, "versions"):
+        raise HTTPException(status_code=400, detail=f"Unsupported embed: {embed}")
+    
+    if embed is None:
+        cached = await note_cache.get(note_id)
+        if cached is not None:
+            etag, payload = cached
+            return (
+                _conditional(request, response, etag, REVALIDATE_CACHE_CONTROL)
+                or _cached_response(payload, etag, REVALIDATE_CACHE_CONTROL)
+            )
+    generation = note_cache.generation(note_id)
+    
+    try:
+        # Query the note alone first, versions are only loaded for a full response
+        note = await db.get(DBNote, note_id)
         
         if note is None:
-            print(f"Note {note_id} not found")  # Debug log
+            logger.debug("Note not found", extra={"note_id": note_id})
             raise HTTPException(status_code=404, detail="Note not found")
         
+        etag = _note_etag(note, embed)
+        not_modified = _conditional(request, response, etag, REVALIDATE_CACHE_CONTROL)
+        if not_modified is not None:
+            return not_modified
+        
+        if embed == "versions":
+            body = await _note_payload(db, note)
+        else:
+            versions = (await db.execute(
+                select(*VERSION_HEADER).where(
+                    DBNoteVersion.note_id == note.id
+                ).order_by(DBNoteVersion.version_number)
+            )).all()
+            body = note_dict(note, [version_header_dict(v) for v in versions])
+        
         try:
-            # Convert to Pydantic model with error checking
-            note_dict = {
-                "id": note.id,
-                "title": note.title,
-                "content": note.content,
-                "created_at": note.created_at,
-                "updated_at": note.updated_at,
-                "versions": []
-            }
-            
-            # Add versions if they exist
-            if hasattr(note, 'versions'):
-                note_dict["versions"] = [
-                    {
-                        "id": v.id,
-                        "note_id": v.note_id,
-                        "title": v.title,
-                        "content": v.content,
-                        "created_at": v.created_at
-                    }
-                    for v in note.versions
-                ]
-            
-            return Note(**note_dict)
+            with serializing():
+                payload = dumps(body)
             
         except Exception as conversion_error:
-            print(f"Error converting note to Pydantic model: {str(conversion_error)}")
+            logger.exception("Error serializing note", extra={"note_id": note_id})
             raise HTTPException(
                 status_code=500,
                 detail=f"Error processing note data: {str(conversion_error)}"
             )
+        
+        if embed is None:
+            await note_cache.set(note_id, etag, payload, generation=generation)
+        return _cached_response(payload, etag, REVALIDATE_CACHE_CONTROL)
             
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error fetching note {note_id}: {str(e)}")
+        logger.exception("Error fetching note", extra={"note_id": note_id})
         raise HTTPException(
             status_code=500,
             detail=f"Error fetching note: {str(e)}"
         )
 
 
-@app.put("/notes/{note_id}", response_model=Note)
-def update_note(note_id: int, note_update: NoteUpdate, db: Session = Depends(get_db)):
-    """Update a note and create a new version"""
-    db_note = db.query(DBNote).filter(DBNote.id == note_id).first()
-    if db_note is None:
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    # Check if the content has actually changed to avoid unnecessary versions
-    if db_note.title == note_update.title and db_note.content == note_update.content:
-        return db_note
-    
-    # Update the note
-    db_note.title = note_update.title
-    db_note.content = note_update.content
-    db_note.updated_at = datetime.datetime.utcnow()
-    
-    # Create a new version
-    db_version = DBNoteVersion(
-        note_id=db_note.id,
-        title=note_update.title,
-        content=note_update.content
-    )
+@app.post("/notes:batchGet", response_model=NoteBatchGetResult)
+async def batch_get_notes(batch: BatchGet, db: AsyncSession = Depends(get_db)):
+    """
+    Get several notes by ID in one request, each as GET /notes/{note_id}
+    returns it, in the order asked. IDs without a note are listed in errors
+    instead of failing the request. Notes missing from the note cache are
+    read with one query, and their version headers with another, however
+    many there are; their payloads are cached like those of single gets.
+    """
+    note_ids = list(dict.fromkeys(batch.ids))
+    payloads = {note_id: payload for note_id, (_, payload) in (await note_cache.get_many(note_ids)).items()}
+    missing = [note_id for note_id in note_ids if note_id not in payloads]
     
-    db.add(db_version)
-    db.commit()
-    db.refresh(db_note)
+    if missing:
+        generations = {note_id: note_cache.generation(note_id) for note_id in missing}
+        notes = (await db.execute(select(DBNote).where(DBNote.id.in_(missing)))).scalars().all()
+        headers = {note.id: [] for note in notes}
+        if notes:
+            versions = (await db.execute(
+                select(*VERSION_HEADER).where(
+                    DBNoteVersion.note_id.in_(headers)
+                ).order_by(DBNoteVersion.note_id, DBNoteVersion.version_number)
+            )).all()
+            for version in versions:
+                headers[version.note_id].append(version_header_dict(version))
+        
+        with serializing():
+            for note in notes:
+                payloads[note.id] = dumps(note_dict(note, headers[note.id]))
+        await asyncio.gather(*(
+            note_cache.set(note.id, _note_etag(note), payloads[note.id], generation=generations[note.id])
+            for note in notes
+        ))
     
-    return db_note
+    # Cached payloads are spliced into the response as they are
+    with serializing():
+        errors = dumps([_batch_error(note_id, "Note not found") for note_id in note_ids if note_id not in payloads])
+        body = b'{"notes":[' + b",".join(
+            payloads[note_id] for note_id in note_ids if note_id in payloads
+        ) + b'],"errors":' + errors + b"}"
+    return Response(content=body, media_type="application/json")
+
+
+@app.put("/notes/{note_id}", response_model=Note)
+async def update_note(note_id: int, note_update: NoteUpdate, request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Update a note and create a new version, unless nothing changed.
+    With If-Match set to the note's ETag, the update only applies to that
+    revision of the note and answers 409 if it has changed since.
+    Autosaving editors send X-Edit-Session with an id of their own: while
+    NOTES_AUTOSAVE_WINDOW is set, their edits within that many seconds of
+    the version they last wrote update that version instead.
+    """
+    return await _write_note(db, request, note_id, note_update.title, note_update.content, if_changed=True)
 
 
 @app.delete("/notes/{note_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_note(note_id: int, db: Session = Depends(get_db)):
+async def delete_note(note_id: int, db: AsyncSession = Depends(get_db)):
     """Delete a note and all its versions"""
-    db_note = db.query(DBNote).filter(DBNote.id == note_id).first()
-    if db_note is None:
+    result = await db.execute(delete(DBNote).where(DBNote.id == note_id))
+    if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Note not found")
     
-    db.delete(db_note)
-    db.commit()
+    # Bulk delete instead of loading every version for the ORM cascade
+    await db.execute(delete(DBNoteVersion).where(DBNoteVersion.note_id == note_id))
+    await db.commit()
+    await _invalidate_caches(note_id)
+    await change_feed.committed(db)
     
     return None
 
 
 @app.get("/notes/{note_id}/versions", response_model=List[NoteVersion])
-def get_note_versions(note_id: int, db: Session = Depends(get_db)):
-    """Get all versions of a note"""
-    note = db.query(DBNote).filter(DBNote.id == note_id).first()
-    if note is None:
+async def get_note_versions(
+    note_id: int,
+    request: Request,
+    response: Response,
+    start: Optional[int] = Query(None, ge=1),
+    end: Optional[int] = Query(None, ge=1),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Get the versions of a note, newest first.
+    start and end restrict the result to an inclusive range of version numbers.
+    Supports If-None-Match; the ETag changes when versions are added or removed.
+    """
+    row = (await db.execute(
+        select(
+            DBNote.revision,
+            select(func.count(DBNoteVersion.id)).where(
+                DBNoteVersion.note_id == note_id
+            ).scalar_subquery()
+        ).where(DBNote.id == note_id)
+    )).first()
+    if row is None:
         raise HTTPException(status_code=404, detail="Note not found")
     
-    versions = db.query(DBNoteVersion).filter(
-        DBNoteVersion.note_id == note_id
-    ).order_by(DBNoteVersion.created_at.desc()).all()
+    revision, version_count = row
+    etag = _etag("versions", note_id, revision, version_count, start or "", end or "")
+    not_modified = _conditional(request, response, etag, REVALIDATE_CACHE_CONTROL)
+    if not_modified is not None:
+        return not_modified
     
-    return versions
-
-
-@app.get("/notes/{note_id}/versions/{version_id}", response_model=NoteVersion)
-def get_note_version(note_id: int, version_id: int, db: Session = Depends(get_db)):
-    """Get a specific version of a note"""
-    version = db.query(DBNoteVersion).filter(
-        DBNoteVersion.note_id == note_id,
-        DBNoteVersion.id == version_id
-    ).first()
+    query = select(*VERSION_ROW).where(DBNoteVersion.note_id == note_id)
+    if start is not None:
+        query = query.where(DBNoteVersion.version_number >= start)
+    if end is not None:
+        query = query.where(DBNoteVersion.version_number <= end)
     
-    if version is None:
-        raise HTTPException(status_code=404, detail="Version not found")
+    versions = (await db.execute(
+        query.order_by(DBNoteVersion.version_number.desc())
+    )).all()
     
-    return version
+    contents = await db.run_sync(load_contents, versions)
+    return JSONResponse(
+        [version_dict(v, contents[v.id]) for v in versions],
+        headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    )
 
 
-@app.post("/notes/{note_id}/revert/{version_id}", response_model=Note)
-def revert_to_version(note_id: int, version_id: int, db: Session = Depends(get_db)):
-    """Revert to a previous version of a note"""
-    # Check that the note exists
-    note = db.query(DBNote).filter(DBNote.id == note_id).first()
-    if note is None:
-        raise HTTPException(status_code=404, detail="Note not found")
-    
-    # Get the version to restore
-    version = db.query(DBNoteVersion).filter(
-        DBNoteVersion.note_id == note_id,
-        DBNoteVersion.id == version_id
-    ).first()
+@app.get("/notes/{note_id}/versions/{version_id}", response_model=NoteVersion)
+async def get_note_version(
+    note_id: int,
+    version_id: int,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Get a specific version of a note.
+    Versions never change once settled, so clients may cache them
+    indefinitely; a head version that may still take autosaved edits of its
+    editor session must be revalidated until then. Settled versions are
+    kept serialized and compressed.
+    """
+    key = ("version", note_id, version_id)
+    cached = await _cached_payload_response(db, request, response, note_id, key)
+    if cached is not None:
+        return cached
+    generation = payload_cache.generation(note_id)
     
-    if version is None:
-        raise HTTPException(status_code=404, detail="Version not found")
+    version = await _get_version_or_404(db, note_id, version_id)
     
-    # Update the note with the content of the version
-    note.title = version.title
-    note.content = version.content
-    note.updated_at = datetime.datetime.utcnow()
+    etag = _etag("version", version.id, version.edits)
+    cache_control = _version_cache_control(version)
+    not_modified = _conditional(request, response, etag, cache_control)
+    if not_modified is not None:
+        return not_modified
     
-    # Create a new version that is a copy of the old one
-    new_version = DBNoteVersion(
-        note_id=note.id,
-        title=version.title,
-        content=version.content
+    return await _immutable_response(
+        request, key, note_id, (version.id,), generation,
+        version_dict(version, await db.run_sync(load_content, version)), etag, cache_control
     )
+
+
+@app.post("/notes/{note_id}/versions:batchGet", response_model=VersionBatchGetResult)
+async def batch_get_note_versions(note_id: int, batch: BatchGet, db: AsyncSession = Depends(get_db)):
+    """
+    Get several versions of a note by ID in one request, each as
+    GET /notes/{note_id}/versions/{version_id} returns it, in the order asked.
+    IDs without a version of this note are listed in errors instead of
+    failing the request. The versions are read with one query, and the bases
+    of their deltas with at most one more.
+    """
+    version_ids = list(dict.fromkeys(batch.ids))
+    versions = (await db.execute(
+        select(*VERSION_ROW).where(
+            DBNoteVersion.note_id == note_id,
+            DBNoteVersion.id.in_(version_ids)
+        )
+    )).all()
+    if not versions:
+        await _get_note_or_404(db, note_id)
     
-    db.add(new_version)
-    db.commit()
-    db.refresh(note)
-    
-    return note
+    contents = await db.run_sync(load_contents, versions)
+    found = {version.id: version for version in versions}
+    return JSONResponse({
+        "versions": [version_dict(found[i], contents[i]) for i in version_ids if i in found],
+        "errors": [_batch_error(i, "Version not found") for i in version_ids if i not in found],
+    })
+
+
+@app.post("/notes/{note_id}/revert/{version_id}", response_model=Note)
+async def revert_to_version(note_id: int, version_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Revert to a previous version of a note, as a new version.
+    Supports If-Match like updates.
+    """
+    await _get_note_or_404(db, note_id)
+    version = await _get_version_or_404(db, note_id, version_id)
+    content = await db.run_sync(load_content, version)
+    return await _write_note(db, request, note_id, version.title, content, if_changed=False)
 
 
-@app.get("/notes/{note_id}/versions/{version_id}/diff", response_model=NoteDiff)
-def get_version_diff(note_id: int, version_id: int, previous: Optional[bool] = False, db: Session = Depends(get_db)):
+@app.get(
+    "/notes/{note_id}/versions/{version_id}/diff",
+    response_model=NoteDiff,
+    responses={200: {"model": NoteHunkDiff, "description": "With format=hunks"}}
+)
+async def get_version_diff(
+    note_id: int,
+    version_id: int,
+    request: Request,
+    response: Response,
+    previous: Optional[bool] = False,
+    format: str = Query("lines", pattern="^(lines|hunks)$"),
+    context: int = Query(3, ge=0, le=MAX_DIFF_CONTEXT),
+    hunk_start: int = Query(0, ge=0),
+    hunk_limit: Optional[int] = Query(None, ge=1),
+    db: AsyncSession = Depends(get_db)
+):
     """
     Get the differences between two versions of a note.
-    If previous=True, compare with the previous version.
-    Otherwise, compare with the current version of the note.
+    If previous=True, compare with the previous version, the closest older
+    one when retention pruned some in between. Otherwise, compare with the current version of the note.
+    Results are cached until the note changes. Clients revalidate diffs with
+    the previous version too: retention may prune that version, and the ETag
+    then changes with the version the diff is taken against.
+    
+    format=lines lists every line with its status. format=hunks only returns
+    changed lines with context lines around them, grouped into hunks of runs;
+    context=0 gives the changed lines alone, and hunk_start/hunk_limit select a
+    range of hunks. Hunks are streamed as NDJSON (a header line, then one hunk
+    per line) when the request accepts application/x-ndjson.
     """
+    target = "previous" if previous else "current"
+    cache_key = (note_id, version_id, target)
+    if format == "lines":
+        cached = diff_cache.get(cache_key)
+        if cached is not None:
+            etag, cache_control, diff, versions = cached
+            if await _versions_exist(db, note_id, versions):
+                return (
+                    _conditional(request, response, etag, cache_control)
+                    or JSONResponse(diff, headers={"ETag": etag, "Cache-Control": cache_control})
+                )
+            await _invalidate_caches(note_id)
+    generation = diff_cache.generation(note_id)
+    
     # Check that the note exists
-    note = db.query(DBNote).filter(DBNote.id == note_id).first()
-    if note is None:
-        raise HTTPException(status_code=404, detail="Note not found")
+    note = await _get_note_or_404(db, note_id)
     
     # Get the requested version
-    version = db.query(DBNoteVersion).filter(
-        DBNoteVersion.note_id == note_id,
-        DBNoteVersion.id == version_id
-    ).first()
-    
-    if version is None:
-        raise HTTPException(status_code=404, detail="Version not found")
+    version = await _get_version_or_404(db, note_id, version_id)
     
     if previous:
         # Compare with the previous version
-        previous_versions = db.query(DBNoteVersion).filter(
-            DBNoteVersion.note_id == note_id,
-            DBNoteVersion.created_at < version.created_at
-        ).order_by(DBNoteVersion.created_at.desc()).first()
+        previous_versions = (await db.execute(
+            select(DBNoteVersion).options(undefer_group("body")).where(
+                DBNoteVersion.note_id == note_id,
+                DBNoteVersion.version_number < version.version_number
+            ).order_by(DBNoteVersion.version_number.desc()).limit(1)
+        )).scalar_one_or_none()
         
         if previous_versions is None:
             raise HTTPException(status_code=404, detail="No previous version")
         
+        etag_parts = ["diff", previous_versions.id, version.id, version.edits]
+    else:
+        # Compare with the current version
+        etag_parts = ["diff", version.id, "current", note.revision]
+    cache_control = REVALIDATE_CACHE_CONTROL
+    
+    streaming = format == "hunks" and "application/x-ndjson" in request.headers.get("accept", "")
+    if format == "hunks":
+        etag_parts += ["hunks", context, hunk_start, hunk_limit or "", "ndjson" if streaming else "json"]
+    etag = _etag(*etag_parts)
+    not_modified = _conditional(request, response, etag, cache_control)
+    if not_modified is not None:
+        return not_modified
+    
+    new_version = {
+        "title": version.title,
+        "content": await db.run_sync(load_content, version)
+    }
+    
+    if previous:
+        # Versions with the same hash have the same content, only one is rebuilt
+        same = previous_versions.content_hash == version.content_hash
         old_version = {
             "title": previous_versions.title,
-            "content": previous_versions.content
+            "content": new_version["content"] if same else await db.run_sync(load_content, previous_versions)
         }
     else:
-        # Compare with the current version
+        same = note.content == new_version["content"]
         old_version = {
             "title": note.title,
             "content": note.content
         }
     
-    new_version = {
-        "title": version.title,
-        "content": version.content
+    new_lines = new_version["content"].splitlines()
+    if format == "lines":
+        # Calculate the differences off the event loop, large notes take a while
+        diff = await run_in_threadpool(
+            compare_versions, old_version, new_version, _unchanged_blocks(new_lines) if same else None
+        )
+        versions = (previous_versions.id, version.id) if previous else (version.id,)
+        diff_cache.set(cache_key, (etag, cache_control, diff, versions), tag=note_id, generation=generation)
+        return JSONResponse(diff, headers={"ETag": etag, "Cache-Control": cache_control})
+    
+    old_lines = new_lines if same else old_version["content"].splitlines()
+    blocks_key = cache_key + ("blocks",) + tuple(etag_parts[1:4])
+    blocks = _unchanged_blocks(new_lines) if same else diff_cache.get(blocks_key)
+    if blocks is None:
+        blocks = await run_in_threadpool(matching_blocks, old_lines, new_lines)
+        diff_cache.set(blocks_key, blocks, tag=note_id, generation=generation)
+    
+    return _hunk_diff_response(
+        old_version["title"], new_version["title"], old_lines, new_lines, blocks,
+        context, hunk_start, hunk_limit, streaming,
+        headers={"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept"}
+    )
+
+
+@app.get(
+    "/notes/{note_id}/diff",
+    response_model=NoteDiff,
+    responses={200: {"model": NoteHunkDiff, "description": "With format=hunks"}}
+)
+async def get_range_diff(
+    note_id: int,
+    request: Request,
+    response: Response,
+    from_: int = Query(..., alias="from", ge=1),
+    to: int = Query(..., ge=1),
+    format: str = Query("lines", pattern="^(lines|hunks)$"),
+    context: int = Query(3, ge=0, le=MAX_DIFF_CONTEXT),
+    hunk_start: int = Query(0, ge=0),
+    hunk_limit: Optional[int] = Query(None, ge=1),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Get the differences between any two versions of a note, given by version
+    number: from is the old side and to the new one, in either order.
+    format, context and the hunk range work as for a version's diff.
+    
+    Consecutive versions are aligned from their stored deltas or from cached
+    alignments, and these are chained across the range, so a wide range
+    costs little more than a narrow one. The diff never changes once both
+    versions are settled, so clients may then cache it indefinitely; it is
+    then kept serialized and compressed.
+    """
+    key = ("range", note_id, from_, to)
+    if format == "lines":
+        cached = await _cached_payload_response(db, request, response, note_id, key)
+        if cached is not None:
+            return cached
+    generation = payload_cache.generation(note_id)
+    
+    low, high = sorted((from_, to))
+    headers = (await db.execute(
+        select(
+            DBNoteVersion.id,
+            DBNoteVersion.version_number,
+            DBNoteVersion.base_id,
+            DBNoteVersion.content_hash,
+            DBNoteVersion.edit_session,
+            DBNoteVersion.created_at,
+            DBNoteVersion.edits,
+            DBNoteVersion.delta.is_not(None).label("is_delta")
+        ).where(
+            DBNoteVersion.note_id == note_id,
+            DBNoteVersion.version_number.between(low, high)
+        )
+    )).all()
+    versions = {row.version_number: row for row in headers}
+    if low not in versions or high not in versions:
+        raise HTTPException(status_code=404, detail="Version not found")
+    
+    old_id, new_id = versions[from_].id, versions[to].id
+    streaming = format == "hunks" and "application/x-ndjson" in request.headers.get("accept", "")
+    etag_parts = ["range", old_id, versions[from_].edits, new_id, versions[to].edits, format]
+    if format == "hunks":
+        etag_parts += [context, hunk_start, hunk_limit or "", "ndjson" if streaming else "json"]
+    etag = _etag(*etag_parts)
+    # Only the newer version can be a head still taking edits
+    cache_control = _version_cache_control(versions[high])
+    not_modified = _conditional(request, response, etag, cache_control)
+    if not_modified is not None:
+        return not_modified
+    
+    # Pairs of consecutive versions that are not stored as deltas are diffed
+    # from their contents, up to a budget per request; beyond it the two
+    # versions are diffed directly while the cache warms up. Versions with
+    # the same hash have the same content and need no alignment at all.
+    same = versions[low].content_hash == versions[high].content_hash
+    contiguous = len(versions) == high - low + 1 and not same
+    deltas, pairs = missing_leaves(versions, low, high) if contiguous else ({}, [])
+    compose = contiguous and len(pairs) <= ALIGNMENTS_PER_REQUEST
+    pairs = pairs[:ALIGNMENTS_PER_REQUEST]
+    needed = {versions[low].id, versions[high].id}
+    needed.update(versions[number].id for pair in pairs for number in pair)
+    rows = (await db.execute(select(*VERSION_ROW).where(DBNoteVersion.id.in_(needed)))).all()
+    if same:
+        contents = await db.run_sync(load_contents, [row for row in rows if row.id == versions[high].id])
+        contents[versions[low].id] = contents[versions[high].id]
+    else:
+        contents = await db.run_sync(load_contents, rows)
+    titles = {row.id: row.title for row in rows}
+    if compose and deltas:
+        deltas = dict((await db.execute(
+            select(DBNoteVersion.id, DBNoteVersion.delta).where(DBNoteVersion.id.in_(deltas))
+        )).all())
+    
+    def alignment():
+        if same:
+            lines = contents[versions[high].id].splitlines()
+            return lines, lines, _unchanged_blocks(lines)
+        align_pairs(note_id, versions, pairs, contents)
+        blocks = align(note_id, versions, low, high, deltas, contents) if compose else None
+        return line_alignment(contents[versions[low].id], contents[versions[high].id], blocks)
+    
+    old_lines, new_lines, blocks = await run_in_threadpool(alignment)
+    if from_ > to:
+        old_lines, new_lines = new_lines, old_lines
+        blocks = [(j, i, n) for i, j, n in blocks]
+    
+    if format == "lines":
+        diff = await run_in_threadpool(
+            compare_versions,
+            {"title": titles[old_id], "content": contents[old_id]},
+            {"title": titles[new_id], "content": contents[new_id]},
+            blocks
+        )
+        return await _immutable_response(
+            request, key, note_id, (old_id, new_id), generation, diff, etag, cache_control
+        )
+    
+    return _hunk_diff_response(
+        titles[old_id], titles[new_id], old_lines, new_lines, blocks,
+        context, hunk_start, hunk_limit, streaming,
+        headers={"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept"}
+    )
+
+
+def _unchanged_blocks(lines: List[str]) -> List[tuple]:
+    """Matching blocks of a text with itself"""
+    return [(0, 0, len(lines))] if lines else []
+
+
+def _hunk_diff_response(
+    old_title: str,
+    new_title: str,
+    old_lines: List[str],
+    new_lines: List[str],
+    blocks,
+    context: int,
+    hunk_start: int,
+    hunk_limit: Optional[int],
+    streaming: bool,
+    headers: dict
+) -> Response:
+    """Send a range of the hunks of a diff as JSON, or all of them as NDJSON"""
+    ranges = hunk_ranges(blocks, len(old_lines), len(new_lines), context)
+    stop = len(ranges) if hunk_limit is None else min(len(ranges), hunk_start + hunk_limit)
+    title_changed = old_title != new_title
+    header = {
+        "title_changed": title_changed,
+        "old_title": old_title if title_changed else None,
+        "new_title": new_title if title_changed else None,
+        "hunk_count": len(ranges),
     }
+    hunks = diff_hunks(old_lines, new_lines, ranges[hunk_start:stop], context)
     
-    # Calculate the differences
-    diff = compare_versions(old_version, new_version)
+    if streaming:
+        def lines():
+            yield dumps(header) + b"\n"
+            for hunk in hunks:
+                with serializing():
+                    line = dumps(hunk) + b"\n"
+                yield line
+        
+        return StreamingResponse(lines(), media_type="application/x-ndjson", headers=headers)
     
-    return diff
+    header["hunks"] = list(hunks)
+    header["next_hunk"] = stop if stop < len(ranges) else None
+    return JSONResponse(header, headers=headers)
 
 
 if __name__ == "__main__":
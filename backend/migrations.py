@@ -0,0 +1,285 @@
+"""
+Schema migrations for existing databases.
+
+The schema version is tracked in SQLite's PRAGMA user_version. A new database
+is created from the current models and stamped with the latest version; an
+existing one runs every migration above its stamp, in order. Migrations must
+be idempotent, since a database created by Base.metadata.create_all alone
+(as in the tests) carries no stamp.
+
+Run manually with:
+    python migrations.py
+"""
+import re
+from itertools import groupby
+from typing import Callable, List, Tuple
+
+from sqlalchemy import DateTime, inspect, insert, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateTable
+
+from database import NOTE_EVENTS_DDL, NOTES_FTS_DDL, VERSION_BLOBS_DDL, Base, DBNote, DBNoteVersion
+import storage
+
+
+def _columns(conn: Connection, table: str) -> List[str]:
+    return [column["name"] for column in inspect(conn).get_columns(table)]
+
+
+def _delta_version_storage(conn: Connection) -> None:
+    """Rebuild note_versions with the delta storage columns and re-encode every history"""
+    if "delta" in _columns(conn, "note_versions"):
+        return
+
+    # SQLite cannot relax the NOT NULL on content in place, so rebuild the table
+    conn.execute(text("ALTER TABLE note_versions RENAME TO note_versions_old"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_note_versions_id"))
+    DBNoteVersion.__table__.create(conn)
+    # Creating the table installed the change event triggers, which would
+    # record copying the history as changes; migration 9 installs them again
+    for statement in NOTE_EVENTS_DDL:
+        name = re.match(r"CREATE TRIGGER IF NOT EXISTS (\w+) ", statement).group(1)
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+
+    old_rows = conn.execute(text(
+        "SELECT id, note_id, title, content, created_at "
+        "FROM note_versions_old ORDER BY note_id, id"
+    ).columns(created_at=DateTime))
+    for note_id, rows in groupby(old_rows, key=lambda row: row.note_id):
+        rows = list(rows)
+        versions = [
+            DBNoteVersion(id=row.id, note_id=note_id, title=row.title, version_number=number)
+            for number, row in enumerate(rows, start=1)
+        ]
+        contents = {row.id: row.content for row in rows}
+        storage.encode_history(versions, contents)
+        storage.save_blobs(conn, (contents[version.id] for version in versions if version.delta is None))
+        conn.execute(insert(DBNoteVersion), [
+            {
+                "id": version.id,
+                "note_id": note_id,
+                "title": version.title,
+                "content_hash": version.content_hash,
+                "delta": version.delta,
+                "base_id": version.base_id,
+                "chain_length": version.chain_length,
+                "size": version.size,
+                "version_number": version.version_number,
+                "created_at": row.created_at,
+            }
+            for version, row in zip(versions, rows)
+        ])
+
+    conn.execute(text("DROP TABLE note_versions_old"))
+
+
+def _create_indexes(conn: Connection, table, *names: str) -> None:
+    indexes = {index.name: index for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+
+def _hot_path_indexes(conn: Connection) -> None:
+    """Index note_versions by note and notes by update time"""
+    _create_indexes(conn, DBNote.__table__, "ix_notes_updated_at")
+    _create_indexes(
+        conn, DBNoteVersion.__table__,
+        "ix_note_versions_note_id_created_at", "ix_note_versions_note_id_id"
+    )
+
+
+def _version_numbers(conn: Connection) -> None:
+    """Number each note's versions 1, 2, 3... in creation order"""
+    if "version_number" not in _columns(conn, "note_versions"):
+        conn.execute(text(
+            "ALTER TABLE note_versions ADD COLUMN version_number INTEGER NOT NULL DEFAULT 0"
+        ))
+        conn.execute(text(
+            "UPDATE note_versions SET version_number = ("
+            "SELECT COUNT(*) FROM note_versions AS earlier "
+            "WHERE earlier.note_id = note_versions.note_id AND earlier.id <= note_versions.id)"
+        ))
+    _create_indexes(conn, DBNoteVersion.__table__, "ix_note_versions_note_id_version_number")
+
+
+def _full_text_search(conn: Connection) -> None:
+    """Index existing notes for full-text search"""
+    for statement in NOTES_FTS_DDL:
+        conn.execute(text(statement))
+    conn.execute(text("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')"))
+
+
+def _version_sizes(conn: Connection) -> None:
+    """Record the content length of every version, rebuilding deltas note by note"""
+    if "size" in _columns(conn, "note_versions"):
+        return
+
+    conn.execute(text("ALTER TABLE note_versions ADD COLUMN size INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text("UPDATE note_versions SET size = length(content) WHERE content IS NOT NULL"))
+    note_ids = conn.execute(text(
+        "SELECT DISTINCT note_id FROM note_versions WHERE delta IS NOT NULL"
+    )).scalars().all()
+    for note_id in note_ids:
+        contents = {}
+        sizes = []
+        for row in conn.execute(text(
+            "SELECT id, content, delta, base_id FROM note_versions WHERE note_id = :note_id ORDER BY id"
+        ), {"note_id": note_id}):
+            # Bases are always older than the versions stored against them
+            content = row.content if row.delta is None else storage.apply_delta(contents[row.base_id], row.delta)
+            contents[row.id] = content
+            if row.delta is not None:
+                sizes.append({"version_id": row.id, "size": len(content)})
+        conn.execute(text("UPDATE note_versions SET size = :size WHERE id = :version_id"), sizes)
+
+
+def _note_revisions(conn: Connection) -> None:
+    """Give every note a row version for conditional writes"""
+    if "revision" not in _columns(conn, "notes"):
+        conn.execute(text("ALTER TABLE notes ADD COLUMN revision INTEGER NOT NULL DEFAULT 1"))
+
+
+def _version_blobs(conn: Connection) -> None:
+    """Move version contents to content-addressed blobs, hashing every version"""
+    if "content" in _columns(conn, "note_versions"):
+        if "content_hash" not in _columns(conn, "note_versions"):
+            conn.execute(text("ALTER TABLE note_versions ADD COLUMN content_hash VARCHAR"))
+        note_ids = conn.execute(text("SELECT DISTINCT note_id FROM note_versions")).scalars().all()
+        for note_id in note_ids:
+            contents = {}
+            hashes = []
+            snapshots = []
+            for row in conn.execute(text(
+                "SELECT id, content, delta, base_id FROM note_versions WHERE note_id = :note_id ORDER BY id"
+            ), {"note_id": note_id}):
+                # Bases are always older than the versions stored against them
+                content = row.content if row.delta is None else storage.apply_delta(contents[row.base_id], row.delta)
+                contents[row.id] = content
+                hashes.append({"version_id": row.id, "content_hash": storage.content_hash(content)})
+                if row.delta is None:
+                    snapshots.append(content)
+            storage.save_blobs(conn, snapshots)
+            conn.execute(text("UPDATE note_versions SET content_hash = :content_hash WHERE id = :version_id"), hashes)
+        conn.execute(text("ALTER TABLE note_versions DROP COLUMN content"))
+
+    # Tables rebuilt by earlier migrations lost their triggers, and rows
+    # inserted before them were not counted
+    for statement in VERSION_BLOBS_DDL:
+        conn.execute(text(statement))
+    conn.execute(text(
+        "UPDATE version_blobs SET refcount = (SELECT count(*) FROM note_versions "
+        "WHERE note_versions.content_hash = version_blobs.hash AND note_versions.delta IS NULL)"
+    ))
+    conn.execute(text("DELETE FROM version_blobs WHERE refcount = 0"))
+
+
+def _autosave_sessions(conn: Connection) -> None:
+    """Record the editor session of versions and the edits coalesced into them"""
+    columns = _columns(conn, "note_versions")
+    if "edit_session" not in columns:
+        conn.execute(text("ALTER TABLE note_versions ADD COLUMN edit_session VARCHAR"))
+    if "edits" not in columns:
+        conn.execute(text("ALTER TABLE note_versions ADD COLUMN edits INTEGER NOT NULL DEFAULT 1"))
+
+
+def _note_events(conn: Connection) -> None:
+    """Record change events; note_events itself is created with the other tables"""
+    # note_versions may have been rebuilt by earlier migrations since
+    for statement in NOTE_EVENTS_DDL:
+        conn.execute(text(statement))
+
+
+def _stable_ids(conn: Connection) -> None:
+    """
+    Rebuild notes and note_versions with AUTOINCREMENT, so that the ids of
+    deleted notes and versions are never handed out again
+    """
+    tables = [
+        table for table in (DBNote.__table__, DBNoteVersion.__table__)
+        if "AUTOINCREMENT" not in conn.execute(text(
+            "SELECT upper(sql) FROM sqlite_master WHERE type = 'table' AND name = :name"
+        ), {"name": table.name}).scalar()
+    ]
+    if not tables:
+        return
+
+    # Renames check every trigger, and those on a dropped table could fire
+    # on its rows: drop them all, and create them again once rebuilt
+    for name in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).scalars().all():
+        conn.execute(text(f'DROP TRIGGER "{name}"'))
+
+    # Ids still named by change events were used by notes deleted since
+    floors = {
+        "notes": "SELECT max(note_id) FROM note_events UNION ALL SELECT max(note_id) FROM note_versions",
+        "note_versions": "SELECT max(version_id) FROM note_events",
+    }
+    for table in tables:
+        columns = ", ".join(name for name in _columns(conn, table.name) if name in table.columns)
+        ddl = str(CreateTable(table).compile(dialect=conn.dialect))
+        conn.execute(text(ddl.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {table.name}_new ", 1)))
+        conn.execute(text(f"INSERT INTO {table.name}_new ({columns}) SELECT {columns} FROM {table.name}"))
+        floor = max(value or 0 for value in conn.execute(text(floors[table.name])).scalars())
+        conn.execute(text(f"DROP TABLE {table.name}"))
+        conn.execute(text(f"ALTER TABLE {table.name}_new RENAME TO {table.name}"))
+        conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {"name": table.name})
+        conn.execute(text(
+            f"INSERT INTO sqlite_sequence (name, seq) SELECT :name, max(coalesce(max(id), 0), :floor) "
+            f"FROM {table.name}"
+        ), {"name": table.name, "floor": floor})
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+    for statement in VERSION_BLOBS_DDL + NOTES_FTS_DDL + NOTE_EVENTS_DDL:
+        conn.execute(text(statement))
+
+
+# (schema version, description, migration), in order
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "delta version storage", _delta_version_storage),
+    (2, "hot path indexes", _hot_path_indexes),
+    (3, "version numbers", _version_numbers),
+    (4, "full-text search", _full_text_search),
+    (5, "version sizes", _version_sizes),
+    (6, "note revisions", _note_revisions),
+    (7, "version blobs", _version_blobs),
+    (8, "autosave sessions", _autosave_sessions),
+    (9, "note events", _note_events),
+    (10, "stable ids", _stable_ids),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def run_migrations(bind) -> List[str]:
+    """
+    Create missing tables and apply pending migrations.
+    Returns the descriptions of the migrations that were applied.
+    """
+    applied = []
+    with bind.begin() as conn:
+        fresh = not inspect(conn).has_table("notes")
+        Base.metadata.create_all(bind=conn)
+        current = conn.execute(text("PRAGMA user_version")).scalar()
+
+        if fresh:
+            current = LATEST_VERSION
+        else:
+            for version, description, migrate in MIGRATIONS:
+                if version > current:
+                    migrate(conn)
+                    applied.append(description)
+                    current = version
+
+        conn.execute(text(f"PRAGMA user_version = {int(current)}"))
+    return applied
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    applied = run_migrations(engine)
+    if applied:
+        for description in applied:
+            print(f"Applied migration: {description}")
+    else:
+        print("Database is up to date")
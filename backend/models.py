@@ -1,19 +1,21 @@
 from datetime import datetime
-from typing import List, Optional
-from pydantic import BaseModel, Field, validator, ConfigDict
+from typing import Dict, List, Optional
+from pydantic import BaseModel, Field, field_validator, ConfigDict
 
 
 class NoteBase(BaseModel):
     title: str = Field(..., min_length=1, max_length=100)
     content: str = Field(..., min_length=1)
 
-    @validator('title')
+    @field_validator('title')
+    @classmethod
     def title_must_not_be_empty(cls, v):
         if not v.strip():
             raise ValueError('Title cannot be empty')
         return v
 
-    @validator('content')
+    @field_validator('content')
+    @classmethod
     def content_must_not_be_empty(cls, v):
         if not v.strip():
             raise ValueError('Content cannot be empty')
@@ -28,9 +30,32 @@ class NoteUpdate(NoteBase):
     pass
 
 
+class NoteBatchCreate(BaseModel):
+    notes: List[NoteCreate] = Field(..., min_length=1, max_length=10000)
+
+
+class NoteBatchResult(BaseModel):
+    ids: List[int]  # Ids of the created notes, in request order
+
+
+class BatchGet(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=1000)  # Repeated ids are only returned once
+
+
+class BatchGetError(BaseModel):
+    id: int
+    status: int  # The status a request for this id alone would have answered
+    detail: str
+
+
+class NoteImportResult(BaseModel):
+    imported: int  # Number of notes created
+
+
 class NoteVersion(BaseModel):
     id: int
     note_id: int
+    version_number: int
     title: str
     content: str
     created_at: datetime
@@ -38,6 +63,17 @@ class NoteVersion(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
+class NoteVersionHeader(BaseModel):
+    id: int
+    note_id: int
+    version_number: int
+    title: str
+    created_at: datetime
+    size: int  # Length of the content in characters
+
+    model_config = ConfigDict(from_attributes=True)
+
+
 class Note(NoteBase):
     id: int
     created_at: datetime
@@ -47,8 +83,126 @@ class Note(NoteBase):
     model_config = ConfigDict(from_attributes=True)
 
 
+class NoteDetail(NoteBase):
+    id: int
+    created_at: datetime
+    updated_at: datetime
+    versions: List[NoteVersionHeader] = []  # Bodies are fetched one version at a time
+
+    model_config = ConfigDict(from_attributes=True)
+
+
 class NoteDiff(BaseModel):
     title_changed: bool = False
     old_title: Optional[str] = None
     new_title: Optional[str] = None
-    content_diff: List[dict] = []  # List of lines with their status (added, removed, unchanged)
\ No newline at end of file
+    content_diff: List[dict] = []  # List of lines with their status (added, removed, unchanged)
+
+
+class DiffRun(BaseModel):
+    type: str  # unchanged, removed or added
+    lines: List[str]
+
+
+class DiffHunk(BaseModel):
+    old_start: int  # 1-based first line in the old text
+    old_lines: int
+    new_start: int  # 1-based first line in the new text
+    new_lines: int
+    runs: List[DiffRun]
+
+
+class NoteHunkDiff(BaseModel):
+    title_changed: bool = False
+    old_title: Optional[str] = None
+    new_title: Optional[str] = None
+    hunk_count: int  # Hunks in the whole diff
+    hunks: List[DiffHunk] = []  # The requested range of hunks
+    next_hunk: Optional[int] = None  # Index of the following hunk, None after the last one
+
+
+class NoteVersionSummary(BaseModel):
+    id: int
+    note_id: int
+    version_number: int
+    created_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class NoteSummary(BaseModel):
+    id: int
+    title: str
+    excerpt: str
+    created_at: datetime
+    updated_at: datetime
+    versions: Optional[List[NoteVersionSummary]] = None  # Only set with include=versions
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class NotePage(BaseModel):
+    items: List[NoteSummary] = []
+    next_cursor: Optional[str] = None  # Opaque keyset cursor, None on the last page
+
+
+class NoteSearchResult(BaseModel):
+    id: int
+    title: str
+    snippet: str  # Best matching fragment, matched words wrapped in <mark></mark>
+    rank: float  # BM25 score, lower is more relevant
+    created_at: datetime
+    updated_at: datetime
+
+
+class NoteSearchPage(BaseModel):
+    items: List[NoteSearchResult] = []
+    next_offset: Optional[int] = None  # None on the last page
+
+
+class NoteBatchGetResult(BaseModel):
+    notes: List[NoteDetail] = []  # The notes found, in request order
+    errors: List[BatchGetError] = []
+
+
+class VersionBatchGetResult(BaseModel):
+    versions: List[NoteVersion] = []  # The versions found, in request order
+    errors: List[BatchGetError] = []
+
+
+class NoteChange(BaseModel):
+    id: int  # Cursor of the change
+    note_id: int
+    version_id: Optional[int] = None  # The note's head version after the change, None when deleted
+    kind: str  # created, updated or deleted
+    updated_at: datetime
+
+
+class NoteChangePage(BaseModel):
+    changes: List[NoteChange] = []  # Oldest first
+    cursor: int  # Pass as after to get the following changes
+    reset: bool = False  # Changes after the cursor given are no longer kept: reload the notes
+
+
+class ProfilerSettings(BaseModel):
+    slow_ms: Optional[float] = Field(None, ge=0)  # Requests at least this slow are kept, 0 switches off
+    interval_ms: Optional[float] = Field(None, ge=1)  # Time between stack samples
+
+
+class SlowRequest(BaseModel):
+    method: str
+    route: str
+    status: int
+    duration_ms: float
+    queries: int
+    started_at: datetime
+    stacks: Dict[str, int]  # Folded stacks sampled during the request, with their counts
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ProfilerReport(BaseModel):
+    enabled: bool
+    slow_ms: float
+    interval_ms: float
+    slow_requests: List[SlowRequest] = []  # Most recent last
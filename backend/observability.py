@@ -0,0 +1,405 @@
+"""
+Logging, request metrics and profiling of slow requests.
+
+Logs go through the "notes" logger, as one JSON object per line by default
+(NOTES_LOG_FORMAT=text for plain lines), at NOTES_LOG_LEVEL (INFO).
+
+MetricsMiddleware records, per route: latency, SQL query count and time
+(counted by engine events, see instrument_sql) and serialization time, as
+histograms rendered in the Prometheus text format by render_metrics().
+
+SlowRequestProfiler samples the stacks of every thread while requests run
+and keeps the samples of those slower than a threshold. Samples cover
+whatever ran meanwhile, including other requests. It is off unless
+NOTES_PROFILE_SLOW_MS is set, and can be switched at runtime through the API
+when NOTES_PROFILE_RUNTIME=1, which anyone reaching the API could then do.
+Samples are at least MIN_PROFILE_INTERVAL_MS apart.
+"""
+import bisect
+import collections
+import contextlib
+import contextvars
+import datetime
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LOG_LEVEL = os.environ.get("NOTES_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("NOTES_LOG_FORMAT", "json")
+PROFILE_SLOW_MS = float(os.environ.get("NOTES_PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("NOTES_PROFILE_INTERVAL_MS", "5"))
+# Whether PUT /debug/profiler may switch the profiler at runtime
+PROFILE_RUNTIME = os.environ.get("NOTES_PROFILE_RUNTIME", "0") == "1"
+
+# Shortest time between stack samples, as each one walks every thread's stack
+MIN_PROFILE_INTERVAL_MS = 1.0
+
+logger = logging.getLogger("notes")
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as JSON objects, with the fields passed in extra="""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = LOG_LEVEL, format: str = LOG_FORMAT) -> None:
+    """Send the "notes" logger to standard error, leaving other loggers alone"""
+    handler = logging.StreamHandler()
+    if format == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+class RequestStats:
+    """What one request spent, filled in as it runs"""
+
+    __slots__ = ("queries", "query_seconds", "serialization_seconds", "endpoint_finished")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.endpoint_finished: Optional[float] = None
+
+
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+@contextlib.contextmanager
+def serializing() -> Iterator[None]:
+    """Count the enclosed time as serialization time of the current request"""
+    stats = _request_stats.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.serialization_seconds += time.perf_counter() - started
+
+
+class InstrumentedRoute(APIRoute):
+    """
+    Route counting the time from the endpoint returning to the response being
+    ready (response model validation and JSON encoding) as serialization time.
+    Endpoints that build their own response time it with serializing().
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if inspect.iscoroutinefunction(endpoint):
+            endpoint = _timed_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            response = await handler(request)
+            stats = _request_stats.get()
+            if stats is not None and stats.endpoint_finished is not None:
+                stats.serialization_seconds += time.perf_counter() - stats.endpoint_finished
+            return response
+
+        return timed_handler
+
+
+def _timed_endpoint(endpoint: Callable) -> Callable:
+    @functools.wraps(endpoint)
+    async def timed(*args, **kwargs):
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            stats = _request_stats.get()
+            if stats is not None:
+                stats.endpoint_finished = time.perf_counter()
+
+    return timed
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_seconds += time.perf_counter() - started
+
+
+def instrument_sql() -> None:
+    """Count queries and their time against the current request, on every engine"""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class Histogram:
+    """A Prometheus histogram with labels: cumulative bucket counts, sum and count"""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        # Counts per bucket (the last one is +Inf), then the sum
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cumulative}'
+            yield f"{self.name}_sum{{{labels}}} {values[-1]}"
+            yield f"{self.name}_count{{{labels}}} {cumulative}"
+
+    def totals(self, *label_values: str) -> Tuple[int, float]:
+        """Number and sum of the observations of one series"""
+        with self._lock:
+            series = self._series.get(label_values)
+            return (int(sum(series[:-1])), series[-1]) if series is not None else (0, 0.0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_SECONDS = Histogram(
+    "notes_http_request_duration_seconds", "Time to handle a request, until its last byte",
+    ["method", "route", "status"], LATENCY_BUCKETS
+)
+QUERY_COUNT = Histogram(
+    "notes_http_request_db_queries", "SQL statements run by a request",
+    ["method", "route"], QUERY_COUNT_BUCKETS
+)
+QUERY_SECONDS = Histogram(
+    "notes_http_request_db_seconds", "Time a request spent running SQL statements",
+    ["method", "route"], LATENCY_BUCKETS
+)
+SERIALIZATION_SECONDS = Histogram(
+    "notes_http_request_serialization_seconds", "Time a request spent serializing its response",
+    ["method", "route"], LATENCY_BUCKETS
+)
+HISTOGRAMS = [REQUEST_SECONDS, QUERY_COUNT, QUERY_SECONDS, SERIALIZATION_SECONDS]
+
+
+def render_metrics(gauges: Sequence[Tuple[str, str, str, Dict[Tuple[Tuple[str, str], ...], float]]] = ()) -> str:
+    """
+    The request histograms in the Prometheus text format, followed by the
+    given (name, type, help, {labels: value}) series.
+    """
+    lines: List[str] = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for name, kind, help, values in gauges:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(values.items()):
+            label_text = _labels([key for key, _ in labels], [value for _, value in labels])
+            lines.append(f"{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class SlowRequest:
+    __slots__ = ("method", "route", "status", "duration_ms", "queries", "started_at", "stacks")
+
+    def __init__(self, method, route, status, duration_ms, queries, started_at, stacks):
+        self.method = method
+        self.route = route
+        self.status = status
+        self.duration_ms = duration_ms
+        self.queries = queries
+        self.started_at = started_at
+        self.stacks = stacks
+
+
+class SlowRequestProfiler:
+    """
+    Samples the stacks of every thread every interval_ms while at least one
+    request is running, and keeps the samples taken during requests slower
+    than slow_ms, as folded stacks ("outer;inner" lines with a count) ready
+    for flame graph tools. Setting slow_ms to 0 switches it off.
+    """
+
+    def __init__(self, slow_ms: float = 0, interval_ms: float = 5, keep: int = 20):
+        self.slow_ms = slow_ms
+        self.interval_ms = max(interval_ms, MIN_PROFILE_INTERVAL_MS)
+        self.slow_requests: Deque[SlowRequest] = collections.deque(maxlen=keep)
+        self._samples: Deque[Tuple[float, Tuple[str, ...]]] = collections.deque(maxlen=100_000)
+        self._active = 0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.slow_ms > 0
+
+    def configure(self, slow_ms: Optional[float] = None, interval_ms: Optional[float] = None) -> None:
+        with self._condition:
+            if slow_ms is not None:
+                self.slow_ms = slow_ms
+            if interval_ms is not None:
+                self.interval_ms = max(interval_ms, MIN_PROFILE_INTERVAL_MS)
+            if not self.enabled:
+                self._samples.clear()
+            self._condition.notify()
+
+    def request_started(self) -> bool:
+        """Start sampling if enabled; returns whether request_finished() must be called"""
+        if not self.enabled:
+            return False
+        with self._condition:
+            self._active += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return True
+
+    def request_finished(self, started: float, method: str, route: str, status: int, queries: int) -> None:
+        finished = time.perf_counter()
+        with self._condition:
+            self._active -= 1
+            duration_ms = (finished - started) * 1000
+            if not self.enabled or duration_ms < self.slow_ms:
+                return
+            stacks = collections.Counter(
+                ";".join(stack) for sampled_at, stack in self._samples if started <= sampled_at <= finished
+            )
+        self.slow_requests.append(SlowRequest(
+            method, route, status, duration_ms, queries,
+            datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(milliseconds=duration_ms),
+            dict(stacks.most_common())
+        ))
+        logger.warning(
+            "Slow request", extra={"method": method, "route": route, "duration_ms": round(duration_ms, 1)}
+        )
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            with self._condition:
+                while not (self.enabled and self._active):
+                    self._condition.wait()
+                interval = self.interval_ms / 1000
+            now = time.perf_counter()
+            for thread_id, frame in sys._current_frames().items():
+                # Skip idle threads, blocked waiting for work or I/O
+                if thread_id != own and os.path.basename(frame.f_code.co_filename) not in _IDLE_FILES:
+                    self._samples.append((now, _stack(frame)))
+            # Samples older than any request still worth keeping are dropped by the deque bound
+            time.sleep(interval)
+
+
+_IDLE_FILES = {"threading.py", "selectors.py", "queue.py"}
+
+
+def _stack(frame) -> Tuple[str, ...]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+profiler = SlowRequestProfiler(slow_ms=PROFILE_SLOW_MS, interval_ms=PROFILE_INTERVAL_MS)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the request histograms, and feeding the slow
+    request profiler. Routes are labelled by their path template, so
+    /notes/1 and /notes/2 share a series.
+    """
+
+    def __init__(self, app, clock: Callable[[], float] = time.perf_counter):
+        self.app = app
+        self._clock = clock
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        started = self._clock()
+        profiled = profiler.request_started()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_stats.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            REQUEST_SECONDS.observe(self._clock() - started, method, route, str(status))
+            QUERY_COUNT.observe(stats.queries, method, route)
+            QUERY_SECONDS.observe(stats.query_seconds, method, route)
+            SERIALIZATION_SECONDS.observe(stats.serialization_seconds, method, route)
+            if profiled:
+                profiler.request_finished(started, method, route, status, stats.queries)
@@ -0,0 +1,412 @@
+"""
+Retention of version history.
+
+A RetentionPolicy decides which versions of a note to prune. It combines any of:
+- keep_last: keep only the N latest versions
+- hourly_after / daily_after: past that age, keep only the latest version of
+  each hour / day
+- max_size: drop the oldest versions until the contents of the remaining
+  ones add up to at most this many characters
+The latest version of a note is always kept, and version numbers are left
+as they were, with gaps where versions were pruned.
+
+Compaction walks the notes in id order, a batch at a time, and plans from the
+version headers alone. Each note with something to prune is then compacted in
+its own short transaction, which starts by incrementing the note's revision
+(like any write, so its ETag changes) to hold the write lock for that note
+only. Versions stored as deltas against a pruned version are re-encoded
+against the previous version kept, or as snapshots. The blob of a pruned
+snapshot goes once no version of any note points at it any more.
+
+Deleted rows leave free pages in the database file. With auto_vacuum set to
+INCREMENTAL (new databases under the tuned SQLite profile), incremental_vacuum()
+gives them back to the filesystem a few pages at a time; an existing database
+is switched over once with enable_incremental_vacuum(), which rewrites it.
+
+Run manually with:
+    python retention.py --keep-last 100 --daily-after 30 [--dry-run] [--vacuum]
+or in the API process by setting NOTES_RETENTION_INTERVAL along with the
+NOTES_RETENTION_* policy variables.
+"""
+import datetime
+import os
+import threading
+import time
+from itertools import groupby
+from operator import attrgetter
+from typing import Callable, Dict, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import LargeBinary, cast, delete, func, select, text, update
+from sqlalchemy.orm import Session
+
+from database import DBNote, DBNoteVersion, DBVersionBlob
+from observability import logger
+import storage
+
+RETENTION_KEEP_LAST = os.environ.get("NOTES_RETENTION_KEEP_LAST")
+RETENTION_HOURLY_AFTER = os.environ.get("NOTES_RETENTION_HOURLY_AFTER")  # Hours
+RETENTION_DAILY_AFTER = os.environ.get("NOTES_RETENTION_DAILY_AFTER")  # Days
+RETENTION_MAX_SIZE = os.environ.get("NOTES_RETENTION_MAX_SIZE")  # Characters per note
+# Seconds between background compactions in the API process, 0 switches them off
+RETENTION_INTERVAL = float(os.environ.get("NOTES_RETENTION_INTERVAL", "0"))
+
+# Notes planned per read of the version headers
+NOTES_PER_BATCH = 100
+
+# Free pages returned to the filesystem per incremental vacuum step
+VACUUM_PAGES = 1000
+
+
+class RetentionPolicy:
+    """Which versions of a note to keep; every rule left as None is off"""
+
+    def __init__(
+        self,
+        keep_last: Optional[int] = None,
+        hourly_after: Optional[datetime.timedelta] = None,
+        daily_after: Optional[datetime.timedelta] = None,
+        max_size: Optional[int] = None
+    ):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError("keep_last must be at least 1")
+        self.keep_last = keep_last
+        self.hourly_after = hourly_after
+        self.daily_after = daily_after
+        self.max_size = max_size
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        return cls(
+            keep_last=int(RETENTION_KEEP_LAST) if RETENTION_KEEP_LAST else None,
+            hourly_after=(
+                datetime.timedelta(hours=float(RETENTION_HOURLY_AFTER)) if RETENTION_HOURLY_AFTER else None
+            ),
+            daily_after=datetime.timedelta(days=float(RETENTION_DAILY_AFTER)) if RETENTION_DAILY_AFTER else None,
+            max_size=int(RETENTION_MAX_SIZE) if RETENTION_MAX_SIZE else None,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return any(
+            rule is not None for rule in (self.keep_last, self.hourly_after, self.daily_after, self.max_size)
+        )
+
+    def prune(self, versions: Sequence, now: datetime.datetime) -> Set[int]:
+        """
+        Ids of the versions to delete, given the versions of one note oldest
+        first, as rows with id, created_at and size.
+        """
+        if len(versions) < 2:
+            return set()
+        doomed: Set[int] = set()
+
+        if self.keep_last is not None:
+            doomed.update(version.id for version in versions[:-self.keep_last])
+
+        for after, bucket in (
+            (self.hourly_after, lambda at: at.replace(minute=0, second=0, microsecond=0)),
+            (self.daily_after, lambda at: at.date()),
+        ):
+            if after is None:
+                continue
+            # Newest first, so each bucket keeps its latest version
+            seen = set()
+            for version in reversed(versions):
+                if now - version.created_at < after:
+                    continue
+                key = bucket(version.created_at)
+                if key in seen:
+                    doomed.add(version.id)
+                else:
+                    seen.add(key)
+
+        if self.max_size is not None:
+            total = sum(version.size for version in versions if version.id not in doomed)
+            for version in versions[:-1]:
+                if total <= self.max_size:
+                    break
+                if version.id not in doomed:
+                    doomed.add(version.id)
+                    total -= version.size
+
+        doomed.discard(versions[-1].id)
+        return doomed
+
+
+class CompactionReport:
+    """What a compaction run did; bytes are those of the version bodies as stored"""
+
+    def __init__(self):
+        self.notes_scanned = 0
+        self.notes_compacted = 0
+        self.versions_deleted = 0
+        self.versions_rebased = 0
+        self.bytes_reclaimed = 0
+        self.bytes_vacuumed = 0  # Returned to the filesystem by incremental_vacuum()
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+# Version columns compaction reads, bodies included
+_VERSION_COLUMNS = (
+    DBNoteVersion.id, DBNoteVersion.version_number, DBNoteVersion.title, DBNoteVersion.created_at,
+    DBNoteVersion.size, DBNoteVersion.content_hash, DBNoteVersion.content, DBNoteVersion.delta,
+    DBNoteVersion.base_id, DBNoteVersion.chain_length
+)
+
+
+def _blob_bytes(db: Session, hashes: Set[str]) -> Dict[str, int]:
+    """Stored size of the blobs with these hashes that exist"""
+    return dict(db.execute(
+        select(DBVersionBlob.hash, func.length(cast(DBVersionBlob.content, LargeBinary)))
+        .where(DBVersionBlob.hash.in_(hashes))
+    ).all())
+
+
+def _delta_bytes(delta: Optional[str]) -> int:
+    return len(delta.encode()) if delta is not None else 0
+
+
+def compact_note(
+    db: Session,
+    note_id: int,
+    policy: RetentionPolicy,
+    now: datetime.datetime
+) -> Tuple[int, int, int]:
+    """
+    Apply a policy to the history of one note in a single transaction.
+    Returns the number of versions deleted and rebased, and the bytes reclaimed.
+    """
+    # Take the write lock first, so the history cannot change while it is pruned.
+    # updated_at stays put: the note did not change, and lists are ordered by it
+    claimed = db.execute(
+        update(DBNote).where(DBNote.id == note_id).values(
+            revision=DBNote.revision + 1, updated_at=DBNote.updated_at
+        ),
+        execution_options={"synchronize_session": False}
+    )
+    versions = db.execute(
+        select(*_VERSION_COLUMNS).where(DBNoteVersion.note_id == note_id).order_by(DBNoteVersion.version_number)
+    ).all()
+    doomed = policy.prune(versions, now) if claimed.rowcount else set()
+    if not doomed:
+        db.rollback()
+        return 0, 0, 0
+
+    kept = [version for version in versions if version.id not in doomed]
+    orphans = [version for version in kept if version.delta is not None and version.base_id in doomed]
+    # Blobs are shared, so they are only reclaimed once no version points at them
+    hashes = {version.content_hash for version in versions if version.id in doomed}
+    hashes.update(version.content_hash for version in orphans)
+    blobs_before = _blob_bytes(db, hashes)
+    reclaimed = sum(_delta_bytes(version.delta) for version in versions if version.id in doomed)
+
+    if orphans:
+        previous = {version.id: kept[index - 1] for index, version in enumerate(kept) if index > 0}
+        bases = [previous[version.id] for version in orphans if version.id in previous]
+        contents = storage.load_contents(db, orphans + bases)
+        chain_lengths = {version.id: version.chain_length for version in kept}
+        for version in orphans:
+            base = previous.get(version.id)
+            encoded = storage.build_version(
+                note_id, version.title, contents[version.id],
+                head=DBNoteVersion(id=base.id, chain_length=chain_lengths[base.id]) if base else None,
+                head_content=contents[base.id] if base else None,
+                shared=version.content_hash in blobs_before,
+                content_hash=version.content_hash,
+                version_number=version.version_number
+            )
+            # A longer chain could push later deltas past MAX_CHAIN_LENGTH
+            if encoded.delta is not None and encoded.chain_length > version.chain_length:
+                encoded.delta, encoded.base_id, encoded.chain_length = None, None, 0
+            if encoded.delta is None:
+                storage.save_blobs(db, [contents[version.id]])
+            chain_lengths[version.id] = encoded.chain_length
+            reclaimed += _delta_bytes(version.delta) - _delta_bytes(encoded.delta)
+            db.execute(
+                update(DBNoteVersion).where(DBNoteVersion.id == version.id).values(
+                    delta=encoded.delta,
+                    base_id=encoded.base_id,
+                    chain_length=encoded.chain_length
+                ),
+                execution_options={"synchronize_session": False}
+            )
+
+    db.execute(
+        delete(DBNoteVersion).where(DBNoteVersion.id.in_(doomed)),
+        execution_options={"synchronize_session": False}
+    )
+    reclaimed += sum(blobs_before.values()) - sum(_blob_bytes(db, hashes).values())
+    db.commit()
+    return len(doomed), len(orphans), reclaimed
+
+
+def compact(
+    session_factory: Callable[[], Session],
+    policy: RetentionPolicy,
+    now: Optional[datetime.datetime] = None,
+    batch_size: int = NOTES_PER_BATCH,
+    dry_run: bool = False,
+    on_compacted: Optional[Callable[[int], None]] = None
+) -> CompactionReport:
+    """
+    Apply a policy to every note. on_compacted is called with the id of each
+    note whose history changed, e.g. to invalidate caches. With dry_run the
+    versions to delete are only counted.
+    """
+    now = now or datetime.datetime.utcnow()
+    report = CompactionReport()
+    if not policy.enabled:
+        return report
+
+    after_id = 0
+    while True:
+        with session_factory() as db:
+            note_ids = db.execute(
+                select(DBNote.id).where(DBNote.id > after_id).order_by(DBNote.id).limit(batch_size)
+            ).scalars().all()
+            if not note_ids:
+                break
+            headers = db.execute(
+                select(DBNoteVersion.id, DBNoteVersion.note_id, DBNoteVersion.created_at, DBNoteVersion.size)
+                .where(DBNoteVersion.note_id.in_(note_ids))
+                .order_by(DBNoteVersion.note_id, DBNoteVersion.version_number)
+            ).all()
+        after_id = note_ids[-1]
+        report.notes_scanned += len(note_ids)
+
+        for note_id, versions in groupby(headers, key=attrgetter("note_id")):
+            planned = policy.prune(list(versions), now)
+            if not planned:
+                continue
+            if dry_run:
+                report.notes_compacted += 1
+                report.versions_deleted += len(planned)
+                continue
+            # The plan is redone under the lock, against the history as it is then
+            with session_factory() as db:
+                deleted, rebased, reclaimed = compact_note(db, note_id, policy, now)
+            if deleted:
+                report.notes_compacted += 1
+                report.versions_deleted += deleted
+                report.versions_rebased += rebased
+                report.bytes_reclaimed += reclaimed
+                if on_compacted is not None:
+                    on_compacted(note_id)
+    return report
+
+
+def free_space(bind) -> Tuple[int, int]:
+    """Free pages in the database file and the page size"""
+    with bind.connect() as conn:
+        return (
+            conn.execute(text("PRAGMA freelist_count")).scalar(),
+            conn.execute(text("PRAGMA page_size")).scalar(),
+        )
+
+
+def incremental_vacuum(bind, pages: Optional[int] = None) -> int:
+    """
+    Return free pages to the filesystem, at most pages of them (all by
+    default), VACUUM_PAGES per transaction so writers are never held up long.
+    Returns the bytes released; 0 unless auto_vacuum is INCREMENTAL.
+    """
+    with bind.connect() as conn:
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:  # INCREMENTAL
+            return 0
+    free_before, page_size = free_space(bind)
+    remaining = free_before if pages is None else min(pages, free_before)
+    while remaining > 0:
+        step = min(remaining, VACUUM_PAGES)
+        with bind.begin() as conn:
+            # The sqlite3 module only steps the pragma once, which frees one page
+            for _ in range(step):
+                conn.exec_driver_sql("PRAGMA incremental_vacuum(1)")
+        remaining -= step
+    free_after, _ = free_space(bind)
+    return (free_before - free_after) * page_size
+
+
+def enable_incremental_vacuum(bind) -> None:
+    """
+    Switch an existing database to auto_vacuum=INCREMENTAL. This rewrites the
+    whole file with VACUUM, locking it meanwhile, so it is a one-off step.
+    """
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+
+def run(session_factory, bind, policy: RetentionPolicy, **options) -> CompactionReport:
+    """Compact every note, then return the freed pages to the filesystem"""
+    report = compact(session_factory, policy, **options)
+    if report.versions_deleted and not options.get("dry_run"):
+        report.bytes_vacuumed = incremental_vacuum(bind)
+    return report
+
+
+def start_compaction(
+    session_factory,
+    bind,
+    policy: RetentionPolicy,
+    interval: float,
+    on_compacted: Optional[Callable[[int], None]] = None
+) -> threading.Thread:
+    """Compact every interval seconds in a daemon thread"""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                report = run(session_factory, bind, policy, on_compacted=on_compacted)
+            except Exception:
+                logger.exception("History compaction failed")
+                continue
+            if report.versions_deleted:
+                logger.info("History compacted", extra=report.as_dict())
+
+    thread = threading.Thread(target=loop, name="history-compaction", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import SessionLocal, create_tables, engine
+
+    defaults = RetentionPolicy.from_env()
+    parser = argparse.ArgumentParser(description="Prune old versions of notes and reclaim their space")
+    parser.add_argument("--keep-last", type=int, default=defaults.keep_last, help="Keep the N latest versions")
+    parser.add_argument("--hourly-after", type=float, help="Past this many hours, keep one version per hour")
+    parser.add_argument("--daily-after", type=float, help="Past this many days, keep one version per day")
+    parser.add_argument("--max-size", type=int, default=defaults.max_size, help="Characters of history per note")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the versions to delete")
+    parser.add_argument("--vacuum", action="store_true", help="Also return free pages to the filesystem")
+    parser.add_argument(
+        "--enable-incremental-vacuum", action="store_true",
+        help="Switch the database to auto_vacuum=INCREMENTAL first (rewrites the whole file)"
+    )
+    args = parser.parse_args()
+
+    policy = RetentionPolicy(
+        keep_last=args.keep_last,
+        hourly_after=datetime.timedelta(hours=args.hourly_after) if args.hourly_after else defaults.hourly_after,
+        daily_after=datetime.timedelta(days=args.daily_after) if args.daily_after else defaults.daily_after,
+        max_size=args.max_size,
+    )
+    create_tables()
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(engine)
+    report = compact(SessionLocal, policy, dry_run=args.dry_run)
+    if args.vacuum and not args.dry_run:
+        report.bytes_vacuumed = incremental_vacuum(engine)
+    free_pages, page_size = free_space(engine)
+
+    verb = "Would delete" if args.dry_run else "Deleted"
+    print(
+        f"{verb} {report.versions_deleted} versions of {report.notes_compacted} notes "
+        f"({report.notes_scanned} scanned), rebased {report.versions_rebased}, "
+        f"reclaimed {report.bytes_reclaimed} bytes of version bodies"
+    )
+    print(f"Returned {report.bytes_vacuumed} bytes to the filesystem; {free_pages * page_size} bytes free in the file")
@@ -0,0 +1,113 @@
+"""
+JSON responses built straight from database rows.
+
+Notes, versions and summaries are read from the database, which only ever
+holds what the request models validated on the way in, so their responses
+skip the response models: rows become plain dicts shaped like the models in
+models.py and are encoded once. orjson is used when installed and the json
+module otherwise; both encode naive datetimes the way pydantic does.
+"""
+import datetime
+import json
+from typing import Any, List, Optional
+
+from starlette.responses import Response
+
+from observability import serializing
+
+try:
+    import orjson
+except ImportError:  # Optional, see README.md
+    orjson = None
+
+
+def dumps(value: Any) -> bytes:
+    """Encode a value as compact UTF-8 JSON"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _default(value: Any) -> str:
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JSONResponse(Response):
+    """JSON response encoded with dumps(), counted as serialization time"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        with serializing():
+            return dumps(content)
+
+
+def version_dict(version, content: str) -> dict:
+    """A NoteVersion, from a version row and its rebuilt content"""
+    return {
+        "id": version.id,
+        "note_id": version.note_id,
+        "version_number": version.version_number,
+        "title": version.title,
+        "content": content,
+        "created_at": version.created_at,
+    }
+
+
+def version_header_dict(version) -> dict:
+    """A NoteVersionHeader, from a version row"""
+    return {
+        "id": version.id,
+        "note_id": version.note_id,
+        "version_number": version.version_number,
+        "title": version.title,
+        "created_at": version.created_at,
+        "size": version.size,
+    }
+
+
+def note_dict(note, versions: List[dict]) -> dict:
+    """A Note or NoteDetail, from a note row and its versions as dicts"""
+    return {
+        "title": note.title,
+        "content": note.content,
+        "id": note.id,
+        "created_at": note.created_at,
+        "updated_at": note.updated_at,
+        "versions": versions,
+    }
+
+
+def summary_dict(row, versions: Optional[list] = None) -> dict:
+    """A NoteSummary, from a row of summary columns"""
+    return {
+        "id": row.id,
+        "title": row.title,
+        "excerpt": row.excerpt,
+        "created_at": row.created_at,
+        "updated_at": row.updated_at,
+        "versions": versions,
+    }
+
+
+def version_summary_dict(row) -> dict:
+    """A NoteVersionSummary, from a row of version metadata columns"""
+    return {
+        "id": row.id,
+        "note_id": row.note_id,
+        "version_number": row.version_number,
+        "created_at": row.created_at,
+    }
+
+
+def change_dict(row) -> dict:
+    """A NoteChange, from a note_events row"""
+    return {
+        "id": row.id,
+        "note_id": row.note_id,
+        "version_id": row.version_id,
+        "kind": row.kind,
+        "updated_at": row.updated_at,
+    }
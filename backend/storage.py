@@ -0,0 +1,348 @@
+"""
+Storage of version bodies.
+
+In "delta" mode (the default) a version's content is stored either as a full
+snapshot or as a forward delta against the previous version of the same note.
+A snapshot is written at least every MAX_CHAIN_LENGTH versions, so rebuilding
+any version never applies more than MAX_CHAIN_LENGTH deltas.
+In "full" mode every version keeps its complete content, as before.
+
+Snapshots are content-addressed: the version points at the version_blobs row
+keyed by the SHA-256 of its content, which every version with the same
+content shares, in any note. A version whose content is already in a blob
+(a revert, or an edit back to an earlier state) is stored as a pointer to it
+rather than as a delta.
+
+Autosaving editors name their session in X-Edit-Session. Edits from the same
+session within AUTOSAVE_WINDOW seconds of the head version are folded into
+that version (see encode_rewrite()) instead of each adding a version.
+"""
+import datetime
+import hashlib
+import json
+import os
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, aliased, undefer, undefer_group
+
+from database import DBNoteVersion, DBVersionBlob
+from utils import matching_blocks
+
+STORAGE_MODE = os.environ.get("NOTES_VERSION_STORAGE", "delta")
+MAX_CHAIN_LENGTH = int(os.environ.get("NOTES_MAX_DELTA_CHAIN", "16"))
+
+# A delta is only kept if it is smaller than this fraction of the full content
+MAX_DELTA_RATIO = 0.5
+
+# Seconds after its creation during which a version takes further edits of
+# its editor session, 0 switches coalescing off
+AUTOSAVE_WINDOW = float(os.environ.get("NOTES_AUTOSAVE_WINDOW", "0"))
+
+
+def make_delta(old_content: str, new_content: str) -> str:
+    """
+    Encode new_content as a delta against old_content.
+
+    The delta is a JSON list of operations over "\\n"-separated lines:
+    [start, count] copies count lines of the old content starting at start,
+    and a string inserts its lines verbatim.
+    """
+    old_lines = old_content.split("\n")
+    new_lines = new_content.split("\n")
+
+    ops: List[object] = []
+    j = 0
+    for block_i, block_j, size in matching_blocks(old_lines, new_lines):
+        if block_j > j:  # Deleted lines are simply not copied
+            ops.append("\n".join(new_lines[j:block_j]))
+        ops.append([block_i, size])
+        j = block_j + size
+    if j < len(new_lines):
+        ops.append("\n".join(new_lines[j:]))
+
+    return json.dumps(ops, separators=(",", ":"))
+
+
+def apply_delta(base_content: str, delta: str) -> str:
+    """
+    Rebuild a content from its base and a delta produced by make_delta.
+    """
+    base_lines = base_content.split("\n")
+    lines: List[str] = []
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            lines.extend(op.split("\n"))
+        else:
+            start, count = op
+            lines.extend(base_lines[start:start + count])
+    return "\n".join(lines)
+
+
+def delta_blocks(delta: str) -> List[Tuple[int, int, int]]:
+    """
+    The lines a delta copies from its base, as matching blocks
+    (base_index, index, length) over "\\n"-separated lines.
+    """
+    blocks: List[Tuple[int, int, int]] = []
+    position = 0
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            position += op.count("\n") + 1
+        else:
+            start, count = op
+            blocks.append((start, position, count))
+            position += count
+    return blocks
+
+
+def content_hash(content: str) -> str:
+    """Key of a content in version_blobs"""
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def build_version(
+    note_id: int,
+    title: str,
+    content: str,
+    head: Optional[DBNoteVersion] = None,
+    head_content: Optional[str] = None,
+    shared: bool = False,
+    **fields
+) -> DBNoteVersion:
+    """
+    Build a new version of a note, stored as a delta against the current head
+    version when that is worthwhile, and as a pointer to the blob of its
+    content otherwise. The caller saves that blob, see save_blobs().
+
+    head is the latest existing version of the note and head_content its full
+    content (the note's content before this change). shared says a blob
+    already holds the content, so pointing at it costs nothing. Unless given,
+    the version number is assigned by the INSERT itself.
+    """
+    if "version_number" not in fields:
+        fields["version_number"] = next_version_number(note_id)
+    fields.setdefault("content_hash", content_hash(content))
+    version = DBNoteVersion(note_id=note_id, title=title, size=len(content), **fields)
+
+    if (
+        STORAGE_MODE == "delta"
+        and not shared
+        and head is not None
+        and head_content is not None
+        and (head.chain_length or 0) < MAX_CHAIN_LENGTH
+    ):
+        delta = make_delta(head_content, content)
+        if len(delta) < len(content) * MAX_DELTA_RATIO:
+            version.delta = delta
+            version.base_id = head.id
+            version.chain_length = (head.chain_length or 0) + 1
+            return version
+
+    version.delta = None
+    version.base_id = None
+    version.chain_length = 0
+    return version
+
+
+def save_blobs(db, contents: Iterable[str]) -> None:
+    """
+    Store the contents of versions that are not deltas, once per distinct
+    content. db is a Session or a Connection. This must run before the
+    versions are inserted, as their triggers count the references.
+    """
+    rows = {content_hash(content): content for content in contents}
+    if rows:
+        db.execute(
+            sqlite_insert(DBVersionBlob).on_conflict_do_nothing(),
+            [{"hash": digest, "content": content, "refcount": 0} for digest, content in rows.items()]
+        )
+
+
+def add_version(
+    db: Session,
+    note_id: Optional[int],
+    title: str,
+    content: str,
+    head: Optional[DBNoteVersion] = None,
+    head_content: Optional[str] = None,
+    **fields
+) -> DBNoteVersion:
+    """
+    Build a version with build_version(), save its blob if it points at one
+    and add it to the session.
+    """
+    digest = content_hash(content)
+    shared = _blob_exists(db, digest)
+    version = build_version(
+        note_id, title, content, head=head, head_content=head_content, shared=shared,
+        content_hash=digest, **fields
+    )
+    if version.delta is None and not shared:
+        save_blobs(db, [content])
+    db.add(version)
+    return version
+
+
+def encode_rewrite(db: Session, version: DBNoteVersion, title: str, content: str) -> DBNoteVersion:
+    """
+    Encode a new title and content for a note's head version, to store with
+    rewrite_version(). Nothing is stored against the head, so it is simply
+    re-encoded against its own base (or as a snapshot if it was one). This
+    only reads, so it can run before the write lock is taken.
+    """
+    base = base_content = None
+    if version.delta is not None:
+        # Deltas are only read for the base's id and chain length, which
+        # the head already tells; its content is rebuilt along the head's
+        base = SimpleNamespace(id=version.base_id, chain_length=version.chain_length - 1)
+        base_content = load_contents(db, [version])[version.base_id]
+    digest = content_hash(content)
+    return build_version(
+        version.note_id, title, content, head=base, head_content=base_content, shared=_blob_exists(db, digest),
+        content_hash=digest, version_number=version.version_number
+    )
+
+
+def rewrite_version(db: Session, version: DBNoteVersion, content: str, encoded: DBNoteVersion) -> DBNoteVersion:
+    """
+    Replace the content of a note's head version in place with an encoding
+    from encode_rewrite(), for an edit coalesced into it. The blob triggers
+    move its reference if it points at a blob.
+    """
+    if encoded.delta is None:
+        save_blobs(db, [content])  # Also when shared, in case the blob went since
+    version.title = encoded.title
+    version.content_hash = encoded.content_hash
+    version.delta = encoded.delta
+    version.base_id = encoded.base_id
+    version.chain_length = encoded.chain_length
+    version.size = encoded.size
+    version.edits = (version.edits or 1) + 1
+    return version
+
+
+def coalesces(head: Optional[DBNoteVersion], edit_session: Optional[str], now: datetime.datetime) -> bool:
+    """Whether an edit by edit_session at now goes into the head version"""
+    return (
+        AUTOSAVE_WINDOW > 0
+        and head is not None
+        and edit_session is not None
+        and head.edit_session == edit_session
+        and now - head.created_at < datetime.timedelta(seconds=AUTOSAVE_WINDOW)
+    )
+
+
+def settled(version, now: datetime.datetime) -> bool:
+    """
+    Whether a version can no longer change. Until AUTOSAVE_WINDOW has passed,
+    a version written by an editor session may still take its edits.
+    """
+    return (
+        AUTOSAVE_WINDOW <= 0
+        or version.edit_session is None
+        or now - version.created_at >= datetime.timedelta(seconds=AUTOSAVE_WINDOW)
+    )
+
+
+def _blob_exists(db: Session, digest: str) -> bool:
+    return db.execute(select(DBVersionBlob.hash).where(DBVersionBlob.hash == digest)).first() is not None
+
+
+def next_version_number(note_id: int):
+    """
+    SQL expression for the next version number of a note. It is evaluated
+    inside the INSERT statement, so two writers can never be handed the same
+    number; the unique (note_id, version_number) index backs this up.
+    """
+    return select(
+        func.coalesce(func.max(DBNoteVersion.version_number), 0) + 1
+    ).where(DBNoteVersion.note_id == note_id).scalar_subquery()
+
+
+def latest_version(db: Session, note_id: int, delta: bool = False) -> Optional[DBNoteVersion]:
+    """
+    Get the most recent version of a note, which new deltas are based on,
+    with its delta if asked (for encode_rewrite()).
+    """
+    query = db.query(DBNoteVersion)
+    if delta:
+        query = query.options(undefer(DBNoteVersion.delta))
+    return query.filter(
+        DBNoteVersion.note_id == note_id
+    ).order_by(DBNoteVersion.version_number.desc()).first()
+
+
+def load_contents(db: Session, versions: Iterable[DBNoteVersion]) -> Dict[int, str]:
+    """
+    Rebuild the full content of the given versions, keyed by version id.
+    Versions may be ORM objects or rows with id, content, delta and base_id.
+    Missing bases of delta chains are fetched with a single recursive query.
+    """
+    rows: Dict[int, DBNoteVersion] = {v.id: v for v in versions}
+
+    missing = {v.base_id for v in rows.values() if v.delta is not None} - rows.keys()
+    if missing:
+        chain = select(DBNoteVersion.id, DBNoteVersion.base_id).where(
+            DBNoteVersion.id.in_(missing)
+        ).cte("chain", recursive=True)
+        parent = aliased(DBNoteVersion)
+        chain = chain.union(
+            select(parent.id, parent.base_id).join(chain, parent.id == chain.c.base_id)
+        )
+        bases = db.query(DBNoteVersion).options(undefer_group("body")).filter(
+            DBNoteVersion.id.in_(select(chain.c.id))
+        ).all()
+        for base in bases:
+            rows[base.id] = base
+
+        unresolved = {v.base_id for v in rows.values() if v.delta is not None} - rows.keys()
+        if unresolved:
+            raise LookupError(f"Missing base versions: {sorted(unresolved)}")
+
+    contents: Dict[int, str] = {}
+    for version_id in rows:
+        # Walk down to the nearest resolved version, then apply deltas back up
+        chain = []
+        current = rows[version_id]
+        while current.id not in contents and current.delta is not None:
+            chain.append(current)
+            current = rows[current.base_id]
+        content = contents.get(current.id, current.content)
+        contents[current.id] = content
+        for version in reversed(chain):
+            content = apply_delta(content, version.delta)
+            contents[version.id] = content
+
+    return contents
+
+
+def load_content(db: Session, version: DBNoteVersion) -> str:
+    """
+    Rebuild the full content of a single version.
+    """
+    return load_contents(db, [version])[version.id]
+
+
+def encode_history(versions: List[DBNoteVersion], contents: Dict[int, str]) -> None:
+    """
+    Re-encode a note's versions (oldest first) in place according to the
+    current storage mode, given their full contents. The caller saves the
+    blobs of those that are not deltas.
+    """
+    head = None
+    for version in versions:
+        content = contents[version.id]
+        encoded = build_version(
+            version.note_id, version.title, content,
+            head=head, head_content=contents[head.id] if head is not None else None,
+            version_number=version.version_number
+        )
+        version.content_hash = encoded.content_hash
+        version.delta = encoded.delta
+        version.base_id = encoded.base_id
+        version.chain_length = encoded.chain_length
+        version.size = encoded.size
+        head = version
@@ -1,11 +1,41 @@
+import asyncio
+import datetime
+import json
+import logging
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from types import SimpleNamespace
+
+import httpx
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool, StaticPool
+from sqlalchemy.schema import CreateTable
 
-from database import Base
-from main import app, get_db
+import main
+import serialization
+import storage
+from database import (
+    NOTE_EVENTS_DDL, NOTES_FTS_DDL, VERSION_BLOBS_DDL, Base, DBNoteVersion, configure_sqlite, create_tables,
+    sqlite_pragmas
+)
+from cache import LocalCacheBackend, NoteCache
+from changes import ChangeFeed
+from compression import negotiate
+from main import _apply_write, _invalidate_caches_blocking, app, get_db
+from migrations import MIGRATIONS, run_migrations
+from models import Note, NoteBatchGetResult, NoteDetail, NotePage, NoteVersion, VersionBatchGetResult
+from observability import JSONFormatter
+from retention import RetentionPolicy, compact, compact_note, enable_incremental_vacuum, free_space, incremental_vacuum
+from transfer import export_notes, import_batch
+from utils import compare_versions
+from writer import GroupCommitWriter, immediate_engine
 
 # Create in-memory database for testing
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -16,16 +46,17 @@ engine = create_engine(
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# Create tables for testing
-Base.metadata.create_all(bind=engine)
+# The API itself uses an async session on the same database
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Create tables for testing, migrating a test database left by an older run
+create_tables(engine)
 
 # Replace the get_db dependency with a test version
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with TestingAsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 app.dependency_overrides[get_db] = override_get_db
 
@@ -159,6 +190,1341 @@ def test_delete_note():
     assert response.status_code == 404
 
 
+def test_list_notes_pagination():
+    # Create a few notes so there is more than one page
+    created_ids = {test_create_note() for _ in range(3)}
+
+    # Walk every page and collect the ids
+    seen_ids = []
+    updated = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/notes", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= 2
+        for item in page["items"]:
+            assert "excerpt" in item
+            assert item["versions"] is None  # No versions unless requested
+            seen_ids.append(item["id"])
+            updated.append(item["updated_at"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    # Every note appears exactly once, most recently updated first
+    assert len(seen_ids) == len(set(seen_ids))
+    assert created_ids <= set(seen_ids)
+    assert updated == sorted(updated, reverse=True)
+
+    # Version metadata is only included on request
+    response = client.get("/notes", params={"limit": 1, "include": "versions"})
+    assert response.status_code == 200
+    item = response.json()["items"][0]
+    assert len(item["versions"]) >= 1
+    assert "content" not in item["versions"][0]
+
+    # Malformed cursors and unknown includes are rejected
+    assert client.get("/notes", params={"cursor": "not-a-cursor"}).status_code == 400
+    assert client.get("/notes", params={"include": "everything"}).status_code == 400
+
+
+def test_delta_version_history():
+    # A long note edited one line at a time is stored as a chain of deltas
+    lines = [f"line {i}" for i in range(50)]
+    response = client.post("/notes", json={"title": "Delta Note", "content": "\n".join(lines)})
+    assert response.status_code == 201
+    note_id = response.json()["id"]
+
+    expected = ["\n".join(lines)]
+    for i in range(40):
+        lines[i] = f"edited line {i}"
+        if i % 7 == 0:
+            lines.append(f"appended {i}")
+        content = "\n".join(lines)
+        response = client.put(f"/notes/{note_id}", json={"title": "Delta Note", "content": content})
+        assert response.status_code == 200
+        expected.append(content)
+
+    # Every version is rebuilt exactly
+    response = client.get(f"/notes/{note_id}/versions")
+    assert response.status_code == 200
+    versions = response.json()
+    assert [v["content"] for v in reversed(versions)] == expected
+
+    oldest_id = versions[-1]["id"]
+    response = client.get(f"/notes/{note_id}/versions/{oldest_id}")
+    assert response.json()["content"] == expected[0]
+
+    # Most rows are deltas and no chain exceeds the configured bound
+    db = TestingSessionLocal()
+    try:
+        rows = db.query(DBNoteVersion).filter(DBNoteVersion.note_id == note_id).all()
+        assert sum(1 for row in rows if row.delta is not None) > len(rows) // 2
+        assert max(row.chain_length for row in rows) <= storage.MAX_CHAIN_LENGTH
+    finally:
+        db.close()
+
+
+def test_note_version_headers():
+    note_id = test_create_note()
+    client.put(f"/notes/{note_id}", json={"title": "Headers", "content": "Second version\nof the note"})
+
+    # Versions come as headers, their bodies on demand
+    note = client.get(f"/notes/{note_id}")
+    versions = note.json()["versions"]
+    assert [v["version_number"] for v in versions] == [1, 2]
+    assert all("content" not in v for v in versions)
+    assert [v["size"] for v in versions] == [len("This is a test note"), len("Second version\nof the note")]
+    body = client.get(f"/notes/{note_id}/versions/{versions[1]['id']}").json()
+    assert body["content"] == "Second version\nof the note"
+
+    # embed=versions gives the full history, under its own ETag
+    embedded = client.get(f"/notes/{note_id}", params={"embed": "versions"})
+    assert [v["content"] for v in embedded.json()["versions"]] == ["This is a test note", "Second version\nof the note"]
+    assert embedded.headers["etag"] != note.headers["etag"]
+    assert client.get(
+        f"/notes/{note_id}", params={"embed": "versions"}, headers={"If-None-Match": embedded.headers["etag"]}
+    ).status_code == 304
+    assert client.get(f"/notes/{note_id}", params={"embed": "bodies"}).status_code == 400
+
+    # Loading versions leaves their bodies out unless asked for
+    db = TestingSessionLocal()
+    try:
+        row = db.query(DBNoteVersion).filter(DBNoteVersion.note_id == note_id).first()
+        assert {"content", "delta"} <= inspect(row).unloaded
+    finally:
+        db.close()
+
+
+def test_shared_version_blobs():
+    first = "\n".join(f"shared line {i}" for i in range(30))
+    second = "\n".join(f"other line {i}" for i in range(30))
+    note_id = client.post("/notes", json={"title": "Shared", "content": first}).json()["id"]
+    client.put(f"/notes/{note_id}", json={"title": "Shared", "content": second})
+    versions = client.get(f"/notes/{note_id}/versions").json()
+    reverted = client.post(f"/notes/{note_id}/revert/{versions[-1]['id']}").json()
+    other_id = client.post("/notes", json={"title": "Copy", "content": first}).json()["id"]
+
+    def blobs():
+        with engine.connect() as conn:
+            return dict(conn.execute(text("SELECT hash, refcount FROM version_blobs WHERE hash IN (:a, :b)"), {
+                "a": storage.content_hash(first), "b": storage.content_hash(second)
+            }).all())
+
+    # The revert and the other note point at the first version's blob
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT content_hash, delta IS NULL FROM note_versions WHERE note_id = :note_id ORDER BY version_number"
+        ), {"note_id": note_id}).all()
+    assert rows == [(storage.content_hash(first), 1), (storage.content_hash(second), 1), (storage.content_hash(first), 1)]
+    assert blobs() == {storage.content_hash(first): 3, storage.content_hash(second): 1}
+    assert reverted["versions"][-1]["content"] == first
+
+    # Versions with the same content diff as unchanged, whatever lies between
+    diff = client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 3}).json()
+    assert diff["title_changed"] is False
+    assert [line["type"] for line in diff["content_diff"]] == ["unchanged"] * 30
+    diff = client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 3, "format": "hunks"}).json()
+    assert diff["hunk_count"] == 0
+
+    # Blobs go with the last version pointing at them
+    client.delete(f"/notes/{other_id}")
+    assert blobs() == {storage.content_hash(first): 2, storage.content_hash(second): 1}
+    client.delete(f"/notes/{note_id}")
+    assert blobs() == {}
+
+
+def test_migrate_version_sizes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'sizes.db'}")
+    contents = ["\n".join(f"row {j} rev {i if j == i else 0}" for j in range(30)) for i in range(10)]
+    try:
+        run_migrations(engine)
+        with sessionmaker(bind=engine)() as db:
+            import_batch(db, [{
+                "title": "Sized", "content": contents[-1],
+                "created_at": datetime.datetime(2024, 1, 1), "updated_at": datetime.datetime(2024, 1, 1),
+                "versions": [{"title": "Sized", "content": c, "created_at": datetime.datetime(2024, 1, 1)} for c in contents],
+            }])
+            db.commit()
+
+        # A database from before sizes were recorded, with snapshots stored inline
+        with engine.begin() as conn:
+            for trigger in ("insert", "delete", "update"):
+                conn.execute(text(f"DROP TRIGGER version_blobs_{trigger}"))
+            conn.execute(text("ALTER TABLE note_versions ADD COLUMN content VARCHAR"))
+            conn.execute(text(
+                "UPDATE note_versions SET content = (SELECT content FROM version_blobs WHERE hash = content_hash) "
+                "WHERE delta IS NULL"
+            ))
+            conn.execute(text("ALTER TABLE note_versions DROP COLUMN size"))
+            conn.execute(text("ALTER TABLE note_versions DROP COLUMN content_hash"))
+            conn.execute(text("DROP TABLE version_blobs"))
+            conn.execute(text("PRAGMA user_version = 4"))
+        assert run_migrations(engine) == [description for number, description, _ in MIGRATIONS if number > 4]
+        with engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT size, delta IS NOT NULL, content_hash FROM note_versions ORDER BY version_number"
+            )).all()
+            blobs = dict(conn.execute(text("SELECT hash, refcount FROM version_blobs")).all())
+        assert [size for size, _, _ in rows] == [len(c) for c in contents]
+        assert any(is_delta for _, is_delta, _ in rows)
+        assert [digest for _, _, digest in rows] == [storage.content_hash(c) for c in contents]
+        assert blobs == {digest: 1 for _, is_delta, digest in rows if not is_delta}
+        assert "content" not in {column["name"] for column in inspect(engine).get_columns("note_versions")}
+    finally:
+        engine.dispose()
+
+
+def test_migrate_stable_ids(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'ids.db'}")
+
+    def add_note(title):
+        with sessionmaker(bind=engine)() as db:
+            note_id, = import_batch(db, [{
+                "title": title, "content": f"{title} content",
+                "created_at": datetime.datetime(2024, 1, 1), "updated_at": datetime.datetime(2024, 1, 1),
+                "versions": [{"title": title, "content": f"{title} content", "created_at": datetime.datetime(2024, 1, 1)}],
+            }])
+            db.commit()
+        return note_id
+
+    def delete_note(conn, note_id):
+        conn.execute(text("DELETE FROM notes WHERE id = :id"), {"id": note_id})
+        conn.execute(text("DELETE FROM note_versions WHERE note_id = :id"), {"id": note_id})
+
+    try:
+        # A database from before ids were kept from reuse
+        with engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                ddl = str(CreateTable(table).compile(dialect=conn.dialect))
+                if table.name in ("notes", "note_versions"):
+                    ddl = ddl.replace(" AUTOINCREMENT", "")
+                conn.execute(text(ddl))
+            for statement in VERSION_BLOBS_DDL + NOTES_FTS_DDL + NOTE_EVENTS_DDL:
+                conn.execute(text(statement))
+            conn.execute(text("PRAGMA user_version = 9"))
+        kept, deleted = add_note("Kept"), add_note("Deleted")
+        with engine.begin() as conn:
+            deleted_version = conn.execute(text("SELECT max(id) FROM note_versions")).scalar()
+            delete_note(conn, deleted)
+            events = conn.execute(text("SELECT count(*) FROM note_events")).scalar()
+            blobs = conn.execute(text("SELECT hash, refcount FROM version_blobs")).all()
+
+        assert run_migrations(engine) == ["stable ids"]
+        assert run_migrations(engine) == []
+        with engine.connect() as conn:
+            # Rows, their search index and blob counts are untouched, and no events were recorded
+            assert conn.execute(text("SELECT id, title FROM notes")).all() == [(kept, "Kept")]
+            assert conn.execute(text("SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'kept'")).scalars().all() == [kept]
+            assert conn.execute(text("SELECT hash, refcount FROM version_blobs")).all() == blobs
+            assert conn.execute(text("SELECT count(*) FROM note_events")).scalar() == events
+
+        # The ids of the note deleted before the migration are not handed out again
+        new = add_note("New")
+        with engine.begin() as conn:
+            assert new > deleted
+            assert conn.execute(text("SELECT min(id) FROM note_versions WHERE note_id = :id"), {"id": new}).scalar() > deleted_version
+            delete_note(conn, new)
+        assert add_note("Newer") > new
+    finally:
+        engine.dispose()
+
+
+def test_migrate_full_versions_to_deltas(tmp_path):
+    # Database with the original schema, where every version stores its full content
+    old_engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with old_engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE notes (id INTEGER PRIMARY KEY, title VARCHAR NOT NULL, "
+            "content VARCHAR NOT NULL, created_at DATETIME, updated_at DATETIME)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE note_versions (id INTEGER PRIMARY KEY, note_id INTEGER "
+            "REFERENCES notes(id) ON DELETE CASCADE, title VARCHAR NOT NULL, "
+            "content VARCHAR NOT NULL, created_at DATETIME)"
+        ))
+        conn.execute(text("CREATE INDEX ix_note_versions_id ON note_versions (id)"))
+        conn.execute(text("INSERT INTO notes VALUES (1, 'Old', 'x', '2024-01-01 00:00:00', '2024-01-01 00:00:00')"))
+        contents = ["\n".join(f"row {j} rev {min(j, i)}" for j in range(30)) for i in range(20)]
+        for i, content in enumerate(contents):
+            conn.execute(
+                text("INSERT INTO note_versions VALUES (:id, 1, 'Old', :content, '2024-01-01 00:00:00')"),
+                {"id": i + 1, "content": content}
+            )
+
+    assert run_migrations(old_engine) == [description for _, description, _ in MIGRATIONS]
+    assert run_migrations(old_engine) == []  # Already up to date
+    index_names = {index["name"] for index in inspect(old_engine).get_indexes("note_versions")}
+    assert {"ix_note_versions_note_id_created_at", "ix_note_versions_note_id_id"} <= index_names
+    with old_engine.connect() as conn:
+        assert conn.execute(text("SELECT rowid FROM notes_fts WHERE notes_fts MATCH 'old'")).all() == [(1,)]
+        # Copying the history over is not a change to the note
+        assert conn.execute(text("SELECT count(*) FROM note_events")).scalar() == 0
+
+    db = sessionmaker(bind=old_engine)()
+    try:
+        rows = db.query(DBNoteVersion).order_by(DBNoteVersion.id).all()
+        assert any(row.delta is not None for row in rows)
+        rebuilt = storage.load_contents(db, rows)
+        assert [rebuilt[row.id] for row in rows] == contents
+        assert [row.size for row in rows] == [len(content) for content in contents]
+        assert [row.version_number for row in rows] == list(range(1, len(contents) + 1))
+    finally:
+        db.close()
+        old_engine.dispose()
+
+
+def test_conditional_writes():
+    note_id = test_create_note()
+    etag = client.get(f"/notes/{note_id}").headers["etag"]
+
+    # A write conditional on the current revision applies and gives the next ETag
+    response = client.put(f"/notes/{note_id}", json={"title": "First", "content": "First edit"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    next_etag = response.headers["etag"]
+    assert next_etag != etag
+    assert client.get(f"/notes/{note_id}").headers["etag"] == next_etag
+
+    # A stale ETag conflicts and nothing is written
+    response = client.put(f"/notes/{note_id}", json={"title": "Lost", "content": "Lost edit"}, headers={"If-Match": etag})
+    assert response.status_code == 409
+    first_version = client.get(f"/notes/{note_id}/versions").json()[-1]["id"]
+    assert client.post(f"/notes/{note_id}/revert/{first_version}", headers={"If-Match": etag}).status_code == 409
+    note = client.get(f"/notes/{note_id}").json()
+    assert note["content"] == "First edit" and len(note["versions"]) == 2
+
+    # Reverts are conditional too; an ETag of another note never matches, * always does
+    response = client.post(f"/notes/{note_id}/revert/{first_version}", headers={"If-Match": next_etag})
+    assert response.status_code == 200
+    assert client.put(
+        f"/notes/{note_id}", json={"title": "Other", "content": "Other"}, headers={"If-Match": '"note-0-1"'}
+    ).status_code == 409
+    assert client.put(
+        f"/notes/{note_id}", json={"title": "Any", "content": "Any revision"}, headers={"If-Match": "*"}
+    ).status_code == 200
+
+
+def test_no_lost_updates():
+    note_id = test_create_note()
+    writers, edits = 8, 5
+
+    def append_lines(worker):
+        # Read, append a line and write back conditionally, starting over on conflicts
+        local = TestClient(app)
+        conflicts = 0
+        for i in range(edits):
+            while True:
+                current = local.get(f"/notes/{note_id}")
+                content = current.json()["content"] + f"\nwriter {worker} edit {i}"
+                response = local.put(
+                    f"/notes/{note_id}", json={"title": "Contended", "content": content},
+                    headers={"If-Match": current.headers["etag"]}
+                )
+                if response.status_code == 200:
+                    break
+                assert response.status_code == 409
+                conflicts += 1
+        return conflicts
+
+    def overwrite(worker):
+        # Unconditional writes are retried on top of concurrent ones
+        response = TestClient(app).put(f"/notes/{note_id}", json={"title": "Overwritten", "content": f"overwrite {worker}"})
+        assert response.status_code == 200
+
+    with ThreadPoolExecutor(writers) as pool:
+        conflicts = sum(pool.map(append_lines, range(writers)))
+    note = client.get(f"/notes/{note_id}").json()
+    lines = note["content"].splitlines()
+    assert sorted(lines[1:]) == sorted(f"writer {w} edit {i}" for w in range(writers) for i in range(edits))
+    assert len(note["versions"]) == 1 + writers * edits
+    assert conflicts > 0
+
+    with ThreadPoolExecutor(writers) as pool:
+        list(pool.map(overwrite, range(writers)))
+    # Every write left exactly one version, each rebuilt to what was written
+    contents = [v["content"] for v in client.get(f"/notes/{note_id}/versions").json()]
+    assert len(contents) == 1 + writers * edits + writers
+    assert sorted(contents[:writers]) == sorted(f"overwrite {w}" for w in range(writers))
+    assert contents[writers] == note["content"]
+
+
+def test_autosave_coalescing(monkeypatch):
+    monkeypatch.setattr(storage, "AUTOSAVE_WINDOW", 60)
+    lines = [f"line {i}" for i in range(20)]
+    note_id = client.post("/notes", json={"title": "Autosaved", "content": "\n".join(lines)}).json()["id"]
+    session = {"X-Edit-Session": "editor-1"}
+
+    # The first autosave adds a version, which is not settled yet
+    lines.append("draft 0")
+    client.put(f"/notes/{note_id}", json={"title": "Autosaved", "content": "\n".join(lines)}, headers=session)
+    head = client.get(f"/notes/{note_id}").json()["versions"][-1]
+    response = client.get(f"/notes/{note_id}/versions/{head['id']}")
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.headers["ETag"]
+    range_etag = client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 2}).headers["ETag"]
+
+    # Later autosaves of the same session go into it, and its ETags change
+    for i in range(1, 4):
+        lines[i] = f"draft {i}"
+        response = client.put(
+            f"/notes/{note_id}", json={"title": f"Autosaved {i}", "content": "\n".join(lines)}, headers=session
+        )
+        assert response.status_code == 200
+    note = client.get(f"/notes/{note_id}").json()
+    assert [v["id"] for v in note["versions"]][-1] == head["id"] and len(note["versions"]) == 2
+    assert note["versions"][-1]["size"] == len(note["content"])
+    response = client.get(f"/notes/{note_id}/versions/{head['id']}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["content"] == "\n".join(lines) and response.json()["title"] == "Autosaved 3"
+    response = client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 2}, headers={"If-None-Match": range_etag})
+    assert response.status_code == 200
+    first = client.get(f"/notes/{note_id}/versions").json()[-1]
+    assert response.json() == compare_versions(first, client.get(f"/notes/{note_id}/versions/{head['id']}").json())
+    with TestingSessionLocal() as db:
+        assert db.get(DBNoteVersion, head["id"]).edits == 4
+
+    # Another session, no session and reverts each add a version
+    client.put(f"/notes/{note_id}", json={"title": "Other", "content": "other"}, headers={"X-Edit-Session": "editor-2"})
+    client.put(f"/notes/{note_id}", json={"title": "Plain", "content": "plain"})
+    client.post(f"/notes/{note_id}/revert/{head['id']}", headers=session)
+    client.put(f"/notes/{note_id}", json={"title": "Again", "content": "again"}, headers=session)
+    client.put(f"/notes/{note_id}", json={"title": "Again", "content": "again and again"}, headers=session)
+    versions = client.get(f"/notes/{note_id}/versions").json()
+    assert [v["content"] for v in versions[:2]] == ["again and again", "\n".join(lines)]
+    assert len(versions) == 6
+
+    # Past the window the head is settled, and the next autosave adds a version
+    with TestingSessionLocal() as db:
+        db.execute(text(
+            "UPDATE note_versions SET created_at = datetime(created_at, '-1 hour') WHERE note_id = :note_id"
+        ), {"note_id": note_id})
+        db.commit()
+    assert "immutable" in client.get(f"/notes/{note_id}/versions/{versions[0]['id']}").headers["Cache-Control"]
+    client.put(f"/notes/{note_id}", json={"title": "Again", "content": "the next day"}, headers=session)
+    assert len(client.get(f"/notes/{note_id}/versions").json()) == 7
+
+
+def test_group_commit_writer(monkeypatch):
+    bind = immediate_engine(SQLALCHEMY_DATABASE_URL)
+    writer = GroupCommitWriter(bind, delay_ms=20)
+    monkeypatch.setattr(main, "group_writer", writer)
+    note_ids = [test_create_note() for _ in range(4)]
+
+    def edit(i):
+        return TestClient(app).put(f"/notes/{note_ids[i % 4]}", json={"title": "Grouped", "content": f"edit {i}"})
+
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(edit, range(32)))
+    assert [response.status_code for response in responses] == [200] * 32
+    assert writer.jobs == 32 and writer.commits < 32
+    for note_id in note_ids:
+        versions = client.get(f"/notes/{note_id}/versions").json()
+        assert len(versions) == 9 and versions[0]["content"] == client.get(f"/notes/{note_id}").json()["content"]
+
+    # A write that fails is rolled back alone, the rest of its batch commits
+    async def batch():
+        return await asyncio.gather(
+            writer.submit(_apply_write, note_ids[0], "Kept", "kept", None, True, None),
+            writer.submit(_apply_write, 0, "Missing", "missing", None, True, None),
+            writer.submit(_apply_write, note_ids[1], "Stale", "stale", 1, True, None),
+            return_exceptions=True
+        )
+
+    commits = writer.commits
+    kept, missing, stale = asyncio.run(batch())
+    assert writer.commits == commits + 1
+    assert kept[0].content == "kept" and not kept[1]
+    assert (missing.status_code, stale.status_code) == (404, 409)
+    assert client.get(f"/notes/{note_ids[0]}/versions").json()[0]["content"] == "kept"
+    assert len(client.get(f"/notes/{note_ids[1]}/versions").json()) == 9
+    writer.close()
+    bind.dispose()
+
+
+async def _event_stream(headers, until):
+    """GET /notes:changes as server-sent events, until the body read so far satisfies until"""
+    body = b""
+    received = asyncio.Event()
+    gone = asyncio.Event()
+
+    async def receive():
+        if not received.is_set():
+            received.set()
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal body
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200
+        elif message["type"] == "http.response.body":
+            body += message.get("body", b"")
+            if until(body):
+                gone.set()
+
+    await app({
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": "/notes:changes", "raw_path": b"/notes:changes",
+        "root_path": "", "query_string": b"", "server": ("test", 80), "client": ("test", 1),
+        "headers": [(b"accept", b"text/event-stream")] + [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    }, receive, send)
+    return body
+
+
+def test_change_feed(monkeypatch):
+    monkeypatch.setattr(storage, "AUTOSAVE_WINDOW", 60)
+    monkeypatch.setattr(main, "change_feed", ChangeFeed())
+    start = client.get("/notes:changes").json()
+    assert start["changes"] == [] and not start["reset"]
+
+    # Creations, updates (coalesced autosaves too), reverts and deletions are all changes
+    session = {"X-Edit-Session": "editor-1"}
+    note = client.post("/notes", json={"title": "Followed", "content": "first"}).json()
+    client.put(f"/notes/{note['id']}", json={"title": "Followed", "content": "second"}, headers=session)
+    updated = client.put(f"/notes/{note['id']}", json={"title": "Followed", "content": "third"}, headers=session).json()
+    client.post(f"/notes/{note['id']}/revert/{note['versions'][0]['id']}")
+    client.delete(f"/notes/{note['id']}")
+    versions = [version["id"] for version in updated["versions"]]
+
+    page = client.get("/notes:changes", params={"after": start["cursor"]}).json()
+    changes = page["changes"]
+    assert [(c["kind"], c["version_id"]) for c in changes] == [
+        ("created", versions[0]), ("updated", versions[1]), ("updated", versions[1]),
+        ("updated", versions[1] + 1), ("deleted", None)
+    ]
+    assert {c["note_id"] for c in changes} == {note["id"]}
+    assert changes[2]["updated_at"] == updated["updated_at"]
+    assert [c["id"] for c in changes] == list(range(start["cursor"] + 1, start["cursor"] + 6))
+    assert page["cursor"] == changes[-1]["id"]
+    # Pages resume from their cursor
+    first = client.get("/notes:changes", params={"after": start["cursor"], "limit": 2}).json()
+    rest = client.get("/notes:changes", params={"after": first["cursor"]}).json()
+    assert first["changes"] + rest["changes"] == changes
+    assert client.get("/notes:changes", params={"after": page["cursor"]}).json() == {
+        "changes": [], "cursor": page["cursor"], "reset": False
+    }
+
+    # A waiting request gets a change made meanwhile, from another thread and event loop
+    with ThreadPoolExecutor(1) as pool:
+        waiting = pool.submit(client.get, "/notes:changes", params={"after": page["cursor"], "wait": 10})
+        while not main.change_feed.subscribers and not waiting.done():
+            pass
+        created = client.post("/notes", json={"title": "Awaited", "content": "new"}).json()
+        assert [c["note_id"] for c in waiting.result().json()["changes"]] == [created["id"]]
+    cursor = page["cursor"] + 1
+
+    # A stream catches up after Last-Event-ID, then pushes changes as they are committed
+    async def stream():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as writer:
+            async def write():
+                while b"id: %d" % cursor not in body:
+                    await asyncio.sleep(0.01)
+                await writer.put(f"/notes/{created['id']}", json={"title": "Awaited", "content": "pushed"})
+
+            body = b""
+            task = asyncio.create_task(write())
+
+            def until(received):
+                nonlocal body
+                body = received
+                return b"id: %d" % (cursor + 1) in received
+
+            await _event_stream({"Last-Event-ID": str(page["cursor"])}, until)
+            await task
+            return body
+
+    body = asyncio.run(stream())
+    events = [dict(line.split(": ", 1) for line in event.splitlines()) for event in body.decode().split("\n\n")[1:-1]]
+    assert [(e["id"], e["event"]) for e in events] == [(str(cursor), "created"), (str(cursor + 1), "updated")]
+    assert json.loads(events[1]["data"])["version_id"] == client.get(f"/notes/{created['id']}").json()["versions"][-1]["id"]
+    assert main.change_feed.subscribers == 0
+
+    # Past the changes kept, the client must reload
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM note_events WHERE id <= :cursor"), {"cursor": cursor})
+    assert client.get("/notes:changes", params={"after": start["cursor"]}).json() == {
+        "changes": [], "cursor": cursor + 1, "reset": True
+    }
+    assert client.get("/notes:changes", params={"after": cursor}).json()["changes"][0]["id"] == cursor + 1
+    assert client.get("/notes:changes", headers={"Last-Event-ID": "x"}).status_code == 400
+
+
+def test_change_feed_fan_out(monkeypatch):
+    # Thousands of idle subscribers hold no connection, and a write wakes them all with one read
+    feed = ChangeFeed()
+    monkeypatch.setattr(main, "change_feed", feed)
+    note_id = test_create_note()
+    checked_out = 0
+
+    def checkout(*args):
+        nonlocal checked_out
+        checked_out += 1
+
+    def checkin(*args):
+        nonlocal checked_out
+        checked_out -= 1
+
+    subscribers = 2000
+
+    async def fan_out():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as writer:
+            cursor = (await writer.get("/notes:changes")).json()["cursor"]
+
+            async def subscriber():
+                async with TestingAsyncSessionLocal() as db:
+                    async with aclosing(feed.follow(db, cursor, heartbeat=60)) as batches:
+                        changes, _, _ = await anext(batches)
+                return changes
+
+            tasks = [asyncio.create_task(subscriber()) for _ in range(subscribers)]
+            while feed.subscribers < subscribers or checked_out:
+                await asyncio.sleep(0.05)
+            reads = feed.reads
+            await writer.put(f"/notes/{note_id}", json={"title": "Fanned out", "content": "to everyone"})
+            received = await asyncio.wait_for(asyncio.gather(*tasks), 30)
+            return cursor, reads, received
+
+    event.listen(async_engine.sync_engine, "checkout", checkout)
+    event.listen(async_engine.sync_engine, "checkin", checkin)
+    try:
+        cursor, reads, received = asyncio.run(fan_out())
+    finally:
+        event.remove(async_engine.sync_engine, "checkout", checkout)
+        event.remove(async_engine.sync_engine, "checkin", checkin)
+    assert feed.reads == reads + 1
+    assert all(changes == received[0] for changes in received)
+    assert [(c["id"], c["note_id"], c["kind"]) for c in received[0]] == [(cursor + 1, note_id, "updated")]
+    assert feed.subscribers == 0
+
+
+def test_retention_policy():
+    # One version an hour, the last one at noon on June 3rd
+    now = datetime.datetime(2024, 6, 3, 12)
+    versions = [
+        SimpleNamespace(id=i, created_at=now - datetime.timedelta(hours=60 - i), size=10) for i in range(61)
+    ]
+    assert RetentionPolicy(keep_last=5).prune(versions, now) == set(range(56))
+    # Past a day old (June 1st 00:00 up to June 2nd 12:00), the last version of each day
+    assert RetentionPolicy(daily_after=datetime.timedelta(days=1)).prune(versions, now) == set(range(36)) - {23}
+    assert RetentionPolicy(max_size=25).prune(versions, now) == set(range(59))
+    # The latest version always stays
+    assert RetentionPolicy(max_size=0).prune(versions, now) == set(range(60))
+    assert RetentionPolicy(keep_last=1).prune(versions[:1], now) == set()
+    assert not RetentionPolicy().enabled
+
+
+def test_compact_history():
+    lines = [f"line {i}" for i in range(30)]
+    note_id = client.post("/notes", json={"title": "Pruned", "content": "\n".join(lines)}).json()["id"]
+    for i in range(1, 13):
+        lines[i] = f"changed {i}"
+        client.put(f"/notes/{note_id}", json={"title": f"Pruned {i}", "content": "\n".join(lines)})
+    # Two versions a day, so thinning to one a day deletes every other one
+    with engine.begin() as conn:
+        conn.execute(text(
+            "UPDATE note_versions SET created_at = datetime('2024-01-01', (version_number / 2) || ' days') "
+            "WHERE note_id = :note_id"
+        ), {"note_id": note_id})
+    before = {v["version_number"]: v for v in client.get(f"/notes/{note_id}/versions").json()}
+    etag = client.get(f"/notes/{note_id}").headers["etag"]
+    previous_url = f"/notes/{note_id}/versions/{before[5]['id']}/diff?previous=true"
+    previous_etag = client.get(previous_url).headers["etag"]
+
+    policy = RetentionPolicy(daily_after=datetime.timedelta(days=1))
+    with TestingSessionLocal() as db:
+        deleted, rebased, reclaimed = compact_note(db, note_id, policy, datetime.datetime(2025, 1, 1))
+    _invalidate_caches_blocking(note_id)
+    assert (deleted, rebased) == (6, 6) and reclaimed > 0
+
+    # Kept versions rebuild to the same contents, still mostly as deltas
+    after = {v["version_number"]: v for v in client.get(f"/notes/{note_id}/versions").json()}
+    assert sorted(after) == [1, 3, 5, 7, 9, 11, 13]
+    assert all(after[number] == before[number] for number in after)
+    with engine.connect() as conn:
+        assert conn.execute(text(
+            "SELECT count(*) FROM note_versions WHERE note_id = :note_id AND delta IS NOT NULL"
+        ), {"note_id": note_id}).scalar() == 6
+    response = client.get(f"/notes/{note_id}")
+    assert response.headers["etag"] != etag
+    assert [v["version_number"] for v in response.json()["versions"]] == [1, 3, 5, 7, 9, 11, 13]
+
+    # The previous version is the closest one kept, so that diff changed; ranges skip the gaps
+    response = client.get(previous_url, headers={"If-None-Match": previous_etag})
+    assert response.status_code == 200
+    assert response.json() == compare_versions(after[3], after[5])
+    diff = client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 13}).json()
+    assert diff == compare_versions(after[1], after[13])
+    with TestingSessionLocal() as db:
+        assert compact_note(db, note_id, policy, datetime.datetime(2025, 1, 1)) == (0, 0, 0)
+
+
+def test_caches_checked_after_outside_compaction():
+    note_id = client.post("/notes", json={"title": "Outside", "content": "one"}).json()["id"]
+    for content in ("two", "three"):
+        client.put(f"/notes/{note_id}", json={"title": "Outside", "content": content})
+    versions = {v["version_number"]: v["id"] for v in client.get(f"/notes/{note_id}/versions").json()}
+    urls = [
+        f"/notes/{note_id}/versions/{versions[1]}",
+        f"/notes/{note_id}/diff?from=1&to=3",
+        f"/notes/{note_id}/versions/{versions[2]}/diff?previous=true",
+    ]
+    assert all(client.get(url).status_code == 200 for url in urls)
+    before = client.get("/cache/stats").json()
+    assert all(client.get(url).status_code == 200 for url in urls)
+    after = client.get("/cache/stats").json()
+    assert after["payloads"]["hits"] == before["payloads"]["hits"] + 2
+    assert after["diffs"]["hits"] == before["diffs"]["hits"] + 1
+
+    # As retention.py would from another process: this one's caches are not invalidated
+    with TestingSessionLocal() as db:
+        assert compact_note(db, note_id, RetentionPolicy(keep_last=2), datetime.datetime.utcnow())[0] == 1
+
+    # Cached responses built from version 1 are not sent any more
+    assert [client.get(url).status_code for url in urls] == [404, 404, 404]
+    assert client.get(f"/notes/{note_id}/diff?from=2&to=3").status_code == 200
+    client.delete(f"/notes/{note_id}")
+
+
+def test_compact_and_vacuum(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'retention.db'}")
+    configure_sqlite(engine, sqlite_pragmas("tuned"))
+    created = datetime.datetime(2024, 1, 1)
+    try:
+        run_migrations(engine)
+        Session = sessionmaker(bind=engine)
+        with Session() as db:
+            import_batch(db, [{
+                "title": f"Note {n}", "content": "last", "created_at": created,
+                "updated_at": created + datetime.timedelta(minutes=n),
+                "versions": [
+                    {"title": f"Note {n}", "content": f"{n} {i} " * 2000, "created_at": created} for i in range(10)
+                ] + [{"title": f"Note {n}", "content": "last", "created_at": created}],
+            } for n in range(5)])
+            db.commit()
+        listing = "SELECT title, updated_at FROM notes ORDER BY updated_at DESC, id DESC"
+        with engine.connect() as conn:
+            listed = conn.execute(text(listing)).all()
+
+        policy = RetentionPolicy(keep_last=2)
+        report = compact(Session, policy, batch_size=2, dry_run=True)
+        assert (report.notes_scanned, report.notes_compacted, report.versions_deleted) == (5, 5, 45)
+        compacted = []
+        report = compact(Session, policy, batch_size=2, on_compacted=compacted.append)
+        assert report.versions_deleted == 45 and report.bytes_reclaimed == 45 * len("0 0 " * 2000)
+        assert len(compacted) == 5
+        with engine.connect() as conn:
+            assert conn.execute(text("SELECT count(*) FROM note_versions")).scalar() == 10
+            # Pruning history is not a change to the notes, lists keep their order
+            assert conn.execute(text(listing)).all() == listed
+
+        # Freed pages go back to the filesystem
+        assert free_space(engine)[0] > 0
+        assert incremental_vacuum(engine) > 300000
+        assert free_space(engine)[0] == 0
+    finally:
+        engine.dispose()
+
+    # Databases created without auto_vacuum are switched over once
+    plain = create_engine(f"sqlite:///{tmp_path / 'plain.db'}")
+    try:
+        run_migrations(plain)
+        assert incremental_vacuum(plain) == 0
+        enable_incremental_vacuum(plain)
+        with plain.connect() as conn:
+            assert conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2
+    finally:
+        plain.dispose()
+
+
+def test_diff_cache_invalidated_on_update():
+    note_id = test_create_note()
+    version_id = client.get(f"/notes/{note_id}/versions").json()[0]["id"]
+
+    # Identical to the current note, then cached
+    response = client.get(f"/notes/{note_id}/versions/{version_id}/diff")
+    assert response.status_code == 200
+    assert all(line["type"] == "unchanged" for line in response.json()["content_diff"])
+    assert client.get(f"/notes/{note_id}/versions/{version_id}/diff").json() == response.json()
+
+    # Updating the note drops the cached diff against the current version
+    client.put(f"/notes/{note_id}", json={"title": "Test Note", "content": "Something else"})
+    response = client.get(f"/notes/{note_id}/versions/{version_id}/diff")
+    assert response.status_code == 200
+    assert {"type": "added", "content": "This is a test note"} in response.json()["content_diff"]
+
+
+def test_sqlite_profile_pragmas(tmp_path):
+    tuned_engine = create_engine(f"sqlite:///{tmp_path / 'tuned.db'}")
+    configure_sqlite(tuned_engine, sqlite_pragmas("tuned"))
+    try:
+        with tuned_engine.connect() as conn:
+            assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+            assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+            assert conn.execute(text("PRAGMA cache_size")).scalar() == -65536
+    finally:
+        tuned_engine.dispose()
+
+
+def test_history_queries_use_indexes():
+    # Capture every SELECT the endpoints run
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    note_id, version_id = test_versions_and_diff()
+    first_page = client.get("/notes", params={"limit": 1}).json()
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        client.get("/notes", params={"limit": 5, "cursor": first_page["next_cursor"]})
+        client.get("/notes", params={"limit": 5, "include": "versions"})
+        client.get(f"/notes/{note_id}")
+        client.get(f"/notes/{note_id}/versions")
+        client.get(f"/notes/{note_id}/versions/{version_id}/diff", params={"previous": True})
+        client.post(f"/notes/{note_id}/revert/{version_id}")
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", capture)
+
+    # None of them may fall back to a full scan of notes or note_versions
+    assert statements
+    full_scan = re.compile(r"\bSCAN (notes|note_versions)\b(?! USING)")
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, tuple(parameters)).all()
+            details = [row[-1] for row in plan]
+            assert not any(full_scan.search(detail) for detail in details), (statement, details)
+
+
+def test_version_numbers():
+    # create, two updates and a revert number the versions 1 to 4
+    note_id = test_update_note()
+    client.put(f"/notes/{note_id}", json={"title": "Third", "content": "Third content"})
+    versions = client.get(f"/notes/{note_id}/versions").json()
+    client.post(f"/notes/{note_id}/revert/{versions[-1]['id']}")
+
+    versions = client.get(f"/notes/{note_id}/versions").json()
+    assert [v["version_number"] for v in versions] == [4, 3, 2, 1]
+    note = client.get(f"/notes/{note_id}").json()
+    assert [v["version_number"] for v in note["versions"]] == [1, 2, 3, 4]
+
+    # Range fetch by version number
+    response = client.get(f"/notes/{note_id}/versions", params={"start": 2, "end": 3})
+    assert response.status_code == 200
+    assert [v["version_number"] for v in response.json()] == [3, 2]
+
+    # The previous version of version 3 is version 2
+    response = client.get(f"/notes/{note_id}/versions/{versions[1]['id']}/diff", params={"previous": True})
+    assert response.status_code == 200
+    assert response.json()["old_title"] == "Updated Note"
+    assert response.json()["new_title"] == "Third"
+
+    # Version 1 has no previous version
+    response = client.get(f"/notes/{note_id}/versions/{versions[-1]['id']}/diff", params={"previous": True})
+    assert response.status_code == 404
+
+
+def test_create_notes_batch():
+    payload = {"notes": [{"title": f"Batch {i}", "content": f"Batch content {i}"} for i in range(25)]}
+    response = client.post("/notes:batch", json=payload)
+    assert response.status_code == 201
+    ids = response.json()["ids"]
+    assert len(ids) == 25
+
+    # Ids come back in request order and every note has its first version
+    note = client.get(f"/notes/{ids[7]}").json()
+    assert note["title"] == "Batch 7"
+    assert [(v["version_number"], v["size"]) for v in note["versions"]] == [(1, len("Batch content 7"))]
+
+    # An invalid note rejects the whole batch
+    payload["notes"].append({"title": " ", "content": "No title"})
+    assert client.post("/notes:batch", json=payload).status_code == 422
+    assert client.post("/notes:batch", json={"notes": []}).status_code == 422
+
+
+def test_batch_get():
+    ids = client.post("/notes:batch", json={
+        "notes": [{"title": f"Multi {i}", "content": f"Multi content {i}"} for i in range(5)]
+    }).json()["ids"]
+    client.put(f"/notes/{ids[2]}", json={"title": "Multi 2", "content": "Edited"})
+    client.get(f"/notes/{ids[0]}")  # Cached
+
+    # Notes come in request order, once each, as single gets return them
+    response = client.post("/notes:batchGet", json={"ids": [ids[2], 999999, ids[0], ids[4], ids[2]]})
+    assert response.status_code == 200
+    body = NoteBatchGetResult.model_validate_json(response.content).model_dump(mode="json")
+    assert body["notes"] == [client.get(f"/notes/{note_id}").json() for note_id in (ids[2], ids[0], ids[4])]
+    assert body["errors"] == [{"id": 999999, "status": 404, "detail": "Note not found"}]
+    assert client.post("/notes:batchGet", json={"ids": [999999]}).json() == {
+        "notes": [], "errors": [{"id": 999999, "status": 404, "detail": "Note not found"}]
+    }
+    assert client.post("/notes:batchGet", json={"ids": []}).status_code == 422
+
+    # Versions of another note are not found in this one
+    versions = client.get(f"/notes/{ids[2]}/versions").json()
+    other = client.get(f"/notes/{ids[3]}/versions").json()[0]["id"]
+    response = client.post(
+        f"/notes/{ids[2]}/versions:batchGet", json={"ids": [versions[1]["id"], other, versions[0]["id"]]}
+    )
+    assert response.status_code == 200
+    body = VersionBatchGetResult.model_validate_json(response.content).model_dump(mode="json")
+    assert body["versions"] == [
+        client.get(f"/notes/{ids[2]}/versions/{version['id']}").json() for version in (versions[1], versions[0])
+    ]
+    assert body["errors"] == [{"id": other, "status": 404, "detail": "Version not found"}]
+    assert client.post("/notes/999999/versions:batchGet", json={"ids": [other]}).status_code == 404
+
+
+def test_conditional_get():
+    note_id, version_id = test_versions_and_diff()
+
+    # Notes revalidate and answer 304 while unchanged
+    response = client.get(f"/notes/{note_id}")
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "no-cache"
+    response = client.get(f"/notes/{note_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    # Versions are immutable; diffs with the previous version revalidate, as retention may prune it
+    for url, cache_control in (
+        (f"/notes/{note_id}/versions/{version_id}", "public, max-age=31536000, immutable"),
+        (f"/notes/{note_id}/versions/{version_id}/diff?previous=true", "no-cache"),
+    ):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers["cache-control"] == cache_control
+        response = client.get(url, headers={"If-None-Match": f'W/"x", {response.headers["etag"]}'})
+        assert response.status_code == 304
+
+    history_etag = client.get(f"/notes/{note_id}/versions").headers["etag"]
+    diff_etag = client.get(f"/notes/{note_id}/versions/{version_id}/diff").headers["etag"]
+    assert client.get(
+        f"/notes/{note_id}/versions/{version_id}/diff", headers={"If-None-Match": diff_etag}
+    ).status_code == 304
+
+    # Any change to the note gives new ETags to the note, its history and diffs against it
+    client.put(f"/notes/{note_id}", json={"title": "Changed", "content": "Changed content"})
+    assert client.get(f"/notes/{note_id}", headers={"If-None-Match": etag}).status_code == 200
+    assert client.get(
+        f"/notes/{note_id}/versions", headers={"If-None-Match": history_etag}
+    ).status_code == 200
+    assert client.get(
+        f"/notes/{note_id}/versions/{version_id}/diff", headers={"If-None-Match": diff_etag}
+    ).status_code == 200
+
+
+def test_note_cache():
+    note_id = test_create_note()
+
+    # Once read, the note is served from the cache
+    first = client.get(f"/notes/{note_id}")
+    before = client.get("/cache/stats").json()["notes"]
+    second = client.get(f"/notes/{note_id}")
+    assert second.json() == first.json()
+    assert second.headers["etag"] == first.headers["etag"]
+    after = client.get("/cache/stats").json()["notes"]
+    assert after["misses"] == before["misses"]
+    assert after["hits"] == before["hits"] + 1
+
+    # Updates, reverts and deletes drop the cached payload
+    client.put(f"/notes/{note_id}", json={"title": "Cached", "content": "New content"})
+    assert client.get(f"/notes/{note_id}").json()["content"] == "New content"
+    first_version = client.get(f"/notes/{note_id}/versions").json()[-1]["id"]
+    client.post(f"/notes/{note_id}/revert/{first_version}")
+    assert client.get(f"/notes/{note_id}").json()["content"] == "This is a test note"
+    client.delete(f"/notes/{note_id}")
+    assert client.get(f"/notes/{note_id}").status_code == 404
+
+
+@pytest.mark.parametrize("orjson", [serialization.orjson, None])
+def test_serialized_responses_match_models(monkeypatch, orjson):
+    # Responses built from rows are byte for byte what the response models would send
+    monkeypatch.setattr(serialization, "orjson", orjson)
+    note_id = client.post("/notes", json={"title": "Café", "content": "Première ligne"}).json()["id"]
+    client.put(f"/notes/{note_id}", json={"title": "Café", "content": "Première ligne\nDeuxième"})
+    version_id = client.get(f"/notes/{note_id}/versions").json()[0]["id"]
+
+    for url, model in [
+        (f"/notes/{note_id}", NoteDetail),
+        (f"/notes/{note_id}?embed=versions", Note),
+        (f"/notes/{note_id}/versions/{version_id}", NoteVersion),
+        ("/notes?limit=2", NotePage),
+        ("/notes?limit=2&include=versions", NotePage),
+    ]:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert model.model_validate_json(response.content).model_dump_json().encode() == response.content
+    response = client.get(f"/notes/{note_id}/versions")
+    assert [
+        NoteVersion.model_validate(version).model_dump(mode="json") for version in response.json()
+    ] == response.json()
+    assert client.get("/notes?limit=1").json()["items"][0]["versions"] is None
+
+
+def test_response_compression():
+    content = "\n".join(f"Line {i} of a long note" for i in range(200))
+    note_id = client.post("/notes", json={"title": "Compressed", "content": content}).json()["id"]
+    client.put(f"/notes/{note_id}", json={"title": "Compressed", "content": content + "\nOne more"})
+    gzip_only = {"Accept-Encoding": "gzip"}
+
+    # Large responses are compressed, as a representation of their own
+    plain = client.get(f"/notes/{note_id}?embed=versions", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    response = client.get(f"/notes/{note_id}?embed=versions", headers=gzip_only)
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.headers["etag"] == plain.headers["etag"][:-1] + '-gzip"'
+    assert response.json() == plain.json()
+    assert "content-encoding" not in client.get("/", headers=gzip_only).headers
+
+    # Either ETag validates the note, and conditions a write on it
+    response = client.get(
+        f"/notes/{note_id}?embed=versions", headers={**gzip_only, "If-None-Match": response.headers["etag"]}
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"].endswith('-gzip"')
+    note_etag = client.get(f"/notes/{note_id}", headers=gzip_only).headers["etag"]
+    assert note_etag.endswith('-gzip"')
+    assert client.put(
+        f"/notes/{note_id}", json={"title": "Compressed", "content": content}, headers={"If-Match": note_etag}
+    ).status_code == 200
+
+    # Streams are compressed as they go
+    response = client.get("/notes:export", headers=gzip_only)
+    assert response.headers["content-encoding"] == "gzip"
+    assert any(json.loads(line)["id"] == note_id for line in response.text.splitlines())
+
+    # Settled versions and diffs between them are only serialized and compressed once
+    version_id = client.get(f"/notes/{note_id}/versions").json()[1]["id"]
+    for url in (
+        f"/notes/{note_id}/versions/{version_id}",
+        f"/notes/{note_id}/diff?from=1&to=2",
+    ):
+        plain = client.get(url, headers={"Accept-Encoding": "identity"})
+        before = client.get("/cache/stats").json()["payloads"]
+        response = client.get(url, headers=gzip_only)
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json() == plain.json()
+        assert client.get("/cache/stats").json()["payloads"]["hits"] == before["hits"] + 1
+    client.delete(f"/notes/{note_id}")
+    assert client.get(f"/notes/{note_id}/versions/{version_id}").status_code == 404
+
+
+def test_negotiate_encoding():
+    encodings = ["zstd", "br", "gzip"]
+    assert negotiate("gzip, deflate, br", encodings) == "br"
+    assert negotiate("gzip;q=0.5, br;q=0", encodings) == "gzip"
+    assert negotiate("*", encodings) == "zstd"
+    assert negotiate("*, zstd;q=0", encodings) == "br"
+    assert negotiate("identity", encodings) is None
+    assert negotiate("gzip;q=0", encodings) is None
+    assert negotiate(None, encodings) is None
+
+
+def test_local_cache_backend():
+    now = [0.0]
+    backend = LocalCacheBackend(max_entries=2, clock=lambda: now[0])
+    cache = NoteCache(backend, ttl=10)
+
+    async def scenario():
+        await cache.set(1, '"a"', b"{}")
+        assert await cache.get(1) == ('"a"', b"{}")
+
+        # A payload built before an invalidation is not stored
+        generation = cache.generation(1)
+        await cache.invalidate(1)
+        await cache.set(1, '"b"', b"{}", generation=generation)
+        assert await cache.get(1) is None
+
+        # Least recently used entries are evicted, and entries expire after the TTL
+        await cache.set(1, '"a"', b"{}")
+        await cache.set(2, '"a"', b"{}")
+        await cache.get(1)
+        await cache.set(3, '"a"', b"{}")
+        assert await cache.get(2) is None
+        now[0] = 11
+        assert await cache.get(1) is None
+
+    asyncio.run(scenario())
+    assert cache.stats() == {"hits": 2, "misses": 3, "evictions": 2}
+
+
+def test_blocking_cache_backend():
+    class SlowBackend(LocalCacheBackend):
+        blocking = True
+        threads = set()
+
+        def get(self, key):
+            self.threads.add(threading.get_ident())
+            return super().get(key)
+
+        def set(self, key, value, ttl=None):
+            self.threads.add(threading.get_ident())
+            super().set(key, value, ttl)
+            cache.invalidate_blocking(1)  # An update commits while the payload is stored
+
+    backend = SlowBackend()
+    cache = NoteCache(backend)
+
+    async def scenario():
+        loop_thread = threading.get_ident()
+        await cache.set(1, '"a"', b"{}", generation=cache.generation(1))
+        assert await cache.get(1) is None  # The stale payload did not outlive the update
+        assert backend.threads and loop_thread not in backend.threads
+
+    asyncio.run(scenario())
+
+
+def test_search_notes():
+    # Words of this run only, as notes of earlier runs stay in the test database
+    zebra, okapi = f"zebra{uuid.uuid4().hex}", f"okapi{uuid.uuid4().hex}"
+    ids = client.post("/notes:batch", json={"notes": [
+        {"title": f"Zebra {i}", "content": "striped animals\n" + f"{zebra} " * i}
+        for i in range(1, 6)
+    ]}).json()["ids"]
+
+    # Notes with more occurrences of the word rank first
+    response = client.get("/notes/search", params={"q": zebra, "limit": 3})
+    assert response.status_code == 200
+    page = response.json()
+    assert [item["id"] for item in page["items"]] == ids[::-1][:3]
+    assert "<mark>" in page["items"][0]["snippet"]
+    response = client.get("/notes/search", params={"q": zebra, "limit": 3, "offset": page["next_offset"]})
+    assert [item["id"] for item in response.json()["items"]] == ids[1::-1]
+    assert response.json()["next_offset"] is None
+
+    # Every word must match, and a trailing * matches a prefix
+    assert len(client.get("/notes/search", params={"q": f"striped {zebra[:-4]}*"}).json()["items"]) == 5
+    assert client.get("/notes/search", params={"q": f"{zebra} unicorn"}).json()["items"] == []
+
+    # Updates and deletes keep the index in sync
+    client.put(f"/notes/{ids[0]}", json={"title": okapi, "content": "Not striped at all"})
+    assert [item["id"] for item in client.get("/notes/search", params={"q": okapi}).json()["items"]] == [ids[0]]
+    client.delete(f"/notes/{ids[0]}")
+    assert client.get("/notes/search", params={"q": okapi}).json()["items"] == []
+
+    # Search operators are taken literally, an empty query is rejected
+    assert client.get("/notes/search", params={"q": 'zebra OR ("'}).status_code == 200
+    assert client.get("/notes/search", params={"q": "*"}).status_code == 400
+
+
+def test_export_and_import_notes():
+    note_id = test_create_note()
+    for i in range(20):
+        client.put(f"/notes/{note_id}", json={"title": "Exported", "content": f"first line\nrevision {i}"})
+    history = client.get(f"/notes/{note_id}/versions").json()
+
+    response = client.get("/notes:export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = response.text.splitlines()
+    exported = [json.loads(line) for line in lines]
+    assert [note["id"] for note in exported] == sorted(note["id"] for note in exported)
+    note = next(note for note in exported if note["id"] == note_id)
+    assert [v["content"] for v in note["versions"]] == [v["content"] for v in reversed(history)]
+
+    # Importing the export recreates every note with its full history; only
+    # this test's note and the one before it, as the test database persists
+    lines = lines[-2:]
+    response = client.post("/notes:import", content="\n".join(lines).encode())
+    assert response.status_code == 201
+    assert response.json() == {"imported": len(lines)}
+    with engine.connect() as conn:
+        copy_id = conn.execute(text("SELECT max(id) FROM notes")).scalar()
+    copy = client.get(f"/notes/{copy_id}", params={"embed": "versions"}).json()
+    assert copy["title"] == exported[-1]["title"]
+    assert [v["content"] for v in copy["versions"]] == [v["content"] for v in exported[-1]["versions"]]
+    copied_history = client.get(f"/notes/{copy_id}/versions?start=1&end=1").json()
+    assert copied_history[0]["version_number"] == 1
+
+    # Invalid lines are reported with their number
+    response = client.post("/notes:import", content=b'{"title": "x"}\n')
+    assert response.status_code == 400
+    assert "Line 1" in response.json()["detail"]
+
+    # Titles and contents are held to the limits of the API
+    valid = dict(exported[-1], versions=exported[-1]["versions"][:1])
+    for line in (
+        dict(valid, title="x" * 101),
+        dict(valid, title="   "),
+        dict(valid, versions=[dict(valid["versions"][0], content="")]),
+    ):
+        response = client.post("/notes:import", content=(json.dumps(valid) + "\n" + json.dumps(line)).encode())
+        assert response.status_code == 400
+        assert "Line 2" in response.json()["detail"]
+
+    # A note exported without history gets its state as version 1
+    response = client.post("/notes:import", content=json.dumps(dict(valid, versions=[])).encode())
+    assert response.json() == {"imported": 1}
+    with engine.connect() as conn:
+        copy_id = conn.execute(text("SELECT max(id) FROM notes")).scalar()
+    versions = client.get(f"/notes/{copy_id}", params={"embed": "versions"}).json()["versions"]
+    assert [(v["version_number"], v["title"], v["content"]) for v in versions] == [
+        (1, valid["title"], valid["content"])
+    ]
+
+
+def test_export_snapshot(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'export.db'}")
+    configure_sqlite(engine, sqlite_pragmas("tuned"))
+    created = datetime.datetime(2024, 1, 1)
+    try:
+        run_migrations(engine)
+        Session = sessionmaker(bind=engine)
+        with Session() as db:
+            import_batch(db, [{
+                "title": f"Note {n}", "content": "text", "created_at": created, "updated_at": created,
+                "versions": [{"title": f"Note {n}", "content": "text", "created_at": created}],
+            } for n in range(3)])
+            db.commit()
+
+        # Writes committed once the export began are not exported, whatever chunk they fall in
+        with Session() as db:
+            lines = export_notes(db, chunk_size=1)
+            first = next(lines)
+            with engine.begin() as conn:
+                conn.execute(text("UPDATE notes SET title = 'Changed' WHERE title = 'Note 2'"))
+            exported = [json.loads(line) for line in [first, *lines]]
+        assert [note["title"] for note in exported] == ["Note 0", "Note 1", "Note 2"]
+    finally:
+        engine.dispose()
+
+
+def test_diff_hunks():
+    lines = [f"line {i}" for i in range(100)]
+    note_id = client.post("/notes", json={"title": "Hunks", "content": "\n".join(lines)}).json()["id"]
+    for i in (10, 50, 90):
+        lines[i] = f"changed {i}"
+    client.put(f"/notes/{note_id}", json={"title": "Hunks", "content": "\n".join(lines)})
+    version_id = client.get(f"/notes/{note_id}/versions").json()[0]["id"]
+    url = f"/notes/{note_id}/versions/{version_id}/diff"
+
+    response = client.get(url, params={"previous": True, "format": "hunks", "context": 2})
+    assert response.status_code == 200
+    diff = response.json()
+    assert diff["hunk_count"] == 3 and diff["next_hunk"] is None
+    assert diff["hunks"][0] == {
+        "old_start": 9, "old_lines": 5, "new_start": 9, "new_lines": 5,
+        "runs": [
+            {"type": "unchanged", "lines": ["line 8", "line 9"]},
+            {"type": "removed", "lines": ["line 10"]},
+            {"type": "added", "lines": ["changed 10"]},
+            {"type": "unchanged", "lines": ["line 11", "line 12"]},
+        ],
+    }
+
+    # Changed lines only, one page of hunks at a time
+    response = client.get(url, params={
+        "previous": True, "format": "hunks", "context": 0, "hunk_start": 1, "hunk_limit": 1
+    })
+    diff = response.json()
+    assert [run["type"] for run in diff["hunks"][0]["runs"]] == ["removed", "added"]
+    assert diff["hunks"][0]["old_start"] == 51 and diff["next_hunk"] == 2
+
+    # Streamed as NDJSON: a header, then one hunk per line
+    response = client.get(
+        url, params={"previous": True, "format": "hunks"}, headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    header, *hunks = [json.loads(line) for line in response.text.splitlines()]
+    assert header["hunk_count"] == 3 and len(hunks) == 3
+
+    # Compared with the current note, which is identical
+    assert client.get(url, params={"format": "hunks"}).json()["hunks"] == []
+
+
+def test_range_diff():
+    lines = [f"line {i}" for i in range(50)]
+    note_id = client.post("/notes", json={"title": "Range", "content": "\n".join(lines)}).json()["id"]
+    for i in range(1, 6):
+        lines[i * 5] = f"changed {i * 5}"
+        if i == 3:
+            lines = [f"new top {j}" for j in range(40)] + lines  # Too big for a delta
+        client.put(f"/notes/{note_id}", json={"title": f"Range {i}", "content": "\n".join(lines)})
+    versions = {v["version_number"]: v["id"] for v in client.get(f"/notes/{note_id}/versions").json()}
+    assert sorted(versions) == [1, 2, 3, 4, 5, 6]
+
+    # Matches diffing the two versions directly, whatever the path in between
+    for old, new in [(1, 6), (2, 5), (6, 1), (3, 3)]:
+        response = client.get(f"/notes/{note_id}/diff", params={"from": old, "to": new})
+        assert response.status_code == 200
+        assert "immutable" in response.headers["Cache-Control"]
+        old_version, new_version = (
+            client.get(f"/notes/{note_id}/versions/{versions[number]}").json() for number in (old, new)
+        )
+        assert response.json() == compare_versions(old_version, new_version)
+
+    response = client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 6, "format": "hunks", "context": 0})
+    diff = response.json()
+    assert diff["hunk_count"] == 4 and diff["new_title"] == "Range 5"
+    assert diff["hunks"][0]["runs"][0]["type"] == "added"
+    assert diff["hunks"][0]["runs"][0]["lines"][:2] == ["new top 0", "new top 1"]
+    assert client.get(
+        f"/notes/{note_id}/diff", params={"from": 1, "to": 6}, headers={"If-None-Match": response.headers["ETag"]}
+    ).status_code == 200  # Different format, different ETag
+
+    assert client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 7}).status_code == 404
+    client.delete(f"/notes/{note_id}")
+    assert client.get(f"/notes/{note_id}/diff", params={"from": 1, "to": 2}).status_code == 404
+
+
+def _metric(text, name, **labels):
+    wanted = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    for line in text.splitlines():
+        if line.startswith(f"{name}{{{wanted}}} "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_metrics():
+    note_id = client.post("/notes", json={"title": "Metrics", "content": "Counted"}).json()["id"]
+    before = client.get("/metrics").text
+    for _ in range(3):
+        client.put(f"/notes/{note_id}", json={"title": "Metrics", "content": "Counted again"})
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    # Routes are labelled by template, and every series has its buckets, sum and count
+    name = "notes_http_request_duration_seconds_count"
+    labels = {"method": "PUT", "route": "/notes/{note_id}", "status": "200"}
+    assert _metric(response.text, name, **labels) - (_metric(before, name, **labels) or 0) == 3
+    assert 'notes_http_request_duration_seconds_bucket{method="PUT",route="/notes/{note_id}",status="200",le="+Inf"}' in response.text
+    assert _metric(response.text, "notes_http_request_db_queries_sum", method="PUT", route="/notes/{note_id}") > 0
+    assert _metric(response.text, "notes_http_request_serialization_seconds_count", method="PUT", route="/notes/{note_id}") >= 3
+    assert _metric(response.text, "notes_cache_hits_total", cache="notes") is not None
+
+
+def test_slow_request_profiler(monkeypatch):
+    assert client.get("/debug/profiler").json()["enabled"] is False
+    assert client.put("/debug/profiler", json={"slow_ms": 0.001}).status_code == 403
+    monkeypatch.setattr(main, "PROFILE_RUNTIME", True)
+    assert client.put("/debug/profiler", json={"slow_ms": 0.001, "interval_ms": 0.0001}).status_code == 422
+    report = client.put("/debug/profiler", json={"slow_ms": 0.001, "interval_ms": 1}).json()
+    try:
+        assert report["enabled"] is True and report["slow_ms"] == 0.001
+        client.get("/notes")
+        slow = client.get("/debug/profiler").json()["slow_requests"]
+        assert slow[-1]["route"] == "/notes" and slow[-1]["method"] == "GET" and slow[-1]["queries"] >= 1
+    finally:
+        report = client.put("/debug/profiler", json={"slow_ms": 0}).json()
+    assert report["enabled"] is False
+
+
+def test_json_log_format():
+    record = logging.LogRecord("notes", logging.INFO, __file__, 1, "Note %s created", (1,), None)
+    record.note_id = 1
+    entry = json.loads(JSONFormatter().format(record))
+    assert entry["level"] == "INFO" and entry["message"] == "Note 1 created" and entry["note_id"] == 1
+
+
 # Run all tests in sequence
 def test_all():
     test_read_root()
@@ -0,0 +1,125 @@
+import difflib
+import random
+
+import pytest
+
+from utils import (
+    compare_versions, compose_blocks, diff_hunks, fts_query, hunk_ranges, matching_blocks, refine_blocks
+)
+
+
+def _differ_diff(old_content, new_content):
+    # The content_diff produced by the original difflib.Differ implementation
+    result = []
+    for line in difflib.Differ().compare(old_content.splitlines(), new_content.splitlines()):
+        kind = {"  ": "unchanged", "- ": "removed", "+ ": "added"}.get(line[:2])
+        if kind:
+            result.append({"type": kind, "content": line[2:]})
+    return result
+
+
+def test_compare_versions_matches_differ_on_simple_edits():
+    old = "first line\nsecond line\nthird line\nfourth line"
+    new = "first line\nsecond line changed\nthird line\nfourth line\nfifth line"
+    diff = compare_versions({"title": "A", "content": old}, {"title": "B", "content": new})
+    assert diff["title_changed"] is True
+    assert diff["old_title"] == "A"
+    assert diff["new_title"] == "B"
+    assert diff["content_diff"] == _differ_diff(old, new)
+
+
+def test_compare_versions_rebuilds_both_sides():
+    random.seed(42)
+    for _ in range(500):
+        old = [random.choice("abcde") for _ in range(random.randint(0, 40))]
+        new = [random.choice("abcdef") for _ in range(random.randint(0, 40))]
+        diff = compare_versions(
+            {"title": "t", "content": "\n".join(old)},
+            {"title": "t", "content": "\n".join(new)}
+        )["content_diff"]
+        assert [d["content"] for d in diff if d["type"] != "added"] == old
+        assert [d["content"] for d in diff if d["type"] != "removed"] == new
+
+
+def test_matching_blocks_are_increasing_runs_of_equal_lines():
+    old = ["}", "a", "}", "b", "}", "c", "}"] * 20
+    new = ["}", "a", "x", "}", "c", "}"] * 20
+    previous_end = (0, 0)
+    for i, j, size in matching_blocks(old, new):
+        assert size > 0
+        assert i >= previous_end[0] and j >= previous_end[1]
+        assert old[i:i + size] == new[j:j + size]
+        previous_end = (i + size, j + size)
+
+
+def test_fts_query_quotes_words():
+    assert fts_query("hello  world") == '"hello" "world"'
+    assert fts_query('say "hi" OR NEAR(') == '"say" """hi""" "OR" "NEAR("'
+    assert fts_query("prog*") == '"prog"*'
+    with pytest.raises(ValueError):
+        fts_query(" * ")
+
+
+def test_diff_hunks_cover_every_change():
+    rng = random.Random(7)
+    for _ in range(50):
+        old = [f"line {rng.randrange(20)}" for _ in range(rng.randrange(60))]
+        new = list(old)
+        for _ in range(rng.randrange(6)):
+            position = rng.randrange(len(new) + 1)
+            if new and rng.random() < 0.5:
+                del new[min(position, len(new) - 1)]
+            else:
+                new.insert(position, f"new {rng.random()}")
+        blocks = matching_blocks(old, new)
+
+        for context in (0, 2):
+            hunks = list(diff_hunks(old, new, hunk_ranges(blocks, len(old), len(new), context), context))
+            # Applying the hunks to the old text gives the new text
+            rebuilt, position = [], 0
+            for hunk in hunks:
+                rebuilt.extend(old[position:hunk["old_start"] - 1])
+                side = {"old": [], "new": []}
+                for run in hunk["runs"]:
+                    if run["type"] != "added":
+                        side["old"].extend(run["lines"])
+                    if run["type"] != "removed":
+                        side["new"].extend(run["lines"])
+                assert side["old"] == old[hunk["old_start"] - 1:hunk["old_start"] - 1 + hunk["old_lines"]]
+                assert len(side["new"]) == hunk["new_lines"]
+                rebuilt.extend(side["new"])
+                position = hunk["old_start"] - 1 + hunk["old_lines"]
+            rebuilt.extend(old[position:])
+            assert rebuilt == new
+            if context == 0:
+                assert all(run["type"] != "unchanged" for hunk in hunks for run in hunk["runs"])
+
+
+def test_composed_blocks_align_equal_lines():
+    rng = random.Random(11)
+    for _ in range(100):
+        versions = [[f"line {rng.randrange(30)}" for _ in range(rng.randrange(40))]]
+        for _ in range(4):
+            lines = list(versions[-1])
+            for _ in range(rng.randrange(5)):
+                position = rng.randrange(len(lines) + 1)
+                if lines and rng.random() < 0.5:
+                    del lines[min(position, len(lines) - 1)]
+                else:
+                    lines.insert(position, f"line {rng.randrange(30)}")
+            versions.append(lines)
+
+        blocks = matching_blocks(versions[0], versions[1])
+        for previous, lines in zip(versions[1:], versions[2:]):
+            blocks = compose_blocks(blocks, matching_blocks(previous, lines))
+        old, new = versions[0], versions[-1]
+        blocks = refine_blocks(old, new, blocks)
+
+        previous_end = (0, 0)
+        for i, j, size in blocks:
+            assert i >= previous_end[0] and j >= previous_end[1]
+            assert old[i:i + size] == new[j:j + size]
+            previous_end = (i + size, j + size)
+        diff = compare_versions({"title": "t", "content": "\n".join(old)}, {"title": "t", "content": "\n".join(new)}, blocks)
+        assert [d["content"] for d in diff["content_diff"] if d["type"] != "added"] == old
+        assert [d["content"] for d in diff["content_diff"] if d["type"] != "removed"] == new
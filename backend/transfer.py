@@ -0,0 +1,252 @@
+"""
+Export and import of notes with their full history as NDJSON.
+
+Each line holds one note and every version of it, with full contents:
+    {"id": 1, "title": ..., "content": ..., "created_at": ..., "updated_at": ...,
+     "versions": [{"version_number": 1, "title": ..., "content": ..., "created_at": ...}]}
+
+Exports walk the notes table in id order, one chunk at a time, so memory
+stays constant whatever the size of the database, all in one read
+transaction so that every chunk sees the same state of the database. Imports insert notes in
+batches, one transaction per batch, and re-encode each history according
+to the current storage mode. Imported notes get new ids.
+
+Run manually with:
+    python transfer.py export [notes.ndjson]
+    python transfer.py import notes.ndjson
+"""
+import datetime
+import json
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import insert, select, text
+from sqlalchemy.orm import Session
+
+from database import DBNote, DBNoteVersion
+from models import NoteCreate
+import storage
+
+EXPORT_CHUNK_SIZE = 500
+IMPORT_BATCH_SIZE = 1000
+
+
+def begin_snapshot(db: Session) -> None:
+    """
+    Open a read transaction on the session's connection: the queries up to
+    the next commit or rollback all see the database as it was at the first
+    one. pysqlite otherwise runs each SELECT on its own, outside of any
+    transaction.
+    """
+    db.execute(text("BEGIN"))
+
+
+def export_chunk(db: Session, after_id: int = 0, chunk_size: int = EXPORT_CHUNK_SIZE) -> Tuple[List[str], Optional[int]]:
+    """
+    Serialize the notes with an id above after_id, at most chunk_size of them.
+    Returns the NDJSON lines and the id to continue from, None when done.
+    """
+    notes = db.execute(
+        select(DBNote.id, DBNote.title, DBNote.content, DBNote.created_at, DBNote.updated_at)
+        .where(DBNote.id > after_id)
+        .order_by(DBNote.id)
+        .limit(chunk_size)
+    ).all()
+    if not notes:
+        return [], None
+
+    # Every version of the chunk, so delta chains resolve without further queries
+    versions = db.execute(
+        select(
+            DBNoteVersion.id,
+            DBNoteVersion.note_id,
+            DBNoteVersion.version_number,
+            DBNoteVersion.title,
+            DBNoteVersion.content,
+            DBNoteVersion.delta,
+            DBNoteVersion.base_id,
+            DBNoteVersion.created_at
+        )
+        .where(DBNoteVersion.note_id.between(notes[0].id, notes[-1].id))
+        .order_by(DBNoteVersion.note_id, DBNoteVersion.version_number)
+    ).all()
+    contents = storage.load_contents(db, versions)
+
+    versions_by_note = {}
+    for version in versions:
+        versions_by_note.setdefault(version.note_id, []).append({
+            "version_number": version.version_number,
+            "title": version.title,
+            "content": contents[version.id],
+            "created_at": version.created_at.isoformat(),
+        })
+
+    lines = [
+        json.dumps({
+            "id": note.id,
+            "title": note.title,
+            "content": note.content,
+            "created_at": note.created_at.isoformat(),
+            "updated_at": note.updated_at.isoformat(),
+            "versions": versions_by_note.get(note.id, []),
+        }, ensure_ascii=False) + "\n"
+        for note in notes
+    ]
+    next_id = notes[-1].id if len(notes) == chunk_size else None
+    return lines, next_id
+
+
+def export_notes(db: Session, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[str]:
+    """Yield every note as an NDJSON line, in id order, from a single snapshot"""
+    begin_snapshot(db)
+    after_id: Optional[int] = 0
+    while after_id is not None:
+        lines, after_id = export_chunk(db, after_id, chunk_size)
+        yield from lines
+        db.expunge_all()
+    db.commit()
+
+
+def _check_note(fields: dict, what: str) -> None:
+    """Check a title and content as the API checks those of a new note"""
+    try:
+        NoteCreate(title=fields["title"], content=fields["content"])
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{what} {error['loc'][0]}: {error['msg']}" for error in e.errors()))
+
+
+def parse_note(line: str, line_number: int) -> dict:
+    """
+    Parse and check one exported note, raising ValueError on bad input.
+    Titles and contents are held to the limits of the API. A note without
+    versions gets a first version holding its current state, as every note
+    has at least one.
+    """
+    try:
+        note = json.loads(line)
+        _check_note(note, "note")
+        note["created_at"] = datetime.datetime.fromisoformat(note["created_at"])
+        note["updated_at"] = datetime.datetime.fromisoformat(note["updated_at"])
+        versions = note.get("versions") or [{
+            "version_number": 1,
+            "title": note["title"],
+            "content": note["content"],
+            "created_at": note["updated_at"].isoformat(),
+        }]
+        for version in versions:
+            _check_note(version, "version")
+            version["created_at"] = datetime.datetime.fromisoformat(version["created_at"])
+        versions.sort(key=lambda version: version["version_number"])
+        note["versions"] = versions
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Line {line_number}: invalid note ({e})")
+    return note
+
+
+def import_batch(db: Session, notes: List[dict]) -> List[int]:
+    """
+    Insert parsed notes and their versions with multi-row INSERTs.
+    The caller commits. Returns the ids of the new notes, in order.
+    """
+    if not notes:
+        return []
+    note_ids = db.execute(
+        insert(DBNote).returning(DBNote.id, sort_by_parameter_order=True),
+        [
+            {
+                "title": note["title"],
+                "content": note["content"],
+                "created_at": note["created_at"],
+                "updated_at": note["updated_at"],
+            }
+            for note in notes
+        ]
+    ).scalars().all()
+
+    # The INSERT above holds the write lock, so these ids cannot be taken meanwhile.
+    # Deltas refer to their base by id, so ids are assigned before encoding;
+    # past sqlite_sequence too, as ids of deleted versions are not reused.
+    next_id = db.execute(text(
+        "SELECT max((SELECT coalesce(max(id), 0) FROM note_versions), "
+        "coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'note_versions'), 0))"
+    )).scalar() + 1
+    rows = []
+    for note_id, note in zip(note_ids, notes):
+        versions = []
+        contents = {}
+        for number, exported in enumerate(note["versions"], start=1):
+            version = DBNoteVersion(
+                id=next_id, note_id=note_id, title=exported["title"], version_number=number
+            )
+            contents[next_id] = exported["content"]
+            versions.append(version)
+            next_id += 1
+        storage.encode_history(versions, contents)
+        storage.save_blobs(db, (contents[version.id] for version in versions if version.delta is None))
+        rows.extend(
+            {
+                "id": version.id,
+                "note_id": note_id,
+                "version_number": version.version_number,
+                "title": version.title,
+                "content_hash": version.content_hash,
+                "delta": version.delta,
+                "base_id": version.base_id,
+                "chain_length": version.chain_length,
+                "size": version.size,
+                "created_at": exported["created_at"],
+            }
+            for version, exported in zip(versions, note["versions"])
+        )
+    if rows:
+        # A Core insert runs as one executemany; the ORM bulk insert would split
+        # the rows into a statement per run of snapshots or deltas
+        db.execute(insert(DBNoteVersion.__table__), rows)
+    return note_ids
+
+
+def import_notes(db: Session, lines: Iterable[str], batch_size: int = IMPORT_BATCH_SIZE) -> int:
+    """
+    Import NDJSON lines, committing every batch_size notes.
+    Returns the number of imported notes.
+    """
+    imported = 0
+    batch = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        batch.append(parse_note(line, line_number))
+        if len(batch) >= batch_size:
+            imported += len(import_batch(db, batch))
+            db.commit()
+            batch = []
+    imported += len(import_batch(db, batch))
+    db.commit()
+    return imported
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from database import SessionLocal, create_tables
+
+    parser = argparse.ArgumentParser(description="Export or import notes with their history as NDJSON")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", nargs="?", help="File to write or read, standard output/input by default")
+    args = parser.parse_args()
+
+    create_tables()
+    db = SessionLocal()
+    try:
+        if args.command == "export":
+            out = open(args.path, "w", encoding="utf-8") if args.path else sys.stdout
+            with out:
+                out.writelines(export_notes(db))
+        else:
+            source = open(args.path, encoding="utf-8") if args.path else sys.stdin
+            with source:
+                count = import_notes(db, source)
+            print(f"Imported {count} notes", file=sys.stderr)
+    finally:
+        db.close()
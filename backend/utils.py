@@ -1,10 +1,176 @@
-import difflib
-from typing import List, Dict, Any
+import base64
+import bisect
+import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 
-def compare_versions(old_version: Dict[str, Any], new_version: Dict[str, Any]) -> Dict[str, Any]:
+# Cost limit for the Myers fallback on a single segment. Segments that differ
+# by more edits than this are reported as fully removed then added.
+MAX_EDIT_DISTANCE = 1000
+
+
+def matching_blocks(old_lines: Sequence[str], new_lines: Sequence[str]) -> List[Tuple[int, int, int]]:
+    """
+    Find the lines two texts have in common.
+
+    Returns (old_index, new_index, length) runs of equal lines in increasing
+    order, like difflib.SequenceMatcher.get_matching_blocks() without the
+    sentinel. Lines are interned to integers, then aligned with patience diff
+    (unique common lines as anchors) and Myers' O(ND) algorithm for segments
+    without unique lines, which keeps large edited texts close to linear time.
+    """
+    table: Dict[str, int] = {}
+    a = [table.setdefault(line, len(table)) for line in old_lines]
+    b = [table.setdefault(line, len(table)) for line in new_lines]
+
+    blocks: List[Tuple[int, int, int]] = []
+    segments = [(0, len(a), 0, len(b))]
+    while segments:
+        alo, ahi, blo, bhi = segments.pop()
+
+        # Common prefix and suffix
+        start_a, start_b = alo, blo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start_a:
+            blocks.append((start_a, start_b, alo - start_a))
+        end_a = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if end_a > ahi:
+            blocks.append((ahi, bhi, end_a - ahi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            prev_a, prev_b = alo, blo
+            for i, j in anchors:
+                segments.append((prev_a, i, prev_b, j))
+                blocks.append((i, j, 1))
+                prev_a, prev_b = i + 1, j + 1
+            segments.append((prev_a, ahi, prev_b, bhi))
+        else:
+            blocks.extend(_myers(a, alo, ahi, b, blo, bhi))
+
+    # Merge touching runs into maximal blocks
+    merged: List[Tuple[int, int, int]] = []
+    for i, j, n in sorted(blocks):
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + n)
+        elif n:
+            merged.append((i, j, n))
+    return merged
+
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi) -> List[Tuple[int, int]]:
+    """
+    Lines occurring exactly once in both segments, reduced to their longest
+    increasing alignment (patience sorting).
+    """
+    counts: Dict[int, int] = {}
+    positions: Dict[int, int] = {}
+    for i in range(alo, ahi):
+        counts[a[i]] = counts.get(a[i], 0) + 1
+        positions[a[i]] = i
+    b_counts: Dict[int, int] = {}
+    b_positions: Dict[int, int] = {}
+    for j in range(blo, bhi):
+        if counts.get(b[j]) == 1:
+            b_counts[b[j]] = b_counts.get(b[j], 0) + 1
+            b_positions[b[j]] = j
+
+    pairs = sorted(
+        (positions[line], j) for line, j in b_positions.items() if b_counts[line] == 1
+    )
+    if not pairs:
+        return []
+
+    # Longest increasing subsequence on the new-side positions
+    tails: List[int] = []  # tails[k] = index in pairs ending an increasing run of length k + 1
+    tail_values: List[int] = []
+    previous: List[int] = [-1] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        k = bisect.bisect_left(tail_values, j)
+        if k > 0:
+            previous[index] = tails[k - 1]
+        if k == len(tails):
+            tails.append(index)
+            tail_values.append(j)
+        else:
+            tails[k] = index
+            tail_values[k] = j
+
+    anchors = []
+    index = tails[-1]
+    while index != -1:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _myers(a, alo, ahi, b, blo, bhi) -> List[Tuple[int, int, int]]:
+    """
+    Myers' greedy shortest edit script over one segment, as matching blocks.
+    Gives up (no common lines) past MAX_EDIT_DISTANCE edits.
+    """
+    n, m = ahi - alo, bhi - blo
+    max_d = min(n + m, MAX_EDIT_DISTANCE)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _myers_backtrack(trace, offset, d, n, m, alo, blo)
+        trace.append(v[offset - d - 1:offset + d + 2])
+
+    return []
+
+
+def _myers_backtrack(trace, offset, d, x, y, alo, blo) -> List[Tuple[int, int, int]]:
+    blocks = []
+    while d > 0:
+        # trace[d - 1] holds v for k in [-d, d] at index k + d
+        v_prev = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and v_prev[k - 1 + d] < v_prev[k + 1 + d]):
+            prev_k = k + 1
+            mid_x = v_prev[prev_k + d]
+        else:
+            prev_k = k - 1
+            mid_x = v_prev[prev_k + d] + 1
+        if x > mid_x:
+            blocks.append((alo + mid_x, blo + mid_x - k, x - mid_x))
+        x = v_prev[prev_k + d]
+        y = x - prev_k
+        d -= 1
+    if x > 0:
+        blocks.append((alo, blo, x))
+    return blocks
+
+
+def compare_versions(
+    old_version: Dict[str, Any],
+    new_version: Dict[str, Any],
+    blocks: Optional[Sequence[Tuple[int, int, int]]] = None
+) -> Dict[str, Any]:
     """
     Compare two versions of a note and return the differences.
+    blocks is the matching_blocks of their lines, when already known.
     """
     result = {
         "title_changed": old_version["title"] != new_version["title"],
@@ -16,26 +182,175 @@ def compare_versions(old_version: Dict[str, Any], new_version: Dict[str, Any]) -
     # Compare content line by line
     old_lines = old_version["content"].splitlines()
     new_lines = new_version["content"].splitlines()
-    
-    # Use difflib to get a detailed comparison
-    differ = difflib.Differ()
-    diff = list(differ.compare(old_lines, new_lines))
-    
-    for line in diff:
-        if line.startswith('  '):  # Unchanged line
-            result["content_diff"].append({
-                "type": "unchanged",
-                "content": line[2:]
-            })
-        elif line.startswith('- '):  # Removed line
-            result["content_diff"].append({
-                "type": "removed",
-                "content": line[2:]
-            })
-        elif line.startswith('+ '):  # Added line
-            result["content_diff"].append({
-                "type": "added",
-                "content": line[2:]
-            })
-    
+
+    # Walk the common runs, reporting removed then added lines in between
+    content_diff = result["content_diff"]
+    i = j = 0
+    if blocks is None:
+        blocks = matching_blocks(old_lines, new_lines)
+    for block_i, block_j, size in list(blocks) + [(len(old_lines), len(new_lines), 0)]:
+        content_diff.extend({"type": "removed", "content": line} for line in old_lines[i:block_i])
+        content_diff.extend({"type": "added", "content": line} for line in new_lines[j:block_j])
+        content_diff.extend(
+            {"type": "unchanged", "content": line} for line in old_lines[block_i:block_i + size]
+        )
+        i, j = block_i + size, block_j + size
+
+    return result
+
+
+def compose_blocks(
+    first: Sequence[Tuple[int, int, int]], second: Sequence[Tuple[int, int, int]]
+) -> List[Tuple[int, int, int]]:
+    """
+    Chain two alignments: given the matching blocks of a against b and of b
+    against c, return the matching blocks of a against c, i.e. the lines of
+    a that are carried unchanged through b into c.
+    """
+    result: List[Tuple[int, int, int]] = []
+    k = 0
+    for i, j, n in first:
+        while k < len(second) and second[k][0] + second[k][2] <= j:
+            k += 1
+        m = k
+        while m < len(second) and second[m][0] < j + n:
+            second_i, second_j, second_n = second[m]
+            start, end = max(j, second_i), min(j + n, second_i + second_n)
+            if end > start:
+                block = (i + start - j, second_j + start - second_i, end - start)
+                last = result[-1] if result else None
+                if last and last[0] + last[2] == block[0] and last[1] + last[2] == block[1]:
+                    result[-1] = (last[0], last[1], last[2] + block[2])
+                else:
+                    result.append(block)
+            m += 1
     return result
+
+
+def refine_blocks(
+    old_lines: Sequence[str], new_lines: Sequence[str], blocks: Sequence[Tuple[int, int, int]]
+) -> List[Tuple[int, int, int]]:
+    """
+    Align the lines between matching blocks again. Composed alignments miss
+    lines that were removed then restored along the way; this finds them
+    while only diffing the changed regions.
+    """
+    refined: List[Tuple[int, int, int]] = []
+    for i1, i2, j1, j2 in _changes(blocks, len(old_lines), len(new_lines)):
+        # Most gaps share no line at all, which is much cheaper to rule out
+        if i2 > i1 and j2 > j1 and not set(old_lines[i1:i2]).isdisjoint(new_lines[j1:j2]):
+            refined.extend(
+                (i1 + i, j1 + j, n) for i, j, n in matching_blocks(old_lines[i1:i2], new_lines[j1:j2])
+            )
+    merged: List[Tuple[int, int, int]] = []
+    for i, j, n in sorted(list(blocks) + refined):
+        if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + n)
+        else:
+            merged.append((i, j, n))
+    return merged
+
+
+def _changes(blocks: Sequence[Tuple[int, int, int]], old_count: int, new_count: int) -> Iterator[Tuple[int, int, int, int]]:
+    """Yield the (old_start, old_end, new_start, new_end) ranges between matching blocks"""
+    i = j = 0
+    for block_i, block_j, size in list(blocks) + [(old_count, new_count, 0)]:
+        if block_i > i or block_j > j:
+            yield i, block_i, j, block_j
+        i, j = block_i + size, block_j + size
+
+
+def hunk_ranges(
+    blocks: Sequence[Tuple[int, int, int]], old_count: int, new_count: int, context: int = 3
+) -> List[List[Tuple[int, int, int, int]]]:
+    """
+    Group the changed ranges of a diff into hunks: changes separated by at most
+    2 * context unchanged lines share a hunk, as in a unified diff.
+    """
+    hunks: List[List[Tuple[int, int, int, int]]] = []
+    for change in _changes(blocks, old_count, new_count):
+        if hunks and change[0] - hunks[-1][-1][1] <= 2 * context:
+            hunks[-1].append(change)
+        else:
+            hunks.append([change])
+    return hunks
+
+
+def diff_hunks(
+    old_lines: Sequence[str],
+    new_lines: Sequence[str],
+    ranges: Iterable[List[Tuple[int, int, int, int]]],
+    context: int = 3
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the hunks of a diff, given (a slice of) its hunk_ranges.
+
+    A hunk gives the 1-based line ranges it covers in both texts and runs of
+    consecutive lines of the same type (unchanged, removed or added), with
+    at most context unchanged lines around each change. Hunks are built one
+    at a time, so a diff can be sent without ever holding it whole.
+    """
+    for changes in ranges:
+        first_old, first_new = changes[0][0], changes[0][2]
+        lead = min(context, first_old)
+        old_start, new_start = first_old - lead, first_new - lead
+        old_end = min(len(old_lines), changes[-1][1] + context)
+        new_end = new_start + (old_end - old_start) + sum((j2 - j1) - (i2 - i1) for i1, i2, j1, j2 in changes)
+
+        runs: List[Dict[str, Any]] = []
+
+        def add_run(kind: str, lines: Sequence[str]) -> None:
+            if lines:
+                runs.append({"type": kind, "lines": list(lines)})
+
+        add_run("unchanged", old_lines[old_start:first_old])
+        for index, (i1, i2, j1, j2) in enumerate(changes):
+            add_run("removed", old_lines[i1:i2])
+            add_run("added", new_lines[j1:j2])
+            following = changes[index + 1][0] if index + 1 < len(changes) else old_end
+            add_run("unchanged", old_lines[i2:following])
+
+        yield {
+            "old_start": old_start + 1,
+            "old_lines": old_end - old_start,
+            "new_start": new_start + 1,
+            "new_lines": new_end - new_start,
+            "runs": runs,
+        }
+
+
+def encode_cursor(updated_at: datetime.datetime, note_id: int) -> str:
+    """
+    Encode the keyset position of the last note of a page into an opaque cursor.
+    """
+    raw = f"{updated_at.isoformat()}|{note_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """
+    Decode a cursor produced by encode_cursor. Raises ValueError if it is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        updated_at, note_id = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.datetime.fromisoformat(updated_at), int(note_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def fts_query(text: str) -> str:
+    """
+    Turn user input into an FTS5 query matching notes that contain every word.
+    Words are quoted so FTS5 operators in the input are taken literally; a
+    trailing * still makes a word a prefix search.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        raise ValueError("Empty search query")
+    return " ".join(terms)
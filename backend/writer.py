@@ -0,0 +1,141 @@
+"""
+Group commit of note writes.
+
+Every write transaction ends with a commit, and a commit is where SQLite
+syncs the journal to disk. With NOTES_GROUP_COMMIT=1, writes are handed to a
+single writer thread instead, which runs whatever writes are waiting (up to
+MAX_BATCH, after waiting at most NOTES_GROUP_COMMIT_DELAY_MS for more) in one
+transaction and commits them together. Each write runs in its own SAVEPOINT,
+so one that fails is rolled back alone and its exception goes back to its
+request; a failed commit fails every write of the batch.
+
+A request only hears back once the commit that holds its write is done, so
+writes are exactly as durable as without grouping.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from database import configure_sqlite, pool_options
+from observability import logger
+
+GROUP_COMMIT = os.environ.get("NOTES_GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_DELAY_MS = float(os.environ.get("NOTES_GROUP_COMMIT_DELAY_MS", "1"))
+
+# Most writes committed together
+MAX_BATCH = 64
+
+Job = Tuple[Callable[..., Any], tuple, dict, Future]
+
+
+def immediate_engine(url: str, pragmas: Optional[Dict[str, object]] = None):
+    """
+    A blocking engine whose transactions start with BEGIN IMMEDIATE, taking
+    the write lock up front. The sqlite3 module's own transaction handling
+    is switched off, as SQLAlchemy needs to emit SAVEPOINTs itself.
+    """
+    bind = create_engine(url, connect_args={"check_same_thread": False}, **pool_options(url))
+    configure_sqlite(bind, pragmas)
+
+    @event.listens_for(bind, "connect")
+    def disable_implicit_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(bind, "begin")
+    def begin_immediate(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return bind
+
+
+class GroupCommitWriter:
+    """
+    Runs write jobs on a dedicated thread, committing them in batches.
+    A job is called as job(session, *args, **kwargs) and must not commit.
+    """
+
+    def __init__(self, bind, max_batch: int = MAX_BATCH, delay_ms: float = GROUP_COMMIT_DELAY_MS):
+        self.session_factory = sessionmaker(bind=bind, autoflush=False, expire_on_commit=False)
+        self.max_batch = max_batch
+        self.delay_ms = delay_ms
+        self.jobs = 0  # Jobs committed
+        self.commits = 0  # Commits that held them
+        self._queue: "queue.Queue[Optional[Job]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    async def submit(self, job: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a job in the next batch and return its result once committed"""
+        future: Future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((job, args, kwargs, future))
+        return await asyncio.wrap_future(future)
+
+    def close(self) -> None:
+        """Commit the jobs already submitted and stop the thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._commit(batch)
+
+    def _next_batch(self) -> Optional[List[Job]]:
+        """Wait for a job, then take those that follow it within the delay"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.delay_ms / 1000
+        while len(batch) < self.max_batch:
+            try:
+                job = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if job is None:
+                self._queue.put(None)  # Stop after this batch
+                break
+            batch.append(job)
+        return batch
+
+    def _commit(self, batch: List[Job]) -> None:
+        done = []
+        try:
+            with self.session_factory() as db:
+                for job, args, kwargs, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with db.begin_nested():
+                            result = job(db, *args, **kwargs)
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        done.append((future, result))
+                db.commit()
+        except Exception as e:
+            logger.exception("Group commit failed", extra={"writes": len(batch)})
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.jobs += len(done)
+        self.commits += 1
+        for future, result in done:
+            future.set_result(result)
@@ -5,13 +5,13 @@ import { Button } from "@/components/ui/button";
 import { Skeleton } from "@/components/ui/skeleton";
 import { Edit, Clock, Trash2 } from "lucide-react";
 import { toast } from 'react-toastify';
-import { Note } from '../types';
+import { NoteWithVersionHeaders } from '../types';
 import { getNote, deleteNote } from '../services/api';
 
 const NoteDetail: React.FC = () => {
   const { id } = useParams();
   const navigate = useNavigate();
-  const [note, setNote] = useState<Note | null>(null);
+  const [note, setNote] = useState<NoteWithVersionHeaders | null>(null);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
@@ -6,14 +6,14 @@ import { Input } from "@/components/ui/input";
 import { Textarea } from "@/components/ui/textarea";
 import { Save, X } from "lucide-react";
 import { toast } from 'react-toastify';
-import { Note } from '../types';
+import { NoteWithVersionHeaders } from '../types';
 import { createNote, updateNote, getNote } from '../services/api';
 
 const NoteForm: React.FC = () => {
   const { id } = useParams();
   const navigate = useNavigate();
   const [loading, setLoading] = useState(false);
-  const [note, setNote] = useState<Partial<Note>>({
+  const [note, setNote] = useState<Partial<NoteWithVersionHeaders>>({
     title: '',
     content: ''
   });
@@ -1,8 +1,9 @@
 import { useEffect, useState } from "react";
-import { getNotes, deleteNote } from "../services/api";
-import { Note } from "../types";
+import { getNotes, deleteNote, searchNotes } from "../services/api";
+import { NoteSearchResult, NoteSummary } from "../types";
 import { Card, CardHeader, CardTitle, CardDescription, CardContent, CardFooter } from "./ui/card";
 import { Button } from "./ui/button";
+import { Input } from "./ui/input";
 import { Pencil, Trash2, History, Plus } from "lucide-react";
 import { useNavigate } from "react-router-dom";
 import { toast } from "sonner";
@@ -18,14 +19,45 @@ import {
   AlertDialogTrigger,
 } from "./ui/alert-dialog";
 
+// Render a search snippet, highlighting the words wrapped in <mark></mark>
+function Snippet({ text }: { text: string }) {
+  return (
+    <>
+      {text.split(/(<mark>.*?<\/mark>)/).map((part, i) =>
+        part.startsWith("<mark>") ? (
+          <mark key={i}>{part.slice(6, -7)}</mark>
+        ) : (
+          <span key={i}>{part}</span>
+        )
+      )}
+    </>
+  );
+}
+
 export default function NoteList() {
-  const [notes, setNotes] = useState<Note[]>([]);
+  const [notes, setNotes] = useState<NoteSummary[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [query, setQuery] = useState("");
+  const [results, setResults] = useState<NoteSearchResult[] | null>(null);
+  const [nextOffset, setNextOffset] = useState<number | null>(null);
   const navigate = useNavigate();
 
   const fetchNotes = async () => {
     try {
-      const data = await getNotes();
-      setNotes(data);
+      const page = await getNotes();
+      setNotes(page.items);
+      setNextCursor(page.next_cursor);
+    } catch (error) {
+      toast.error("Failed to load notes");
+    }
+  };
+
+  const fetchMoreNotes = async () => {
+    if (!nextCursor) return;
+    try {
+      const page = await getNotes(nextCursor);
+      setNotes(prev => [...prev, ...page.items]);
+      setNextCursor(page.next_cursor);
     } catch (error) {
       toast.error("Failed to load notes");
     }
@@ -35,9 +67,42 @@ export default function NoteList() {
     fetchNotes();
   }, []);
 
+  // Search on the server once typing pauses
+  useEffect(() => {
+    if (!query.trim()) {
+      setResults(null);
+      setNextOffset(null);
+      return;
+    }
+    const timer = setTimeout(async () => {
+      try {
+        const page = await searchNotes(query);
+        setResults(page.items);
+        setNextOffset(page.next_offset);
+      } catch (error) {
+        toast.error("Search failed");
+      }
+    }, 250);
+    return () => clearTimeout(timer);
+  }, [query]);
+
+  const fetchMoreResults = async () => {
+    if (nextOffset === null) return;
+    try {
+      const page = await searchNotes(query, nextOffset);
+      setResults(prev => [...(prev ?? []), ...page.items]);
+      setNextOffset(page.next_offset);
+    } catch (error) {
+      toast.error("Search failed");
+    }
+  };
+
+  const shown: (NoteSummary | NoteSearchResult)[] = results ?? notes;
+
   const handleDelete = async (id: number) => {
     try {
       await deleteNote(id);
+      setResults(prev => prev && prev.filter(result => result.id !== id));
       await fetchNotes();
       toast.success("Note deleted successfully");
     } catch (error) {
@@ -66,13 +131,22 @@ export default function NoteList() {
         </div>
       </div>
 
-      {notes.length === 0 ? (
+      <Input
+        type="search"
+        placeholder="Search notes..."
+        value={query}
+        onChange={(e) => setQuery(e.target.value)}
+      />
+
+      {shown.length === 0 ? (
         <div className="text-center py-12">
-          <p className="text-muted-foreground text-lg">No notes yet. Create your first note!</p>
+          <p className="text-muted-foreground text-lg">
+            {results ? "No matching notes." : "No notes yet. Create your first note!"}
+          </p>
         </div>
       ) : (
         <div className="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-6">
-          {notes.map((note) => (
+          {shown.map((note) => (
             <Card key={note.id} className="flex flex-col hover:shadow-lg transition-shadow">
               <CardHeader className="space-y-1">
                 <CardTitle className="text-2xl">{note.title}</CardTitle>
@@ -81,7 +155,9 @@ export default function NoteList() {
                 </CardDescription>
               </CardHeader>
               <CardContent className="flex-grow">
-                <p className="line-clamp-3 text-muted-foreground">{note.content}</p>
+                <p className="line-clamp-3 text-muted-foreground">
+                  {"snippet" in note ? <Snippet text={note.snippet} /> : note.excerpt}
+                </p>
               </CardContent>
               <CardFooter className="flex justify-end gap-2 pt-6">
                 <Button
@@ -113,6 +189,14 @@ export default function NoteList() {
           ))}
         </div>
       )}
+
+      {(results ? nextOffset !== null : nextCursor) && (
+        <div className="flex justify-center">
+          <Button variant="outline" onClick={results ? fetchMoreResults : fetchMoreNotes}>
+            Load more
+          </Button>
+        </div>
+      )}
     </div>
   );
 }
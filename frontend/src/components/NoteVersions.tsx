@@ -13,12 +13,12 @@ import {
 import { Skeleton } from "@/components/ui/skeleton";
 import { ArrowLeft, Eye, RotateCcw } from "lucide-react";
 import { toast } from 'react-toastify';
-import { Note, NoteVersion } from '../types';
+import { NoteWithVersionHeaders, NoteVersionHeader } from '../types';
 import { getNote, restoreVersion } from '../services/api';
 
 const NoteVersions: React.FC = () => {
   const { id } = useParams();
-  const [note, setNote] = useState<Note | null>(null);
+  const [note, setNote] = useState<NoteWithVersionHeaders | null>(null);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
@@ -80,14 +80,14 @@ const NoteVersions: React.FC = () => {
           </p>
         </CardHeader>
         <CardContent className="p-4">
-          {note.versions.map((version: NoteVersion, index: number) => (
+          {note.versions.map((version: NoteVersionHeader) => (
             <div
               key={version.id}
               className="mb-3 p-3 border border-green-700 rounded-lg hover:bg-green-800 transition-colors cursor-pointer"
             >
               <div className="text-white font-bold">{version.title}</div>
               <div className="text-green-200 text-sm">
-                Version {note.versions.length - index}
+                Version {version.version_number}
               </div>
               <div className="text-green-300 text-xs">
                 {new Date(version.created_at).toLocaleString()}
@@ -1,5 +1,5 @@
 // src/services/api.ts
-import { Note, NoteVersion, NoteDiff, NoteFormData, ApiError } from '../types';
+import { Note, NoteWithVersionHeaders, NotePage, NoteSearchPage, NoteVersion, NoteDiff, NoteFormData, ApiError } from '../types';
 
 const API_URL = '/api'; // API URL is handled by Vite proxy
 
@@ -18,14 +18,25 @@ const handleApiError = async (response: Response): Promise<any> => {
   return response.json();
 };
 
-// Get all notes
-export const getNotes = async (): Promise<Note[]> => {
-  const response = await fetch(`${API_URL}/notes`);
+// Get a page of note summaries; pass the previous page's next_cursor to continue
+export const getNotes = async (cursor?: string | null, limit: number = 50): Promise<NotePage> => {
+  const params = new URLSearchParams({ limit: String(limit) });
+  if (cursor) {
+    params.set('cursor', cursor);
+  }
+  const response = await fetch(`${API_URL}/notes?${params}`);
+  return handleApiError(response);
+};
+
+// Search notes, best matches first; pass the previous page's next_offset to continue
+export const searchNotes = async (query: string, offset: number = 0, limit: number = 20): Promise<NoteSearchPage> => {
+  const params = new URLSearchParams({ q: query, offset: String(offset), limit: String(limit) });
+  const response = await fetch(`${API_URL}/notes/search?${params}`);
   return handleApiError(response);
 };
 
 // Get a single note by ID
-export const getNote = async (id: number): Promise<Note> => {
+export const getNote = async (id: number): Promise<NoteWithVersionHeaders> => {
   const response = await fetch(`${API_URL}/notes/${id}`);
   return handleApiError(response);
 };
@@ -12,11 +12,61 @@ export interface Note {
 export interface NoteVersion {
   id: number;
   note_id: number;
+  version_number: number;
   title: string;
   content: string;
   created_at: string;
 }
 
+export interface NoteVersionHeader {
+  id: number;
+  note_id: number;
+  version_number: number;
+  title: string;
+  created_at: string;
+  size: number; // Length of the content in characters
+}
+
+// A note as returned by getNote: version bodies are fetched one at a time
+export interface NoteWithVersionHeaders extends Omit<Note, 'versions'> {
+  versions: NoteVersionHeader[];
+}
+
+export interface NoteVersionSummary {
+  id: number;
+  note_id: number;
+  version_number: number;
+  created_at: string;
+}
+
+export interface NoteSummary {
+  id: number;
+  title: string;
+  excerpt: string;
+  created_at: string;
+  updated_at: string;
+  versions: NoteVersionSummary[] | null;
+}
+
+export interface NotePage {
+  items: NoteSummary[];
+  next_cursor: string | null;
+}
+
+export interface NoteSearchResult {
+  id: number;
+  title: string;
+  snippet: string; // Matched words are wrapped in <mark></mark>
+  rank: number;
+  created_at: string;
+  updated_at: string;
+}
+
+export interface NoteSearchPage {
+  items: NoteSearchResult[];
+  next_offset: number | null;
+}
+
 export interface NoteDiff {
   title_changed: boolean;
   old_title: string | null;